@@ -0,0 +1,150 @@
+"""
+Route the sites of a batch to Tag Manager and Analytics accounts, spreading them over many accounts.
+"""
+from __future__ import print_function, unicode_literals
+import hashlib
+import threading
+
+from google_tag_manager_api import IterAccounts, GetContainersList
+from google_analytics_api import IterAccounts as IterAnalyticsAccounts, GetWebPropertyIndex
+import settings
+
+STRATEGIES = ('first', 'hash', 'least_loaded')
+
+
+def _Hash(name):
+    return int(hashlib.md5(name.encode('utf-8')).hexdigest(), 16)
+
+
+class _Pool(object):
+    """
+    The accounts of one API with the number of resources (containers or web
+    properties) each holds, and the account every existing resource is in.
+    """
+
+    def __init__(self, api_name, limit):
+        self.api_name = api_name
+        self.limit = limit
+        self.account_ids = []
+        self.counts = {}
+        self.owners = {}
+
+    def add(self, account_id, names):
+        self.account_ids.append(account_id)
+        self.counts[account_id] = len(names)
+        for name in names:
+            self.owners.setdefault(name, account_id)
+
+    def choose(self, name, strategy, account_id=None):
+        """
+        Return the account of a resource: the one holding it already, else
+        account_id when given, else one with room left picked by strategy.
+        The resource is counted in right away so concurrent sites spread out.
+        """
+
+        if name in self.owners:
+            return self.owners[name]
+
+        if account_id is None:
+            candidates = [candidate for candidate in self.account_ids
+                          if self.limit is None or self.counts[candidate] < self.limit]
+            if not candidates:
+                raise Exception('Every %s account holds %s resources already, add an account or raise the limit'
+                                % (self.api_name, self.limit))
+
+            if strategy == 'hash':
+                # stable across runs, moving to the next account when the hashed one is full
+                start = _Hash(name) % len(self.account_ids)
+                ordered = self.account_ids[start:] + self.account_ids[:start]
+                account_id = next(candidate for candidate in ordered if candidate in candidates)
+            elif strategy == 'least_loaded':
+                account_id = min(candidates, key=lambda candidate: self.counts[candidate])
+            else:
+                account_id = candidates[0]
+
+        self.owners[name] = account_id
+        self.counts[account_id] = self.counts.get(account_id, 0) + 1
+        return account_id
+
+
+class AccountRouter(object):
+    """
+    Chooses the Tag Manager account and the Analytics account of every site
+    of a batch, so provisioning scales past the limits of a single account.
+
+    A site whose container or web property exists already keeps its account
+    whatever the strategy. A new one goes to the account its manifest options
+    name (tagmanager_account and analytics_account), else to an account with
+    room left, picked by strategy:
+
+    first: fill the accounts in listing order.
+    hash: a stable hash of the site name, sites keep their account across runs.
+    least_loaded: the account holding the fewest containers or web properties.
+
+    Built once per batch: every account is listed with its containers and
+    web properties, through inventory when given. Thread-safe.
+
+    Args:
+    analytics_service: an authorized analytics v3 service object.
+    tag_manager_service: an authorized tagmanager service object.
+    strategy: one of STRATEGIES. Defaults to settings.ACCOUNT_ROUTING.
+    inventory: optional Inventory caching the listings.
+    tag_manager_accounts: IDs of the Tag Manager accounts to use.
+      Defaults to settings.TAG_MANAGER_ACCOUNTS, every account if empty.
+    analytics_accounts: IDs of the Analytics accounts to use.
+      Defaults to settings.ANALYTICS_ACCOUNTS, every account if empty.
+    """
+
+    def __init__(self, analytics_service, tag_manager_service, strategy=None, inventory=None,
+                 tag_manager_accounts=None, analytics_accounts=None):
+        self.strategy = strategy or settings.ACCOUNT_ROUTING
+        if self.strategy not in STRATEGIES:
+            raise Exception('Improperly configured settings: unknown ACCOUNT_ROUTING %s' % self.strategy)
+
+        self._lock = threading.Lock()
+        self._property_indexes = {}
+        self._tag_manager = _Pool('Tag Manager', settings.TAG_MANAGER_ACCOUNT_CONTAINER_LIMIT)
+        self._analytics = _Pool('Analytics', settings.ANALYTICS_ACCOUNT_PROPERTY_LIMIT)
+
+        tag_manager_accounts = tag_manager_accounts or settings.TAG_MANAGER_ACCOUNTS or [
+            account.get('accountId') for account in IterAccounts(tag_manager_service)]
+        if not tag_manager_accounts:
+            raise Exception('Currently you have not created any account on Google Tag Manager. Please create one.')
+        for account_id in tag_manager_accounts:
+            self._tag_manager.add(account_id, GetContainersList(tag_manager_service, account_id, inventory))
+
+        analytics_accounts = analytics_accounts or settings.ANALYTICS_ACCOUNTS or [
+            account.get('id') for account in IterAnalyticsAccounts(analytics_service)]
+        if not analytics_accounts:
+            raise Exception('Currently you have not created any account on Google Analytics. Please create one.')
+        for account_id in analytics_accounts:
+            property_index = GetWebPropertyIndex(analytics_service, account_id, inventory)
+            self._property_indexes[account_id] = property_index
+            self._analytics.add(account_id, property_index.names())
+
+    def route(self, site):
+        """
+        Return the Tag Manager account ID and the WebPropertyIndex of the Analytics account of a manifest site.
+        """
+
+        options = site.get('options') or {}
+        # JSONL manifests may give account IDs as numbers
+        explicit = {key: str(options[key]) if options.get(key) else None
+                    for key in ('tagmanager_account', 'analytics_account')}
+        with self._lock:
+            tag_manager_account = self._tag_manager.choose(site['name'], self.strategy,
+                                                           explicit['tagmanager_account'])
+            analytics_account = self._analytics.choose(site['name'], self.strategy, explicit['analytics_account'])
+
+        if analytics_account not in self._property_indexes:
+            raise Exception('Analytics account %s of site %s is not one of the routed accounts'
+                            % (analytics_account, site['name']))
+        return tag_manager_account, self._property_indexes[analytics_account]
+
+    def loads(self):
+        """
+        Return the number of containers and web properties per account, including the sites routed so far.
+        """
+
+        with self._lock:
+            return {'tagmanager': dict(self._tag_manager.counts), 'analytics': dict(self._analytics.counts)}
@@ -0,0 +1,572 @@
+"""
+Asyncio client of the Tag Manager v1 and v2 and Analytics v3 management APIs, on pooled aiohttp connections.
+
+Requires Python 3.6+ and aiohttp. The operations mirror google_tag_manager_api
+and google_analytics_api, but take an AsyncClient instead of a service object
+and are coroutines, so one process can keep thousands of them in flight.
+"""
+import asyncio
+import socket
+import time
+
+import aiohttp
+import httplib2
+from googleapiclient.http import HttpError
+import simplejson as json
+
+from auth import ExpiresSoon
+from google_tag_manager_api import ChooseWorkspace, HelloWorldTag, TagFingerprint, HELLO_WORLD_TAG_NAME
+from metrics import METRICS
+import retry
+from services import GetCredentials
+import settings
+
+# path of every API version under the root URL
+API_PATHS = {
+    ('tagmanager', 'v1'): '/tagmanager/v1/',
+    ('tagmanager', 'v2'): '/tagmanager/v2/',
+    ('analytics', 'v3'): '/analytics/v3/management/',
+}
+
+# APIs with method IDs like analytics.management.webproperties.insert: the last
+# collection of the path only, under management, and creates named insert
+MANAGEMENT_APIS = ('analytics',)
+
+# verbs of the methods on a collection and on one of its resources, by HTTP method
+COLLECTION_VERBS = {'GET': 'list', 'POST': 'create'}
+RESOURCE_VERBS = {'GET': 'get', 'PUT': 'update', 'PATCH': 'patch', 'DELETE': 'delete'}
+
+# custom methods v1 has as a path segment after the resource ID, v2 puts them after a ':'
+V1_ACTIONS = ('publish', 'restore', 'undelete')
+
+
+def _MethodId(api_name, method, path):
+    """
+    Return the API method ID of a request as the discovery document names it,
+    e.g. tagmanager.accounts.containers.workspaces.create_version for POST
+    accounts/1/containers/2/workspaces/3:create_version. IDs are left out so
+    the number of metrics series stays bounded, like with the sync client.
+    """
+
+    path, _, verb = path.partition(':')
+    segments = [segment for segment in path.split('/') if segment]
+    if not verb and len(segments) % 2 and segments[-1] in V1_ACTIONS:
+        verb = segments.pop()
+    # collections and resource IDs alternate
+    collections = segments[0::2]
+    if not verb:
+        verb = (COLLECTION_VERBS if len(segments) % 2 else RESOURCE_VERBS).get(method, method.lower())
+    if api_name in MANAGEMENT_APIS:
+        return '.'.join([api_name, 'management', collections[-1], 'insert' if verb == 'create' else verb])
+    return '.'.join([api_name] + collections + [verb])
+
+
+def _ErrorMessage(error):
+    try:
+        return json.loads(error.content)['error']['message']
+    except (ValueError, KeyError, TypeError):
+        return '%s : %s' % (error.resp.status, error.resp.reason)
+
+
+class AsyncClient(object):
+    """
+    Authorized client of one Google API on an aiohttp session.
+
+    All requests share one pool of keep-alive connections and are retried
+    like retry.Execute does, sleeping with asyncio instead of blocking.
+    Use it as an async context manager or call close.
+
+    Args:
+    api_name: 'tagmanager' or 'analytics'.
+    scope: auth scopes, e.g. settings.TAG_MANAGER_SCOPE.
+    api_version: 'v1' or 'v2' for Tag Manager, 'v3' for Analytics.
+    client_secrets_path: defaults to settings.GOOGLE_DEVELOPER_SECRET_KEY.
+    connections: size of the connection pool. Defaults to settings.ASYNC_CONNECTIONS.
+    limiter: optional TokenBucket, shared with threads or other clients if needed.
+    policy: retry.RetryPolicy, retry.DEFAULT_POLICY if not given.
+    stats: retry.RetryStats to record into, retry.STATS if not given.
+    """
+
+    def __init__(self, api_name, scope, api_version, client_secrets_path=None, connections=None, limiter=None,
+                 policy=None, stats=None):
+        self.api_name = api_name
+        self.api_version = api_version
+        self.root = (settings.API_ROOT_URL or 'https://www.googleapis.com') + API_PATHS[(api_name, api_version)]
+        # v2 addresses tags by workspace, see GetWorkspacePath
+        self.v2 = (api_name, api_version) == ('tagmanager', 'v2')
+        self.limiter = limiter
+        self.policy = policy or retry.DEFAULT_POLICY
+        self.stats = stats or retry.STATS
+        # loaded (or authorized interactively) once, the token is refreshed off the event loop.
+        # A local stand-in of the APIs takes unauthenticated requests.
+        self.credentials = None if settings.API_ROOT_URL else GetCredentials(
+            api_name, scope, client_secrets_path or settings.GOOGLE_DEVELOPER_SECRET_KEY)
+        self.connections = connections or settings.ASYNC_CONNECTIONS
+        # created on the event loop by the first request
+        self._session = None
+        self._refresh_lock = None
+        # v2 workspace path and its lookup lock per (account ID, container ID)
+        self._workspaces = {}
+        self._workspace_locks = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _Token(self, refresh=False):
+        if self._refresh_lock is None:
+            self._refresh_lock = asyncio.Lock()
+        async with self._refresh_lock:
+            if refresh or ExpiresSoon(self.credentials):
+                await asyncio.get_event_loop().run_in_executor(None, self.credentials.refresh, httplib2.Http())
+            return self.credentials.access_token
+
+    async def _Acquire(self):
+        while self.limiter is not None:
+            wait = self.limiter.reserve()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    async def _Send(self, method, path, params, body):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        await self._Acquire()
+        headers = {'Authorization': 'Bearer %s' % await self._Token()} if self.credentials else {}
+        label = _MethodId(self.api_name, method, path)
+        start = time.time()
+        async with self._session.request(method, self.root + path, params=params, json=body,
+                                         headers=headers) as response:
+            content = await response.read()
+            METRICS.record_request(label, response.status, time.time() - start,
+                                   len(json.dumps(body)) if body is not None else 0, len(content))
+            if response.status >= 300:
+                info = dict((key.lower(), value) for key, value in response.headers.items())
+                info.update({'status': str(response.status), 'reason': response.reason})
+                raise HttpError(httplib2.Response(info), content, uri=str(response.url))
+            return json.loads(content) if content else {}
+
+    async def request(self, method, path, params=None, body=None, idempotent=True):
+        """
+        Send a request and return its JSON response as a dict.
+
+        Args:
+        method: HTTP method.
+        path: path under the API root, e.g. 'accounts/123/containers'.
+        params: dict of query parameters, None values are left out.
+        body: JSON body.
+        idempotent: False for create and insert calls, see retry.RetryPolicy.is_retryable.
+
+        Raises HttpError like the service objects once retries are exhausted.
+        """
+
+        params = dict((key, value) for key, value in (params or {}).items() if value is not None)
+        attempt = 1
+        refreshed = False
+
+        while True:
+            self.stats.record_call()
+            try:
+                return await self._Send(method, path, params, body)
+            except HttpError as error:
+                if error.resp.status == 401 and self.credentials and not refreshed:
+                    # expired or revoked token, refresh it once
+                    refreshed = True
+                    await self._Token(refresh=True)
+                    continue
+                retryable, status = self.policy.is_retryable(error, idempotent), error.resp.status
+                failure = error
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                retryable, status = self.policy.is_retryable(socket.error(str(error)), idempotent), 'socket'
+                failure = error
+
+            if attempt >= self.policy.max_attempts or not retryable:
+                self.stats.record_failure()
+                raise failure
+
+            delay = self.policy.delay(attempt, failure)
+            self.stats.record_retry(status, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def TagManagerClient(**kwargs):
+    """
+    Return an AsyncClient of the Tag Manager API with the scopes and API version of settings.
+    """
+
+    return AsyncClient('tagmanager', settings.TAG_MANAGER_SCOPE, settings.TAG_MANAGER_API_VERSION, **kwargs)
+
+
+def AnalyticsClient(**kwargs):
+    """
+    Return an AsyncClient of the Analytics management API with the scopes of settings.
+    """
+
+    return AsyncClient('analytics', settings.ANALYTICS_SCOPE, 'v3', **kwargs)
+
+
+async def _ListItems(client, path, items_key, item_fields, params=None, first_page_only=False):
+    """
+    Return the items of a Tag Manager list call, following nextPageToken from
+    page to page in v2, see google_tag_manager_api._IterItems. v1 lists have
+    a single page. v2 names the items in the singular, items_key is the v1 name.
+    """
+
+    if client.v2:
+        items_key = items_key[:-1]
+    fields = '%s(%s)' % (items_key, item_fields)
+    if client.v2:
+        fields = 'nextPageToken,' + fields
+
+    items = []
+    page_token = None
+    while True:
+        try:
+            response = await client.request('GET', path, dict(params or {}, fields=fields, pageToken=page_token))
+        except HttpError as error:
+            raise Exception('There was an API error : %s' % _ErrorMessage(error))
+
+        items.extend(response.get(items_key, []))
+        page_token = response.get('nextPageToken')
+        if not page_token or (first_page_only and items):
+            return items
+
+
+def _ContainerPath(account_id, container_id):
+    return 'accounts/%s/containers/%s' % (account_id, container_id)
+
+
+async def GetWorkspacePath(client, account_id, container_id):
+    """
+    Return the path of the v2 workspace changes of a container are staged in,
+    created if the container has none, see google_tag_manager_api.GetWorkspacePath.
+    Looked up once per container and client, by one coroutine at a time.
+    """
+
+    key = (account_id, container_id)
+    lock = client._workspace_locks.setdefault(key, asyncio.Lock())
+
+    async with lock:
+        if key in client._workspaces:
+            return client._workspaces[key]
+
+        path = '%s/workspaces' % _ContainerPath(account_id, container_id)
+        workspace = ChooseWorkspace(await _ListItems(client, path, 'workspaces', 'workspaceId,name,path'))
+        if workspace is None:
+            try:
+                workspace = await client.request('POST', path, {'fields': 'workspaceId,name,path'},
+                                                 {'name': settings.TAG_MANAGER_WORKSPACE}, idempotent=False)
+            except HttpError as error:
+                raise Exception('There was an API error : %s' % _ErrorMessage(error))
+
+            # another process may have created one meanwhile, all of them settle on the oldest
+            workspaces = await _ListItems(client, path, 'workspaces', 'workspaceId,name,path')
+            workspace = ChooseWorkspace(workspaces) or workspace
+
+        client._workspaces[key] = workspace.get('path')
+        return workspace.get('path')
+
+
+async def _TagsPath(client, account_id, container_id):
+    if client.v2:
+        return '%s/tags' % await GetWorkspacePath(client, account_id, container_id)
+    return '%s/tags' % _ContainerPath(account_id, container_id)
+
+
+async def GetAccountID(client):
+    """
+    Return the ID of the first Tag Manager account.
+    """
+
+    # get first account, no need to fetch the others
+    for account in await _ListItems(client, 'accounts', 'accounts', 'accountId', first_page_only=True):
+        return account.get('accountId')
+    raise Exception('Currently you have not created any account on Google Tag Manager. Please create one.')
+
+
+async def GetContainersList(client, account_id, inventory=None):
+    """
+    Return a dict mapping container name to (container ID, public ID), see
+    google_tag_manager_api.GetContainersList.
+    """
+
+    if inventory is not None:
+        account_containers = inventory.get('containers', account_id)
+        if account_containers is not None:
+            return account_containers
+
+    account_containers = {
+        container.get('name'): (container.get('containerId'), container.get('publicId'))
+        for container in await _ListItems(client, 'accounts/%s/containers' % account_id, 'containers',
+                                          'name,containerId,publicId')
+    }
+
+    if inventory is not None:
+        inventory.set('containers', account_id, account_containers)
+    return account_containers
+
+
+async def CreateOrGetContainer(client, account_id, container_name, container_site, container_type=None,
+                               inventory=None):
+    """
+    Return the ID, or the public ID if container_type is 'public_id', of the
+    container named container_name, creating it if it does not exist.
+    """
+
+    account_containers = await GetContainersList(client, account_id, inventory)
+    if (container_name not in account_containers and inventory is not None and
+            inventory.seeded('containers', account_id)):
+        # a snapshot listing may predate the container, list them live before creating a duplicate
+        inventory.invalidate('containers', account_id)
+        account_containers = await GetContainersList(client, account_id, inventory)
+
+    if container_name in account_containers:
+        return account_containers[container_name][1 if container_type == 'public_id' else 0]
+
+    body = {
+        'name': container_name,
+        'usageContext': settings.GOOGLE_TAG_USAGE_CONTEXT,
+        'domainName': [container_site],
+        'notes': settings.MANAGED_CONTAINER_NOTES
+    }
+    if not client.v2:
+        # v2 containers have no time zone
+        body.update({'timeZoneCountryId': settings.TIME_ZONE_COUNTRY_ID, 'timeZoneId': settings.TIME_ZONE_ID})
+
+    try:
+        response = await client.request('POST', 'accounts/%s/containers' % account_id,
+                                        {'fields': 'containerId,publicId'}, body, idempotent=False)
+    except HttpError as error:
+        raise Exception('There was an error either in API call or your Account ID. Original Message: %s' %
+                        _ErrorMessage(error))
+
+    if inventory is not None:
+        inventory.add('containers', account_id, container_name, (response.get('containerId'), response.get('publicId')))
+        # a new container has no tags, no need to list them
+        inventory.set('tags', '%s/%s' % (account_id, response.get('containerId')), {})
+
+    if container_type == 'public_id':
+        return response.get('publicId')
+    return response.get('containerId')
+
+
+async def GetTagsList(client, account_id, container_id, inventory=None):
+    """
+    Return a dict mapping tag name to tag ID for a container.
+    """
+
+    inventory_key = '%s/%s' % (account_id, container_id)
+    if inventory is not None:
+        container_tags = inventory.get('tags', inventory_key)
+        if container_tags is not None:
+            return container_tags
+
+    container_tags = {
+        tag.get('name'): tag.get('tagId')
+        for tag in await _ListItems(client, await _TagsPath(client, account_id, container_id), 'tags', 'name,tagId')
+    }
+
+    if inventory is not None:
+        inventory.set('tags', inventory_key, container_tags)
+    return container_tags
+
+
+async def CreateOrGetTag(client, account_id, container_id, tracking_id, tag_name=HELLO_WORLD_TAG_NAME,
+                         inventory=None):
+    """
+    Create the Universal Analytics Hello World Tag or return it if it exists, as a Tag resource dict.
+    """
+
+    container_tags = await GetTagsList(client, account_id, container_id, inventory)
+    inventory_key = '%s/%s' % (account_id, container_id)
+    if tag_name not in container_tags and inventory is not None and inventory.seeded('tags', inventory_key):
+        # a snapshot listing may predate the tag, list them live before creating a duplicate
+        inventory.invalidate('tags', inventory_key)
+        container_tags = await GetTagsList(client, account_id, container_id, inventory)
+    path = await _TagsPath(client, account_id, container_id)
+
+    try:
+        if tag_name in container_tags:
+            return await client.request('GET', '%s/%s' % (path, container_tags[tag_name]))
+
+        response = await client.request('POST', path, body=HelloWorldTag(tracking_id, tag_name), idempotent=False)
+    except HttpError as error:
+        raise Exception('There was an error either in API call or Google Tracking ID. Original Message: %s' %
+                        _ErrorMessage(error))
+
+    if inventory is not None:
+        inventory.add('tags', '%s/%s' % (account_id, container_id), tag_name, response.get('tagId'))
+    return response
+
+
+async def FindLiveTagVersion(client, account_id, container_id, tag):
+    """
+    Return the ID of the published container version if it has tag unchanged,
+    None otherwise, see google_tag_manager_api.FindLiveTagVersion.
+    """
+
+    path = _ContainerPath(account_id, container_id) + ('/versions:live' if client.v2 else '/versions/published')
+    try:
+        live_version = await client.request('GET', path, {'fields': 'containerVersionId,tag'})
+    except HttpError as error:
+        if error.resp.status == 404:
+            return None
+        raise Exception('There was an API error : %s' % _ErrorMessage(error))
+
+    fingerprint = TagFingerprint(tag)
+    for live_tag in live_version.get('tag', []):
+        if live_tag.get('name') == tag.get('name') and TagFingerprint(live_tag) == fingerprint:
+            return live_version.get('containerVersionId')
+    return None
+
+
+async def CreateContainerVersion(client, account_id, container_id):
+    """
+    Create a new container version and return its ID.
+    In v2 the version is created from the container workspace.
+    """
+
+    try:
+        if client.v2:
+            response = await client.request(
+                'POST', '%s:create_version' % await GetWorkspacePath(client, account_id, container_id),
+                {'fields': 'containerVersion/containerVersionId,compilerError,newWorkspacePath'}, {},
+                idempotent=False)
+
+            # the workspace is consumed, the API names the one to stage the next changes in
+            client._workspaces[(account_id, container_id)] = response.get('newWorkspacePath')
+            if response.get('compilerError'):
+                raise Exception('The workspace of container %s does not compile, no version was created' %
+                                container_id)
+        else:
+            response = await client.request(
+                'POST', '%s/versions' % _ContainerPath(account_id, container_id),
+                {'fields': 'containerVersion/containerVersionId'}, {'quickPreview': False}, idempotent=False)
+    except HttpError as error:
+        raise Exception('There was an API error or Something went wrong with your Accout. Original Message : %s' %
+                        _ErrorMessage(error))
+
+    return response.get('containerVersion', {}).get('containerVersionId')
+
+
+async def PublishContainerVersion(client, account_id, container_id, container_version_id):
+    """
+    Publish a container version.
+    """
+
+    path = '%s/versions/%s%s' % (_ContainerPath(account_id, container_id), container_version_id,
+                                 ':publish' if client.v2 else '/publish')
+    try:
+        await client.request('POST', path, {'fields': 'compilerError' if client.v2 else ''})
+    except HttpError as error:
+        raise Exception('There was an API error : %s' % _ErrorMessage(error))
+
+
+async def _ListWebProperties(client, account_id):
+    """
+    Return the web properties of an Analytics account with their id, name and websiteUrl, page by page.
+    """
+
+    properties = []
+    start_index = 1
+    while True:
+        response = await client.request('GET', 'accounts/%s/webproperties' % account_id, {
+            'fields': 'nextLink,items(id,name,websiteUrl)', 'max-results': 1000, 'start-index': start_index})
+        items = response.get('items', [])
+        properties.extend(items)
+        if not response.get('nextLink') or not items:
+            return properties
+        start_index += len(items)
+
+
+async def GetOrCreateTrackingId(client, site_name, site_url, property_index=None):
+    """
+    Return the tracking ID of the web property named site_name in the first
+    Google Analytics account, creating the property if it does not exist.
+    Lookups go through property_index when given (see
+    google_analytics_api.GetWebPropertyIndex), otherwise the properties are
+    listed page by page until the name is found.
+    """
+
+    try:
+        if property_index is not None:
+            account = property_index.account_id
+            tracking_id = property_index.find(name=site_name)
+            if tracking_id is None and property_index.seeded:
+                # a snapshot listing may predate the property, list them live before creating a duplicate
+                property_index.reload(await _ListWebProperties(client, account))
+                tracking_id = property_index.find(name=site_name)
+            if tracking_id is not None:
+                return tracking_id
+        else:
+            accounts = await client.request('GET', 'accounts', {'fields': 'items(id)', 'max-results': 1})
+            if not accounts.get('items'):
+                raise Exception('Currently you have not created any account on Google Analytics. Please create one.')
+            account = accounts['items'][0]['id']
+
+            start_index = 1
+            while True:
+                response = await client.request('GET', 'accounts/%s/webproperties' % account, {
+                    'fields': 'nextLink,items(id,name)', 'max-results': 1000, 'start-index': start_index})
+                items = response.get('items', [])
+                for property in items:
+                    if site_name == property.get('name'):
+                        return property.get('id')
+                if not response.get('nextLink') or not items:
+                    break
+                start_index += len(items)
+
+        web_property = await client.request('POST', 'accounts/%s/webproperties' % account, {'fields': 'id'}, {
+            'websiteUrl': site_url,
+            'name': site_name
+        }, idempotent=False)
+
+    except HttpError as error:
+        raise Exception('There was an in API call or your Account ID. Original Message: %s :' % _ErrorMessage(error))
+
+    if property_index is not None:
+        property_index.add({'id': web_property.get('id'), 'name': site_name, 'websiteUrl': site_url})
+    return web_property.get('id')
+
+
+async def ProvisionSite(analytics_client, tag_manager_client, site_name, site_url, account_id=None, inventory=None,
+                        property_index=None):
+    """
+    Run the whole provisioning chain for a single site, see provisioning.ProvisionSite.
+    Run many of them with asyncio.gather, the clients bound the connections they use.
+    """
+
+    tracking_id = await GetOrCreateTrackingId(analytics_client, site_name, site_url, property_index)
+    account_id = account_id or await GetAccountID(tag_manager_client)
+    container_id = await CreateOrGetContainer(tag_manager_client, account_id, site_name, site_url,
+                                              inventory=inventory)
+    tag = await CreateOrGetTag(tag_manager_client, account_id, container_id, tracking_id, inventory=inventory)
+
+    # only create and publish a version when the published one lacks the tag
+    container_version_id = await FindLiveTagVersion(tag_manager_client, account_id, container_id, tag)
+    changed = container_version_id is None
+    if changed:
+        container_version_id = await CreateContainerVersion(tag_manager_client, account_id, container_id)
+        await PublishContainerVersion(tag_manager_client, account_id, container_id, container_version_id)
+    public_id = await CreateOrGetContainer(tag_manager_client, account_id, site_name, site_url, 'public_id',
+                                           inventory=inventory)
+
+    return {
+        'site_name': site_name,
+        'site_url': site_url,
+        'tracking_id': tracking_id,
+        'account_id': account_id,
+        'container_id': container_id,
+        'public_id': public_id,
+        'version_id': container_version_id,
+        'changed': changed,
+        'status': 'ok',
+    }
@@ -0,0 +1,206 @@
+"""
+Service account credentials and a token cache shared by every process of a host, refreshed ahead of expiry.
+"""
+import copy
+import datetime
+import io
+import os
+import threading
+
+import simplejson as json
+import settings
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory file locks (e.g. Windows), the cache is then only safe within a process
+    fcntl = None
+
+from oauth2client import client
+
+# token_expiry is written in the format oauth2client serializes it with
+EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_file_locks_lock = threading.Lock()
+_file_locks = {}
+
+
+def _ThreadLock(path):
+    """
+    Return the in-process lock of a cache file, flock alone does not exclude threads sharing a process.
+    """
+
+    with _file_locks_lock:
+        return _file_locks.setdefault(os.path.abspath(path), threading.RLock())
+
+
+class SharedTokenStorage(client.Storage):
+    """
+    oauth2client Storage keeping the access tokens of many credentials in one
+    JSON file, locked across processes while a token is read, refreshed and
+    written back. When several worker processes find their token about to
+    expire, the first one refreshes it and the others pick the new token up
+    from the file instead of refreshing it again.
+
+    Only access tokens and their expiry are written, never refresh tokens or
+    private keys, and the file is only readable by its owner.
+
+    Args:
+    path: the JSON cache file, created if missing.
+    key: the entry of these credentials in the file, e.g. 'tagmanager'.
+    credentials: the credentials whose tokens are cached.
+    storage: optional Storage the credentials were loaded from (the installed
+      mode api_name.dat file). Credentials found revoked are written to it, so
+      the next run goes through the auth flow instead of failing on them.
+    """
+
+    def __init__(self, path, key, credentials, storage=None):
+        super(SharedTokenStorage, self).__init__(lock=_ThreadLock(path))
+        self.path = path
+        self.key = key
+        self.storage = storage
+        self._credentials = credentials
+        self._lock_file = None
+
+    def acquire_lock(self):
+        self._lock.acquire()
+        if fcntl is not None:
+            self._lock_file = io.open(self.path + '.lock', 'a')
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+
+    def release_lock(self):
+        if self._lock_file is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+            self._lock_file.close()
+            self._lock_file = None
+        self._lock.release()
+
+    def _Read(self):
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as cache:
+                return json.load(cache)
+        except (IOError, OSError, ValueError):
+            # missing, or torn by a crash while writing: tokens are simply refreshed
+            return {}
+
+    def locked_get(self):
+        """
+        Return a copy of the credentials with the cached token, None if there is none.
+        """
+
+        entry = self._Read().get(self.key)
+        if not entry:
+            return None
+
+        credentials = copy.copy(self._credentials)
+        credentials.access_token = entry['access_token']
+        credentials.token_expiry = (datetime.datetime.strptime(entry['token_expiry'], EXPIRY_FORMAT)
+                                    if entry.get('token_expiry') else None)
+        credentials.invalid = False
+        return credentials
+
+    def _Write(self, tokens):
+        # write then rename so a process not holding the lock never reads half a file
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        descriptor = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with io.open(descriptor, 'w', encoding='utf-8') as cache:
+            cache.write(json.dumps(tokens))
+        os.rename(tmp_path, self.path)
+
+    def locked_put(self, credentials):
+        if credentials.invalid:
+            # revoked refresh token: no token to share, and the credentials must not be loaded again
+            if self.storage is not None:
+                self.storage.put(credentials)
+            self.locked_delete()
+            return
+
+        tokens = self._Read()
+        tokens[self.key] = {
+            'access_token': credentials.access_token,
+            'token_expiry': credentials.token_expiry.strftime(EXPIRY_FORMAT) if credentials.token_expiry else None,
+        }
+        self._Write(tokens)
+
+    def locked_delete(self):
+        tokens = self._Read()
+        if tokens.pop(self.key, None) is not None:
+            self._Write(tokens)
+
+
+def GetServiceAccountCredentials(scope, key_path=None, delegated_user=None):
+    """
+    Load service account credentials from a JSON key file.
+
+    Args:
+    scope: list of auth scopes.
+    key_path: the JSON key of the service account. Defaults to settings.SERVICE_ACCOUNT_KEY.
+    delegated_user: email of the user to act as with domain-wide delegation.
+      Defaults to settings.DELEGATED_USER, the service account itself if None.
+    """
+
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(key_path or settings.SERVICE_ACCOUNT_KEY, scope)
+    delegated_user = delegated_user if delegated_user is not None else settings.DELEGATED_USER
+    if delegated_user:
+        credentials = credentials.create_delegated(delegated_user)
+    return credentials
+
+
+def ShareTokens(credentials, key, path=None, storage=None):
+    """
+    Keep the tokens of credentials in the shared cache file, settings.TOKEN_CACHE_PATH
+    by default. storage is the Storage they were loaded from, see SharedTokenStorage.
+    """
+
+    path = path or settings.TOKEN_CACHE_PATH
+    if path:
+        credentials.set_store(SharedTokenStorage(path, key, credentials, storage))
+    return credentials
+
+
+def ExpiresSoon(credentials, margin=None):
+    """
+    Whether the token of credentials is missing or expires within margin
+    seconds (settings.TOKEN_REFRESH_MARGIN by default), so it is refreshed
+    before a request fails on it.
+    """
+
+    if credentials.invalid or not credentials.access_token:
+        return True
+    if not credentials.token_expiry:
+        return False
+
+    margin = settings.TOKEN_REFRESH_MARGIN if margin is None else margin
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=margin) >= credentials.token_expiry
+
+
+def AuthorizeHttp(credentials, http):
+    """
+    Authorize http with credentials, refreshing the token ahead of its expiry.
+
+    oauth2client only refreshes a token once a request is refused with it,
+    every process then pays a failed request and a refresh on the hot path.
+    Here the token is refreshed (or picked up from the shared cache) before
+    the first request that would be sent within TOKEN_REFRESH_MARGIN seconds of expiry.
+    """
+
+    # the refresh request itself goes out unauthorized
+    refresh_request = http.request
+    authorized_http = credentials.authorize(http)
+    authorized_request = authorized_http.request
+    refresh_lock = threading.Lock()
+
+    def request(*args, **kwargs):
+        if ExpiresSoon(credentials):
+            with refresh_lock:
+                # another thread of this process may have refreshed it meanwhile
+                if ExpiresSoon(credentials):
+                    credentials.refresh(refresh_request)
+        return authorized_request(*args, **kwargs)
+
+    # googleapiclient finds the credentials of batch requests there
+    request.credentials = credentials
+    authorized_http.request = request
+    return authorized_http
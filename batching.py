@@ -0,0 +1,148 @@
+"""
+Group independent Google API calls into batch HTTP requests.
+"""
+import time
+
+from googleapiclient.http import HttpError
+import simplejson as json
+from metrics import METRICS
+from retry import Execute, DEFAULT_POLICY, STATS, TRANSPORT_ERRORS
+import settings
+
+
+def _ErrorMessage(error):
+    """
+    Turn the HttpError of a batched call into a readable message.
+    """
+
+    try:
+        return json.loads(error.content)['error']['message']
+    except (ValueError, KeyError, TypeError):
+        return '%s : %s' % (error.resp.status, error.resp.reason)
+
+
+class BatchExecutor(object):
+    """
+    Collect independent requests of one service and send them as batch HTTP
+    requests of at most batch_size calls each, so N calls cost N / batch_size
+    round-trips instead of N.
+
+    Every call is added with a key (e.g. a site name) used to map its result
+    back. A failing call does not fail the others: its error is reported
+    for its key only.
+
+    Args:
+    service: the service object the requests were built from.
+    batch_size: calls per batch request. Defaults to settings.BATCH_SIZE.
+    limiter: optional TokenBucket. Quotas count every call of a batch, so a
+      token is taken per call besides the one a RateLimitedHttp takes for the
+      batch request itself.
+    idempotent: False when the calls create resources, a failed batch request
+      or call is then only retried when refused for quota.
+    policy: RetryPolicy of the batch requests and of their calls, retry.DEFAULT_POLICY if not given.
+    """
+
+    def __init__(self, service, batch_size=None, limiter=None, idempotent=True, policy=None):
+        self.service = service
+        self.batch_size = batch_size or settings.BATCH_SIZE
+        self.limiter = limiter
+        self.idempotent = idempotent
+        self.policy = policy or DEFAULT_POLICY
+        self._calls = []
+        self._keys = set()
+
+    def add(self, key, request, callback=None):
+        """
+        Queue a request built with the service, e.g. service.accounts().get(...).
+
+        Args:
+        key: hashable used to map the result back, unique among the queued calls.
+        request: the HttpRequest, not executed.
+        callback: optional callable(key, response, error) called once the
+          call is done. error is None on success, response None on error.
+        """
+
+        if key in self._keys:
+            raise Exception('A call is already queued for key %r' % (key,))
+        self._keys.add(key)
+        self._calls.append((key, request, callback))
+
+    def __len__(self):
+        return len(self._calls)
+
+    def execute(self):
+        """
+        Send all queued calls and return a dict mapping each key to a
+        (response, error) tuple. error is an Exception with the API message,
+        or None. The queue is emptied.
+
+        Calls of a batch failing on their own with a transient error (429,
+        5xx, quota 403, see RetryPolicy.is_retryable) are sent again in the
+        next batch after a backoff, like Execute retries single calls.
+        """
+
+        calls, self._calls, self._keys = self._calls, [], set()
+        results = {}
+        attempt = 1
+
+        while calls:
+            retries = []
+            for start in range(0, len(calls), self.batch_size):
+                retries.extend(self._ExecuteChunk(calls[start:start + self.batch_size], results,
+                                                  attempt < self.policy.max_attempts))
+
+            calls = [call for call, _ in retries]
+            if calls:
+                # the calls to retry wait together, the longest backoff of their errors
+                delay = max(self.policy.delay(attempt, error) for _, error in retries)
+                for index, (call, error) in enumerate(retries):
+                    call_delay = delay if index == 0 else 0
+                    STATS.record_retry(error.resp.status, call_delay)
+                    METRICS.record_retry(getattr(call[1], 'methodId', None) or 'batch', error.resp.status, call_delay)
+                time.sleep(delay)
+                attempt += 1
+
+        return results
+
+    def _ExecuteChunk(self, chunk, results, retry):
+        """
+        Send one batch request of chunk calls, store their results and return
+        the (call, error) tuples of the calls to retry when retry is True.
+        """
+
+        retries = []
+
+        def done(request_id, response, error, final=False):
+            call = chunk[int(request_id)]
+            key, _, callback = call
+            if error is not None:
+                if not final and retry and self.policy.is_retryable(error, self.idempotent):
+                    retries.append((call, error))
+                    return
+                if isinstance(error, HttpError):
+                    error = Exception('There was an API error : %s' % _ErrorMessage(error))
+                elif not isinstance(error, Exception) or isinstance(error, TRANSPORT_ERRORS):
+                    error = Exception('There was a connection error : %s' % error)
+                response = None
+            results[key] = (response, error)
+            if callback is not None:
+                callback(key, response, error)
+
+        batch = self.service.new_batch_http_request(callback=done)
+        for request_id, (key, request, _) in enumerate(chunk):
+            batch.add(request, request_id=str(request_id))
+
+        if self.limiter is not None:
+            for _ in range(len(chunk) - 1):
+                self.limiter.acquire()
+
+        try:
+            Execute(batch, self.idempotent, self.policy)
+        except (HttpError,) + TRANSPORT_ERRORS as error:
+            # the batch request itself failed and was retried already, report it for every call
+            reported = set(call[0] for call, _ in retries)
+            for request_id in range(len(chunk)):
+                if chunk[request_id][0] not in results and chunk[request_id][0] not in reported:
+                    done(str(request_id), None, error, final=True)
+
+        return retries
@@ -0,0 +1,231 @@
+"""
+Load test the provisioning paths against the local fake APIs of fake_api.py, and check the CLI startup time.
+"""
+from __future__ import print_function, division, unicode_literals
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import simplejson as json
+from fake_api import FakeGoogleApis
+from google_tag_manager_api import ClearWorkspaces
+from metrics import METRICS
+import provisioning
+import retry
+import services
+import settings
+
+# modules index.py may only import once a command needs them
+HEAVY_MODULES = ('googleapiclient', 'oauth2client', 'httplib2', 'smtplib', 'email.mime', 'validators', 'simplejson')
+
+
+def _Sites(count):
+    return [{'name': 'Site %s' % index, 'url': 'https://site-%s.example.com' % index, 'options': {}}
+            for index in range(count)]
+
+
+def _Services():
+    analytics_service = services.GetService('analytics', 'v3', settings.ANALYTICS_SCOPE,
+                                            settings.GOOGLE_DEVELOPER_SECRET_KEY)
+    tag_manager_service = services.GetService('tagmanager', settings.TAG_MANAGER_API_VERSION,
+                                              settings.TAG_MANAGER_SCOPE, settings.GOOGLE_DEVELOPER_SECRET_KEY)
+    return analytics_service, tag_manager_service
+
+
+def RunPath(path, sites, workers):
+    """
+    Provision the sites with one of the provisioning paths and return the results.
+
+    single: ProvisionSite per site without any shared cache, like index.py --site_name.
+    batch: ProvisionSites, or ProvisionSitesConcurrently with workers > 1, like index.py --manifest.
+    """
+
+    if path == 'single':
+        analytics_service, tag_manager_service = _Services()
+        results = []
+        for site in sites:
+            try:
+                results.append(provisioning.ProvisionSite(analytics_service, tag_manager_service, site['name'],
+                                                          site['url']))
+            except Exception as error:
+                results.append({'site_name': site['name'], 'status': 'error', 'error': str(error)})
+        return results
+
+    if workers > 1:
+        return list(provisioning.ProvisionSitesConcurrently(sites, workers))
+
+    analytics_service, tag_manager_service = _Services()
+    return list(provisioning.ProvisionSites(analytics_service, tag_manager_service, sites))
+
+
+def _SitesPerAccount(results):
+    counts = {}
+    for result in results:
+        if result.get('account_id'):
+            counts[result['account_id']] = counts.get(result['account_id'], 0) + 1
+    return counts
+
+
+def Benchmark(path='batch', sites=100, workers=1, runs=1, latency=0.0, jitter=0.0, error_rate=0.0,
+              throttle_rate=0.0, server_qps=None, seed=None, accounts=1):
+    """
+    Provision sites against a fresh fake server, runs times over the same
+    state (the runs after the first one find everything in place).
+
+    Returns:
+    One report dict per run: sites per second, API calls per site, seconds
+    per step at p50 and p99, retries and errors.
+    """
+
+    reports = []
+    with FakeGoogleApis(latency, jitter, error_rate, throttle_rate, server_qps, seed, accounts) as fake:
+        settings.API_ROOT_URL = fake.root_url
+        # services built before point at another server
+        services.ClearServices()
+        ClearWorkspaces()
+
+        for run in range(runs):
+            site_list = _Sites(sites)
+            METRICS.reset()
+            retry.STATS.reset()
+            calls_before = fake.calls
+
+            start = time.time()
+            results = RunPath(path, site_list, workers)
+            elapsed = time.time() - start
+
+            stats = retry.STATS.as_dict()
+            failed = [result for result in results if result['status'] != 'ok']
+            reports.append({
+                'path': path,
+                'run': run + 1,
+                'sites': sites,
+                'workers': workers,
+                'seconds': round(elapsed, 3),
+                'sites_per_second': round(sites / elapsed, 2) if elapsed else None,
+                'api_calls_per_site': round((fake.calls - calls_before) / sites, 2),
+                'retries': stats['retries'],
+                'retries_by_status': stats['retries_by_status'],
+                'failed': len(failed),
+                'sites_per_account': _SitesPerAccount(results),
+                'errors': sorted(set(result.get('error') for result in failed))[:5],
+                'steps': dict((step, {
+                    'calls': quantiles['calls'],
+                    'p50': round(quantiles['p50'], 4),
+                    'p99': round(quantiles['p99'], 4),
+                }) for step, quantiles in METRICS.step_quantiles().items()),
+            })
+    return reports
+
+
+def _Seconds(command, runs):
+    """
+    Return the median wall clock seconds of running command, runs times.
+    """
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    seconds = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(command, cwd=root, stdout=devnull, stderr=devnull)
+            seconds.append(time.time() - start)
+    return sorted(seconds)[len(seconds) // 2]
+
+
+def StartupTime(args=('--help',), runs=5):
+    """
+    Measure how long `python index.py <args>` takes beyond starting a bare
+    interpreter, and which HEAVY_MODULES importing index loads.
+
+    Returns:
+    A report dict with the median seconds and the list of heavy modules.
+    """
+
+    command = [sys.executable, 'index.py'] + list(args)
+    baseline = _Seconds([sys.executable, '-c', 'pass'], runs)
+    seconds = _Seconds(command, runs)
+
+    probe = ('import sys, index\n'
+             'print("\\n".join(sorted(sys.modules)))')
+    loaded = subprocess.check_output([sys.executable, '-c', probe],
+                                     cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').split()
+    heavy = [module for module in HEAVY_MODULES
+             if any(name == module or name.startswith(module + '.') for name in loaded)]
+
+    return {
+        'command': ' '.join(['index.py'] + list(args)),
+        'seconds': round(max(seconds - baseline, 0), 4),
+        'interpreter_seconds': round(baseline, 4),
+        'heavy_modules': heavy,
+    }
+
+
+def PrintReport(report, output=sys.stdout):
+    print('%(path)s run %(run)s: %(sites)s sites, %(workers)s workers, %(seconds)ss, %(sites_per_second)s sites/s, '
+          '%(api_calls_per_site)s API calls/site, %(retries)s retries, %(failed)s failed' % report, file=output)
+    for name, step in sorted(report['steps'].items()):
+        print('  %-40s %6s calls  p50 %8.4fs  p99 %8.4fs' % (name, step['calls'], step['p50'], step['p99']),
+              file=output)
+    if len(report['sites_per_account']) > 1:
+        print('  sites per Tag Manager account: %s' % ', '.join(
+            '%s: %s' % item for item in sorted(report['sites_per_account'].items())), file=output)
+    for error in report['errors']:
+        print('  error: %s' % error, file=output)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Load test provisioning against a local fake of the Google APIs')
+    parser.add_argument('--path', choices=('single', 'batch'), default='batch', help='Provisioning path to measure')
+    parser.add_argument('--sites', type=int, default=100, help='Sites provisioned per run')
+    parser.add_argument('--workers', type=int, default=1, help='Worker threads of the batch path')
+    parser.add_argument('--runs', type=int, default=1, help='Runs over the same fake state')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds every fake API call takes')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to that many seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of calls failing with 503')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of calls refused with 429')
+    parser.add_argument('--server-qps', type=float, help='Calls per second the fake accepts before answering 429')
+    parser.add_argument('--client-qps', type=float, default=1000,
+                        help='Queries per second the batch workers are limited to, per API')
+    parser.add_argument('--retry-delay', type=float, default=0.05, help='Seconds before the first retry')
+    parser.add_argument('--seed', type=int, help='Seed of the error and throttle injection')
+    parser.add_argument('--accounts', type=int, default=1, help='Tag Manager and Analytics accounts of the fake')
+    parser.add_argument('--routing', choices=('first', 'hash', 'least_loaded'), default=settings.ACCOUNT_ROUTING,
+                        help='How the batch path spreads sites over the accounts')
+    parser.add_argument('--json', action='store_true', help='Print the reports as JSON lines')
+    parser.add_argument('--startup', action='store_true',
+                        help='Instead of load testing, check the startup time of index.py --help')
+    parser.add_argument('--startup-budget', type=float, default=0.1,
+                        help='Seconds index.py --help may take beyond a bare interpreter start')
+    args = parser.parse_args(argv[1:])
+
+    if args.startup:
+        report = StartupTime(runs=max(args.runs, 5))
+        report['budget'] = args.startup_budget
+        report['passed'] = report['seconds'] <= args.startup_budget and not report['heavy_modules']
+        if args.json:
+            print(json.dumps(report))
+        else:
+            print('%(command)s: %(seconds)ss beyond the interpreter start (budget %(budget)ss)' % report)
+            for module in report['heavy_modules']:
+                print('  imported eagerly: %s' % module)
+        return 0 if report['passed'] else 1
+
+    settings.ANALYTICS_QUERIES_PER_SECOND = settings.TAG_MANAGER_QUERIES_PER_SECOND = args.client_qps
+    retry.DEFAULT_POLICY.base_delay = args.retry_delay
+    settings.ACCOUNT_ROUTING = args.routing
+
+    reports = Benchmark(args.path, args.sites, args.workers, args.runs, args.latency, args.jitter, args.error_rate,
+                        args.throttle_rate, args.server_qps, args.seed, args.accounts)
+    for report in reports:
+        if args.json:
+            print(json.dumps(report))
+        else:
+            PrintReport(report)
+    return 1 if any(report['failed'] for report in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
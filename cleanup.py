@@ -0,0 +1,311 @@
+"""
+Find stale containers, tags and container versions by rule and delete them in throttled batches.
+"""
+from __future__ import print_function, unicode_literals
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google_tag_manager_api import (IterAccounts, IterContainers, IterTags, IterVersionHeaders, IterWorkspaces,
+                                    GetLiveVersion, GetContainerVersion, DeleteTags, DeleteContainerVersions,
+                                    DeleteContainers, CreateContainerVersion, PublishContainerVersion, GetService,
+                                    IsV2, ContainerCollection, CONTAINER_KINDS)
+from google_analytics_api import (IterAccounts as IterAnalyticsAccounts, IterWebProperties,
+                                  GetService as GetAnalyticsService)
+from rate_limit import TokenBucket, RateLimitedHttp
+import settings
+
+# deletions run in this order, the tags and versions of a deleted container go with it
+KINDS = ('tag', 'version', 'container')
+
+
+def _Time(fingerprint):
+    """
+    Tag Manager fingerprints are the time of the last change in milliseconds,
+    return it in seconds since the epoch, None if fingerprint is not one.
+    """
+
+    try:
+        return int(fingerprint) / 1000.0
+    except (TypeError, ValueError):
+        return None
+
+
+def _AgeDays(fingerprints, now):
+    """
+    Days since the latest of fingerprints, None if any of them is not a time.
+    """
+
+    times = [_Time(fingerprint) for fingerprint in fingerprints]
+    if not times or None in times:
+        return None
+    return round((now - max(times)) / 86400, 1)
+
+
+def _Old(age_days, max_age_days):
+    # a resource of unknown age is never old enough
+    return not max_age_days or (age_days is not None and age_days >= max_age_days)
+
+
+def _ActivityFingerprints(service, account_id, container, version_ids, live_version_id):
+    """
+    Return the fingerprints of everything whose change means a container is in
+    use: the container resource, its v2 workspaces (the v1 tags, triggers and
+    variables, which have no workspace) and its newest and published versions.
+    None of them alone tells, e.g. editing a workspace leaves the container fingerprint unchanged.
+    """
+
+    container_id = container.get('containerId')
+    fingerprints = [container.get('fingerprint')]
+    if IsV2(service):
+        fingerprints.extend(workspace.get('fingerprint')
+                            for workspace in IterWorkspaces(service, account_id, container_id, 'fingerprint'))
+    else:
+        for kind in CONTAINER_KINDS:
+            fingerprints.extend(item.get('fingerprint') for item in
+                                ContainerCollection(service, account_id, container_id, kind).iter('fingerprint'))
+
+    for version_id in set(version_ids[:1] + [live_version_id]) - {None}:
+        version = GetContainerVersion(service, account_id, container_id, version_id)
+        if version is not None:
+            fingerprints.append(version.get('fingerprint'))
+    return fingerprints
+
+
+def FindStaleContainers(service, account_id, keep=None, max_age_days=None, keep_versions=None, now=None,
+                        delete_containers=False):
+    """
+    Find the stale resources of a Tag Manager account:
+
+    container: only with delete_containers and keep. Created by this tool
+      (its notes are settings.MANAGED_CONTAINER_NOTES), absent from keep, and
+      neither the container, its workspaces or resources, nor its newest or
+      published version changed for max_age_days.
+    tag: paused and unchanged for max_age_days, in a container that is kept.
+    version: neither published nor one of the keep_versions newest, in a container that is kept.
+
+    Args:
+    service: the Tag Manager service object.
+    account_id: the ID of the account.
+    keep: names of the containers to keep, e.g. the sites of a manifest. None keeps every container.
+    max_age_days: days a container or tag must be unchanged for to be stale, 0 for any age.
+      Defaults to settings.GC_MAX_AGE_DAYS.
+    keep_versions: versions kept besides the published one. Defaults to settings.GC_KEEP_VERSIONS.
+    now: time to compute ages from, in seconds since the epoch.
+    delete_containers: whether containers of this account may be stale at all.
+
+    Returns:
+    A list of dicts with kind, account_id, container_id, name, id, age_days and reason keys.
+    """
+
+    max_age_days = settings.GC_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    keep_versions = settings.GC_KEEP_VERSIONS if keep_versions is None else keep_versions
+    now = time.time() if now is None else now
+
+    stale = []
+    for container in IterContainers(service, account_id, fields='name,containerId,fingerprint,notes'):
+        container_id = container.get('containerId')
+        record = {'account_id': account_id, 'container_id': container_id, 'container': container.get('name')}
+
+        version_ids = sorted((header.get('containerVersionId')
+                              for header in IterVersionHeaders(service, account_id, container_id, 'containerVersionId')
+                              # v1 lists a header for the draft, which has version ID 0
+                              if header.get('containerVersionId') not in (None, '0')), key=int, reverse=True)
+        candidate = (delete_containers and keep is not None and container.get('name') not in keep and
+                     container.get('notes') == settings.MANAGED_CONTAINER_NOTES)
+
+        live_version_id = None
+        if candidate or len(version_ids) > keep_versions:
+            live_version = GetLiveVersion(service, account_id, container_id, fields='containerVersionId')
+            live_version_id = live_version.get('containerVersionId') if live_version else None
+
+        if candidate:
+            age_days = _AgeDays(_ActivityFingerprints(service, account_id, container, version_ids, live_version_id),
+                                now)
+            if _Old(age_days, max_age_days):
+                stale.append(dict(record, kind='container', name=container.get('name'), id=container_id,
+                                  age_days=age_days, reason='not in manifest'))
+                continue
+
+        for tag in IterTags(service, account_id, container_id, fields='name,tagId,paused,fingerprint'):
+            tag_age_days = _AgeDays([tag.get('fingerprint')], now)
+            if tag.get('paused') and _Old(tag_age_days, max_age_days):
+                stale.append(dict(record, kind='tag', name=tag.get('name'), id=tag.get('tagId'),
+                                  age_days=tag_age_days, reason='paused'))
+
+        for version_id in version_ids[keep_versions:]:
+            if version_id != live_version_id:
+                stale.append(dict(record, kind='version', name=version_id, id=version_id, age_days=None,
+                                  reason='older than the %s newest versions' % keep_versions))
+    return stale
+
+
+def CollectGarbage(keep=None, apply=False, workers=None, max_age_days=None, keep_versions=None, inventory=None,
+                   container_accounts=None, report=None):
+    """
+    Find the stale resources of every Tag Manager account (settings.TAG_MANAGER_ACCOUNTS
+    or all of them) and delete them when apply is True, see FindStaleContainers.
+
+    Containers are only ever stale in the accounts of container_accounts,
+    which must be listed explicitly, and only when this tool created them.
+
+    Accounts are scanned concurrently by a pool of worker threads sharing
+    one token bucket per API. Deletions are sent in batch requests of
+    BATCH_SIZE calls, every call taking a token of the Tag Manager bucket.
+    A container version is then created and published for every container
+    that lost tags, the published version would still serve them otherwise.
+
+    Analytics web properties absent from keep are reported only: the
+    Analytics Management API cannot delete web properties.
+
+    Args:
+    keep: names of the sites to keep, e.g. those of a manifest. None keeps every container and web property.
+    apply: delete the stale resources. False only reports them (dry run).
+    workers: number of worker threads. Defaults to settings.PROVISIONING_WORKERS.
+    max_age_days, keep_versions: see FindStaleContainers.
+    inventory: optional Inventory, the listings of changed accounts and containers are dropped from it.
+    container_accounts: IDs of the Tag Manager accounts whose containers may be deleted.
+      Defaults to settings.GC_CONTAINER_ACCOUNTS.
+    report: optional callable(record) called with every record once its status
+      is final, one call at a time. A deletion is reported as soon as it is done,
+      a tag one once its container version is published, so an interrupted run
+      still tells what it deleted.
+
+    Returns:
+    One dict per stale resource, see FindStaleContainers, with a status:
+    'stale' in a dry run, 'deleted' or 'error' once applied, 'report_only' for web properties.
+    """
+
+    keep = set(keep) if keep is not None else None
+    container_accounts = set(settings.GC_CONTAINER_ACCOUNTS if container_accounts is None else container_accounts)
+    analytics_limiter = TokenBucket(settings.ANALYTICS_QUERIES_PER_SECOND)
+    tag_manager_limiter = TokenBucket(settings.TAG_MANAGER_QUERIES_PER_SECOND)
+    local = threading.local()
+    report_lock = threading.Lock()
+
+    def services():
+        if not hasattr(local, 'analytics_service'):
+            local.analytics_service = GetAnalyticsService(
+                'analytics', 'v3', settings.ANALYTICS_SCOPE, settings.GOOGLE_DEVELOPER_SECRET_KEY,
+                http=RateLimitedHttp(analytics_limiter))
+            local.tag_manager_service = GetService(
+                'tagmanager', settings.TAG_MANAGER_API_VERSION, settings.TAG_MANAGER_SCOPE,
+                settings.GOOGLE_DEVELOPER_SECRET_KEY, http=RateLimitedHttp(tag_manager_limiter))
+        return local.analytics_service, local.tag_manager_service
+
+    def emit(record):
+        with report_lock:
+            if report is not None:
+                report(record)
+
+    # Authorize once in the calling thread so an interactive auth flow never runs inside the pool.
+    analytics_service, tag_manager_service = services()
+    account_ids = settings.TAG_MANAGER_ACCOUNTS or [
+        account.get('accountId') for account in IterAccounts(tag_manager_service)]
+    account_ids = list(account_ids) + sorted(container_accounts - set(account_ids))
+
+    def find(account_id):
+        return FindStaleContainers(services()[1], account_id, keep, max_age_days, keep_versions,
+                                   delete_containers=account_id in container_accounts)
+
+    def delete(records):
+        # deleted tags stay live until a new version of their container is published, they are reported then
+        unpublished = {}
+
+        def done(index, response, error):
+            record = records[index]
+            record['status'] = 'deleted' if error is None else 'error'
+            if error is not None:
+                record['error'] = str(error)
+            elif inventory is not None:
+                # drop what the deletion changed, the next runs list it again without the deleted resource
+                if record['kind'] == 'container':
+                    inventory.invalidate('containers', record['account_id'])
+                inventory.invalidate('tags', '%s/%s' % (record['account_id'], record['container_id']))
+            if record['kind'] == 'tag' and error is None:
+                unpublished[index] = record
+            else:
+                emit(record)
+
+        def publish(service):
+            errors = {}
+            for index, record in sorted(unpublished.items()):
+                container = (record['account_id'], record['container_id'])
+                if container not in errors:
+                    try:
+                        version_id = CreateContainerVersion(service, *container)
+                        PublishContainerVersion(service, record['account_id'], record['container_id'], version_id)
+                        errors[container] = None
+                    except Exception as error:
+                        errors[container] = error
+                if errors[container] is not None:
+                    record.update({'status': 'error', 'error': 'Deleted but not published: %s' % errors[container]})
+                del unpublished[index]
+                emit(record)
+
+        by_kind = {kind: {index: record for index, record in enumerate(records) if record['kind'] == kind}
+                   for kind in KINDS}
+        try:
+            service = services()[1]
+            DeleteTags(service, {
+                index: (record['account_id'], record['container_id'], record['id'])
+                for index, record in by_kind['tag'].items()
+            }, tag_manager_limiter, done)
+            publish(service)
+            DeleteContainerVersions(service, {
+                index: (record['account_id'], record['container_id'], record['id'])
+                for index, record in by_kind['version'].items()
+            }, tag_manager_limiter, done)
+            DeleteContainers(service, {
+                index: (record['account_id'], record['container_id'])
+                for index, record in by_kind['container'].items()
+            }, tag_manager_limiter, done)
+        except Exception as error:
+            # e.g. a connection lost during a batch request, whose calls may or may not have been applied
+            for record in records:
+                if record['status'] == 'stale':
+                    record.update({'status': 'error', 'error': 'Deletion unconfirmed: %s' % error})
+                    emit(record)
+            for record in unpublished.values():
+                record.update({'status': 'error', 'error': 'Deleted but not published: %s' % error})
+                emit(record)
+
+    def list_web_properties(account_id):
+        return [dict(web_property, accountId=account_id)
+                for web_property in IterWebProperties(services()[0], account_id, fields='id,name')]
+
+    stale = []
+    pool = ThreadPoolExecutor(max_workers=workers or settings.PROVISIONING_WORKERS)
+    try:
+        scans = [pool.submit(find, account_id) for account_id in account_ids]
+        web_property_listings = []
+        if keep is not None:
+            analytics_account_ids = settings.ANALYTICS_ACCOUNTS or [
+                account.get('id') for account in IterAnalyticsAccounts(analytics_service)]
+            web_property_listings = [pool.submit(list_web_properties, account_id)
+                                     for account_id in analytics_account_ids]
+
+        for future in scans:
+            for record in future.result():
+                record['status'] = 'stale'
+                stale.append(record)
+                if not apply:
+                    emit(record)
+
+        if apply and stale:
+            chunks = [stale[start:start + settings.BATCH_SIZE] for start in range(0, len(stale), settings.BATCH_SIZE)]
+            for future in [pool.submit(delete, chunk) for chunk in chunks]:
+                future.result()
+
+        for future in web_property_listings:
+            for web_property in future.result():
+                if web_property.get('name') not in keep:
+                    record = {'kind': 'webproperty', 'account_id': web_property['accountId'],
+                              'name': web_property.get('name'), 'id': web_property.get('id'), 'age_days': None,
+                              'reason': 'not in manifest', 'status': 'report_only'}
+                    stale.append(record)
+                    emit(record)
+    finally:
+        pool.shutdown(wait=True)
+
+    return stale
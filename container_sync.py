@@ -0,0 +1,358 @@
+"""
+Sync Tag Manager containers to a declarative spec of tags, triggers and variables.
+"""
+from __future__ import print_function, unicode_literals
+import io
+
+import simplejson as json
+from batching import BatchExecutor
+from google_tag_manager_api import (GetAccountID, GetContainersList, CreateOrGetContainer, ContainerCollection,
+                                    ResourceFingerprint, CreateContainerVersion, PublishContainerVersion)
+from retry import Execute
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Resource kinds with their ID field, in creation order: triggers and tags
+# may reference variables, tags reference triggers. Deletes go the other way.
+KINDS = (
+    ('variables', 'variableId'),
+    ('triggers', 'triggerId'),
+    ('tags', 'tagId'),
+)
+
+# Fields of live resources the API sets itself, left out of update bodies
+READ_ONLY_FIELDS = ('accountId', 'containerId', 'workspaceId', 'fingerprint', 'path', 'tagManagerUrl')
+
+# Spec keys of a tag listing trigger names, and the API fields of their IDs
+TRIGGER_REFERENCES = (
+    ('firingTrigger', 'firingTriggerId'),
+    ('blockingTrigger', 'blockingTriggerId'),
+)
+
+
+def ReadSpec(path):
+    """
+    Read a desired-state spec from a .json, .yaml or .yml file.
+
+    The spec has a containers list, each container has a name, an optional
+    url (to create it if missing), an optional prune flag and variables,
+    triggers and tags lists of resource bodies as the Tag Manager API takes
+    them. Tags may reference triggers by name in firingTrigger and
+    blockingTrigger lists instead of by ID in firingTriggerId and blockingTriggerId.
+
+    Returns:
+    The list of container dicts.
+    """
+
+    with io.open(path, 'r', encoding='utf-8') as spec_file:
+        if path.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise Exception('PyYAML is required to read %s, install it or use a JSON spec' % path)
+            spec = yaml.safe_load(spec_file)
+        else:
+            try:
+                spec = json.load(spec_file)
+            except ValueError as error:
+                raise Exception('Spec %s: invalid JSON: %s' % (path, error))
+
+    containers = (spec or {}).get('containers') or []
+    container_names = set()
+    for container in containers:
+        if not container.get('name'):
+            raise Exception('Spec %s: every container needs a name' % path)
+        if container['name'] in container_names:
+            raise Exception('Spec %s: container %s is listed twice' % (path, container['name']))
+        container_names.add(container['name'])
+
+        for kind, _ in KINDS:
+            names = [resource.get('name') for resource in container.get(kind) or []]
+            if not all(names) or len(set(names)) != len(names):
+                raise Exception('Spec %s: %s of container %s need unique names' % (path, kind, container['name']))
+
+    return containers
+
+
+def _ResolveTriggers(tag, trigger_ids):
+    """
+    Return the tag body with trigger names replaced by trigger IDs.
+    Names not in trigger_ids are kept, they may be IDs already (e.g. built-in triggers).
+    """
+
+    body = dict(tag)
+    for names_key, ids_key in TRIGGER_REFERENCES:
+        if names_key in body:
+            body[ids_key] = [trigger_ids.get(name, name) for name in body.pop(names_key)]
+    return body
+
+
+def _UpdateBody(body, live, id_field):
+    """
+    Return the body of an update: the live resource with the fields of the
+    spec body set over it. Updates replace the whole resource, so the fields
+    the spec leaves out are sent as they are live to keep them.
+    """
+
+    merged = {key: value for key, value in live.items() if key not in READ_ONLY_FIELDS and key != id_field}
+    merged.update(body)
+    return merged
+
+
+def FetchLiveState(service, account_id, container_ids, callback=None):
+    """
+    List the variables, triggers and tags of many containers in batch HTTP requests.
+
+    Args:
+    service: the Tag Manager service object.
+    account_id: the ID of the account holding the containers.
+    container_ids: dict mapping container name to container ID.
+    callback: optional callable(key, response, error), see BatchExecutor.add.
+
+    Returns:
+    A dict mapping every container name to a (state, error) tuple. state maps
+    each kind to a dict of live resources by name, error is None on success.
+    """
+
+    batch = BatchExecutor(service)
+    collections = {}
+    for container_name, container_id in container_ids.items():
+        for kind, _ in KINDS:
+            collection = ContainerCollection(service, account_id, container_id, kind)
+            request = collection.list()
+            collections[(container_name, kind)] = (collection, request)
+            batch.add((container_name, kind), request, callback)
+
+    responses = batch.execute()
+
+    live_state = {}
+    for container_name in container_ids:
+        state, error = {}, None
+        for kind, _ in KINDS:
+            response, kind_error = responses[(container_name, kind)]
+            if kind_error is not None:
+                error = kind_error
+                continue
+
+            collection, request = collections[(container_name, kind)]
+            items = response.get(collection.items_key, [])
+            # v2 pages long lists, the pages after the first one are not batched
+            while response.get('nextPageToken'):
+                request = collection.resource.list_next(request, response)
+                response = Execute(request)
+                items.extend(response.get(collection.items_key, []))
+
+            state[kind] = {resource.get('name'): resource for resource in items}
+        live_state[container_name] = (state, error)
+    return live_state
+
+
+def DiffContainer(container, state, prune=False):
+    """
+    Compare the spec of a container with its live state.
+
+    A resource is updated when one of the fields the spec sets differs from
+    the live one (compared by ResourceFingerprint), fields the spec leaves
+    out are not managed. Live resources missing from the spec are only
+    deleted when pruning.
+
+    Returns:
+    A dict mapping each kind to a dict with create (list of specs), update
+    (list of (spec, live resource) tuples) and delete (list of live resources) keys.
+    """
+
+    trigger_ids = {name: trigger.get('triggerId') for name, trigger in state.get('triggers', {}).items()}
+    prune = container.get('prune', prune)
+
+    plan = {}
+    for kind, _ in KINDS:
+        live = state.get(kind, {})
+        desired = {resource['name']: resource for resource in container.get(kind) or []}
+        changes = {'create': [], 'update': [], 'delete': []}
+
+        for name, resource in desired.items():
+            if name not in live:
+                changes['create'].append(resource)
+                continue
+
+            # triggers created by this sync have no ID yet, their tags differ anyway
+            body = _ResolveTriggers(resource, trigger_ids) if kind == 'tags' else resource
+            if ResourceFingerprint(body, body.keys()) != ResourceFingerprint(live[name], body.keys()):
+                changes['update'].append((resource, live[name]))
+
+        if prune:
+            changes['delete'] = [resource for name, resource in live.items() if name not in desired]
+
+        plan[kind] = changes
+    return plan
+
+
+def _CountChanges(plan):
+    return {
+        action: sum(len(plan[kind][action]) for kind, _ in KINDS)
+        for action in ('create', 'update', 'delete')
+    }
+
+
+def ApplyPlans(service, account_id, containers, callback=None):
+    """
+    Apply the plans of many containers with as few batch HTTP requests as
+    possible: one round of creates and updates per kind for the whole fleet
+    (variables, then triggers, then tags so their references resolve), then
+    one round of deletes per kind in reverse order.
+
+    Args:
+    service: the Tag Manager service object.
+    account_id: the ID of the account holding the containers.
+    containers: dict mapping container name to a (container_id, plan, state) tuple.
+    callback: optional callable(key, response, error), see BatchExecutor.add.
+
+    Returns:
+    A dict mapping every container name to the list of error messages of its failed calls.
+    """
+
+    errors = {container_name: [] for container_name in containers}
+    trigger_ids = {
+        container_name: {name: trigger.get('triggerId') for name, trigger in state.get('triggers', {}).items()}
+        for container_name, (_, _, state) in containers.items()
+    }
+
+    def report(results):
+        for (container_name, kind, name), (response, error) in results.items():
+            if error is not None:
+                errors[container_name].append('%s %s: %s' % (kind, name, error))
+            elif kind == 'triggers' and response:
+                trigger_ids[container_name][name] = response.get('triggerId')
+
+    for kind, id_field in KINDS:
+        creates = BatchExecutor(service, idempotent=False)
+        updates = BatchExecutor(service)
+
+        for container_name, (container_id, plan, _) in containers.items():
+            collection = ContainerCollection(service, account_id, container_id, kind)
+
+            def body(resource):
+                if kind == 'tags':
+                    return _ResolveTriggers(resource, trigger_ids[container_name])
+                return dict(resource)
+
+            for resource in plan[kind]['create']:
+                creates.add((container_name, kind, resource['name']), collection.create(
+                    body(resource),
+                    fields='name,%s' % id_field
+                ), callback)
+
+            for resource, live in plan[kind]['update']:
+                updates.add((container_name, kind, resource['name']), collection.update(
+                    live.get(id_field),
+                    _UpdateBody(body(resource), live, id_field),
+                    fingerprint=live.get('fingerprint'),
+                    fields='name,%s' % id_field
+                ), callback)
+
+        report(creates.execute())
+        report(updates.execute())
+
+    for kind, id_field in reversed(KINDS):
+        deletes = BatchExecutor(service)
+        for container_name, (container_id, plan, _) in containers.items():
+            collection = ContainerCollection(service, account_id, container_id, kind)
+            for live in plan[kind]['delete']:
+                deletes.add((container_name, kind, live.get('name')), collection.delete(live.get(id_field)), callback)
+        report(deletes.execute())
+
+    return errors
+
+
+def SyncContainers(service, containers, account_id=None, prune=False, publish=True, inventory=None):
+    """
+    Bring many containers to their desired state with the fewest API calls.
+
+    The live variables, triggers and tags of every container are fetched
+    once in batch requests and diffed against the spec. Only the differences
+    are applied, and a container version is only created and published for
+    containers that changed, so a run over a fleet already in sync costs the
+    containers listing and the batched live state fetch only.
+
+    Args:
+    service: the Tag Manager service object.
+    containers: list of container specs, see ReadSpec.
+    account_id: Tag Manager account ID. Looked up if not given.
+    prune: delete live resources missing from the spec, a container may override it.
+    publish: create and publish a version for changed containers.
+    inventory: optional Inventory caching the containers listing.
+
+    Returns:
+    One result dict per container with the counts of created, updated and
+    deleted resources, the published version ID and a status.
+    """
+
+    account_id = account_id or GetAccountID(service)
+    account_containers = GetContainersList(service, account_id, inventory)
+
+    results = {}
+    container_ids = {}
+    new_container_ids = {}
+    for container in containers:
+        name = container['name']
+        results[name] = {'container': name, 'account_id': account_id, 'status': 'ok'}
+
+        if name in account_containers:
+            container_ids[name] = account_containers[name][0]
+        elif container.get('url'):
+            try:
+                new_container_ids[name] = CreateOrGetContainer(service, account_id, name, container['url'],
+                                                               inventory=inventory)
+            except Exception as error:
+                results[name].update({'status': 'error', 'error': str(error)})
+        else:
+            results[name].update({'status': 'error', 'error': 'Container %s does not exist and has no url' % name})
+
+    print('Getting live state of %s containers...' % len(container_ids))
+    live_state = FetchLiveState(service, account_id, container_ids)
+    # a container created just now is empty
+    live_state.update({name: ({}, None) for name in new_container_ids})
+    container_ids.update(new_container_ids)
+
+    plans = {}
+    for container in containers:
+        name = container['name']
+        if name not in live_state:
+            continue
+
+        state, error = live_state[name]
+        if error is not None:
+            results[name].update({'status': 'error', 'error': str(error)})
+            continue
+
+        plan = DiffContainer(container, state, prune)
+        counts = _CountChanges(plan)
+        results[name].update({
+            'container_id': container_ids[name],
+            'created': counts['create'],
+            'updated': counts['update'],
+            'deleted': counts['delete'],
+            'changed': any(counts.values()),
+        })
+        if results[name]['changed']:
+            plans[name] = (container_ids[name], plan, state)
+
+    print('Applying changes to %s containers...' % len(plans))
+    errors = ApplyPlans(service, account_id, plans)
+
+    for name, (container_id, _, _) in plans.items():
+        if errors[name]:
+            results[name].update({'status': 'error', 'error': '; '.join(errors[name])})
+            continue
+
+        if publish:
+            try:
+                version_id = CreateContainerVersion(service, account_id, container_id)
+                PublishContainerVersion(service, account_id, container_id, version_id)
+            except Exception as error:
+                results[name].update({'status': 'error', 'error': str(error)})
+                continue
+            results[name]['version_id'] = version_id
+
+    return [results[container['name']] for container in containers]
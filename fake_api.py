@@ -0,0 +1,613 @@
+"""
+In-process fake of the Tag Manager v1 and v2 and Analytics v3 management endpoints this project uses, for load tests.
+"""
+from __future__ import print_function, unicode_literals
+import itertools
+import random
+import re
+import threading
+import time
+from email.parser import Parser
+
+import simplejson as json
+from rate_limit import TokenBucket
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit, parse_qs
+
+TAG_MANAGER_PATH = '/tagmanager/v1/'
+TAG_MANAGER_V2_PATH = '/tagmanager/v2/'
+ANALYTICS_PATH = '/analytics/v3/'
+DISCOVERY_PATH = re.compile(r'^/discovery/v1/apis/(\w+)/(\w+)/rest$')
+
+# Resource collections of a container, with their ID field
+CONTAINER_COLLECTIONS = {'tags': 'tagId', 'triggers': 'triggerId', 'variables': 'variableId'}
+
+# (resource path, method name, HTTP method, path, has a body, query parameters) of the fake APIs
+TAG_MANAGER_METHODS = [
+    (('accounts',), 'list', 'GET', 'accounts', False, ()),
+    (('accounts', 'containers'), 'list', 'GET', 'accounts/{accountId}/containers', False, ()),
+    (('accounts', 'containers'), 'create', 'POST', 'accounts/{accountId}/containers', True, ()),
+    (('accounts', 'containers'), 'delete', 'DELETE', 'accounts/{accountId}/containers/{containerId}', False, ()),
+    (('accounts', 'containers', 'versions'), 'create', 'POST',
+     'accounts/{accountId}/containers/{containerId}/versions', True, ()),
+    (('accounts', 'containers', 'versions'), 'list', 'GET',
+     'accounts/{accountId}/containers/{containerId}/versions', False, ('headersOnly',)),
+    (('accounts', 'containers', 'versions'), 'delete', 'DELETE',
+     'accounts/{accountId}/containers/{containerId}/versions/{containerVersionId}', False, ()),
+    (('accounts', 'containers', 'versions'), 'get', 'GET',
+     'accounts/{accountId}/containers/{containerId}/versions/{containerVersionId}', False, ()),
+    (('accounts', 'containers', 'versions'), 'publish', 'POST',
+     'accounts/{accountId}/containers/{containerId}/versions/{containerVersionId}/publish', False, ()),
+] + [
+    method
+    for collection, id_field in sorted(CONTAINER_COLLECTIONS.items())
+    for method in [
+        (('accounts', 'containers', collection), 'list', 'GET',
+         'accounts/{accountId}/containers/{containerId}/%s' % collection, False, ()),
+        (('accounts', 'containers', collection), 'create', 'POST',
+         'accounts/{accountId}/containers/{containerId}/%s' % collection, True, ()),
+        (('accounts', 'containers', collection), 'get', 'GET',
+         'accounts/{accountId}/containers/{containerId}/%s/{%s}' % (collection, id_field), False, ()),
+        (('accounts', 'containers', collection), 'update', 'PUT',
+         'accounts/{accountId}/containers/{containerId}/%s/{%s}' % (collection, id_field), True, ('fingerprint',)),
+        (('accounts', 'containers', collection), 'delete', 'DELETE',
+         'accounts/{accountId}/containers/{containerId}/%s/{%s}' % (collection, id_field), False, ()),
+    ]
+]
+
+# v2 methods take resource paths, e.g. parent=accounts/1/containers/2/workspaces/3
+TAG_MANAGER_V2_METHODS = [
+    (('accounts',), 'list', 'GET', 'accounts', False, ('pageToken',)),
+    (('accounts', 'containers'), 'list', 'GET', '{+parent}/containers', False, ('pageToken',)),
+    (('accounts', 'containers'), 'create', 'POST', '{+parent}/containers', True, ()),
+    (('accounts', 'containers'), 'delete', 'DELETE', '{+path}', False, ()),
+    (('accounts', 'containers', 'version_headers'), 'list', 'GET', '{+parent}/version_headers', False,
+     ('pageToken', 'includeDeleted')),
+    (('accounts', 'containers', 'versions'), 'get', 'GET', '{+path}', False, ()),
+    (('accounts', 'containers', 'versions'), 'delete', 'DELETE', '{+path}', False, ()),
+    (('accounts', 'containers', 'workspaces'), 'list', 'GET', '{+parent}/workspaces', False, ('pageToken',)),
+    (('accounts', 'containers', 'workspaces'), 'create', 'POST', '{+parent}/workspaces', True, ()),
+    (('accounts', 'containers', 'workspaces'), 'create_version', 'POST', '{+path}:create_version', True, ()),
+    (('accounts', 'containers', 'versions'), 'live', 'GET', '{+parent}/versions:live', False, ()),
+    (('accounts', 'containers', 'versions'), 'publish', 'POST', '{+path}:publish', False, ()),
+] + [
+    method
+    for collection in sorted(CONTAINER_COLLECTIONS)
+    for method in [
+        (('accounts', 'containers', 'workspaces', collection), 'list', 'GET', '{+parent}/%s' % collection, False,
+         ('pageToken',)),
+        (('accounts', 'containers', 'workspaces', collection), 'create', 'POST', '{+parent}/%s' % collection, True,
+         ()),
+        (('accounts', 'containers', 'workspaces', collection), 'get', 'GET', '{+path}', False, ()),
+        (('accounts', 'containers', 'workspaces', collection), 'update', 'PUT', '{+path}', True, ('fingerprint',)),
+        (('accounts', 'containers', 'workspaces', collection), 'delete', 'DELETE', '{+path}', False, ()),
+    ]
+]
+
+ANALYTICS_METHODS = [
+    (('management', 'accounts'), 'list', 'GET', 'management/accounts', False, ('max-results', 'start-index')),
+    (('management', 'webproperties'), 'list', 'GET', 'management/accounts/{accountId}/webproperties', False,
+     ('max-results', 'start-index')),
+    (('management', 'webproperties'), 'insert', 'POST', 'management/accounts/{accountId}/webproperties', True, ()),
+]
+
+
+def DiscoveryDocument(api_name, api_version, root_url):
+    """
+    Return a minimal discovery document of the fake API methods, enough for
+    googleapiclient to build a service object sending requests to root_url.
+    """
+
+    methods = {
+        ('tagmanager', 'v1'): TAG_MANAGER_METHODS,
+        ('tagmanager', 'v2'): TAG_MANAGER_V2_METHODS,
+        ('analytics', 'v3'): ANALYTICS_METHODS,
+    }[(api_name, api_version)]
+    service_path = '%s/%s/' % (api_name, api_version)
+    document = {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'name': api_name,
+        'version': api_version,
+        'rootUrl': root_url + '/',
+        'servicePath': service_path,
+        'baseUrl': '%s/%s' % (root_url, service_path),
+        'batchPath': 'batch',
+        'parameters': {'fields': {'type': 'string', 'location': 'query'}},
+        'schemas': {
+            'Resource': {'id': 'Resource', 'type': 'object', 'additionalProperties': {'type': 'any'}},
+            # googleapiclient only adds list_next methods for responses declaring nextPageToken
+            'Page': {'id': 'Page', 'type': 'object', 'properties': {'nextPageToken': {'type': 'string'}},
+                     'additionalProperties': {'type': 'any'}},
+        },
+        'resources': {},
+    }
+
+    for resource_path, name, http_method, path, has_body, query in methods:
+        resource = document
+        for resource_name in resource_path:
+            resource = resource.setdefault('resources', {}).setdefault(resource_name, {})
+
+        path_parameters = re.findall(r'\{\+?(\w+)\}', path)
+        method = {
+            'id': '.'.join((api_name,) + resource_path + (name,)),
+            'path': path,
+            'httpMethod': http_method,
+            'parameters': dict(
+                [(parameter, {'type': 'string', 'required': True, 'location': 'path'})
+                 for parameter in path_parameters] +
+                [(parameter, {'type': 'string', 'location': 'query'}) for parameter in query]),
+            'parameterOrder': path_parameters,
+            'response': {'$ref': 'Page' if 'pageToken' in query else 'Resource'},
+        }
+        if has_body:
+            method['request'] = {'$ref': 'Resource'}
+        resource.setdefault('methods', {})[name] = method
+
+    return document
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message, reason='notFound'):
+        super(ApiError, self).__init__(message)
+        self.status = status
+        self.body = {'error': {'code': status, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+
+
+class FakeState(object):
+    """
+    Accounts, containers, tags, versions and web properties of the fake APIs.
+    The Tag Manager accounts 1000, 1001... and the Analytics accounts 2000,
+    2001... exist from the start, one of each by default.
+    """
+
+    def __init__(self, accounts=1, page_size=None):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._last_fingerprint = 0
+        # items per page of the v2 list responses, all of them in one page if None
+        self.page_size = page_size
+        self.tag_manager_accounts = [str(1000 + index) for index in range(accounts)]
+        self.analytics_accounts = [str(2000 + index) for index in range(accounts)]
+        self.containers = {}
+        # web properties by Analytics account
+        self.web_properties = {account_id: [] for account_id in self.analytics_accounts}
+
+    def _Id(self):
+        return str(next(self._ids))
+
+    def _Fingerprint(self):
+        # like Tag Manager, the time of the change in milliseconds, unique per change
+        self._last_fingerprint = max(int(time.time() * 1000), self._last_fingerprint + 1)
+        return str(self._last_fingerprint)
+
+    def _Container(self, account_id, container_id):
+        container = self.containers.get((account_id, container_id))
+        if container is None:
+            raise ApiError(404, 'Not found: container %s' % container_id)
+        return container
+
+    def tag_manager(self, http_method, parts, query, body):
+        """
+        Serve a Tag Manager v1 request, parts is the path split on / after the version.
+        """
+
+        with self._lock:
+            if parts == ['accounts'] and http_method == 'GET':
+                return {'accounts': [{'accountId': account_id, 'name': 'Fake account %s' % account_id}
+                                     for account_id in self.tag_manager_accounts]}
+
+            if len(parts) < 3 or parts[0] != 'accounts' or parts[1] not in self.tag_manager_accounts or \
+                    parts[2] != 'containers':
+                raise ApiError(404, 'Not found: %s' % '/'.join(parts))
+            account_id = parts[1]
+
+            if len(parts) == 3:
+                if http_method == 'GET':
+                    return {'containers': [dict(container['resource']) for key, container in
+                                           sorted(self.containers.items()) if key[0] == account_id]}
+                container_id = self._Id()
+                resource = dict(body, accountId=account_id, containerId=container_id,
+                                publicId='GTM-%06d' % int(container_id), fingerprint=self._Fingerprint())
+                self.containers[(account_id, container_id)] = {
+                    'resource': resource, 'tags': {}, 'triggers': {}, 'variables': {}, 'versions': {},
+                    'published': None, 'workspace': self._Id(), 'workspace_fingerprint': self._Fingerprint(),
+                }
+                return dict(resource)
+
+            container = self._Container(account_id, parts[3])
+            if len(parts) == 4:
+                if http_method == 'DELETE':
+                    del self.containers[(account_id, parts[3])]
+                    return None
+                return dict(container['resource'])
+
+            collection = parts[4]
+            if collection == 'versions':
+                return self._Versions(container, http_method, parts[5:])
+
+            if collection not in CONTAINER_COLLECTIONS:
+                raise ApiError(404, 'Not found: %s' % collection)
+            id_field = CONTAINER_COLLECTIONS[collection]
+            items = container[collection]
+
+            if len(parts) == 5 and http_method == 'GET':
+                return {collection: [dict(item) for _, item in sorted(items.items())]}
+            if http_method != 'GET':
+                # like v2 workspaces, the container resource itself is unchanged
+                container['workspace_fingerprint'] = self._Fingerprint()
+
+            if len(parts) == 5:
+                item_id = self._Id()
+                items[item_id] = dict(body, accountId=account_id, containerId=parts[3], fingerprint=self._Fingerprint(),
+                                      **{id_field: item_id})
+                return dict(items[item_id])
+
+            item_id = parts[5]
+            if item_id not in items:
+                raise ApiError(404, 'Not found: %s %s' % (collection, item_id))
+
+            if http_method == 'GET':
+                return dict(items[item_id])
+            if http_method == 'DELETE':
+                del items[item_id]
+                return None
+
+            if query.get('fingerprint') and query['fingerprint'] != items[item_id]['fingerprint']:
+                raise ApiError(409, 'Fingerprint does not match', 'conflict')
+            items[item_id] = dict(body, accountId=account_id, containerId=parts[3], fingerprint=self._Fingerprint(),
+                                  **{id_field: item_id})
+            return dict(items[item_id])
+
+    def _Versions(self, container, http_method, parts):
+        if not parts and http_method == 'GET':
+            return {'containerVersionHeader': [
+                {'containerVersionId': version_id, 'numTags': str(len(version['tag']))}
+                for version_id, version in sorted(container['versions'].items(), key=lambda item: int(item[0]))
+            ]}
+
+        if not parts:
+            version_id = self._Id()
+            container['versions'][version_id] = {
+                'containerVersionId': version_id,
+                'fingerprint': self._Fingerprint(),
+                'tag': [dict(tag) for _, tag in sorted(container['tags'].items())],
+                'trigger': [dict(trigger) for _, trigger in sorted(container['triggers'].items())],
+                'variable': [dict(variable) for _, variable in sorted(container['variables'].items())],
+            }
+            return {'containerVersion': dict(container['versions'][version_id])}
+
+        version_id = container['published'] if parts[0] == 'published' else parts[0]
+        if version_id not in container['versions']:
+            raise ApiError(404, 'Not found: version %s' % parts[0])
+
+        if parts[1:] == ['publish']:
+            container['published'] = version_id
+            return {'containerVersion': dict(container['versions'][version_id])}
+        if http_method == 'DELETE':
+            if version_id == container['published']:
+                raise ApiError(400, 'The live version cannot be deleted', 'badRequest')
+            del container['versions'][version_id]
+            return None
+        return dict(container['versions'][version_id])
+
+    def tag_manager_v2(self, http_method, parts, query, body):
+        """
+        Serve a Tag Manager v2 request by its v1 equivalent, parts is the path split on / after the version.
+        Lists are split in pages of page_size items, the pageToken of the next page is its offset.
+        """
+
+        response = self._TagManagerV2(http_method, parts, query, body)
+        if http_method != 'GET' or not self.page_size or not isinstance(response, dict) or len(response) != 1:
+            return response
+
+        items_key, items = next(iter(response.items()))
+        if not isinstance(items, list):
+            return response
+        start = int(query.get('pageToken') or 0)
+        response = {items_key: items[start:start + self.page_size]}
+        if start + self.page_size < len(items):
+            response['nextPageToken'] = str(start + self.page_size)
+        return response
+
+    def _TagManagerV2(self, http_method, parts, query, body):
+        """
+        Every container has a single workspace holding its tags, triggers and
+        variables. Creating a version from it replaces it by a new workspace
+        with the same content, so clients must follow newWorkspacePath.
+        """
+
+        # custom methods are suffixed to the last part, e.g. versions:live
+        parts[-1], _, action = parts[-1].partition(':')
+        container_parts = parts[:4]
+
+        if parts == ['accounts']:
+            return {'account': self.tag_manager('GET', parts, query, body)['accounts']}
+
+        if len(parts) == 3:
+            response = self.tag_manager(http_method, parts, query, body)
+            if http_method == 'GET':
+                return {'container': [self._V2Path(container) for container in response['containers']]}
+            return self._V2Path(response)
+
+        if len(parts) == 4 and http_method == 'DELETE':
+            return self.tag_manager(http_method, parts, query, body)
+
+        if len(parts) < 5:
+            raise ApiError(404, 'Not found: %s' % '/'.join(parts))
+
+        with self._lock:
+            container = self._Container(parts[1], parts[3])
+            workspace_id = container['workspace']
+            workspace_fingerprint = container['workspace_fingerprint']
+        workspace_path = '/'.join(container_parts + ['workspaces', workspace_id])
+
+        if parts[4] == 'version_headers' and len(parts) == 5:
+            return self.tag_manager('GET', container_parts + ['versions'], query, body)
+
+        if parts[4] == 'versions':
+            if len(parts) == 6 and not action and http_method in ('GET', 'DELETE'):
+                return self.tag_manager(http_method, parts, query, body)
+            if action == 'live':
+                return self.tag_manager('GET', container_parts + ['versions', 'published'], query, body)
+            if action == 'publish' and len(parts) == 6:
+                return self.tag_manager('POST', parts + ['publish'], query, body)
+            raise ApiError(404, 'Not found: %s' % '/'.join(parts))
+
+        if parts[4] != 'workspaces':
+            raise ApiError(404, 'Not found: %s' % parts[4])
+
+        if len(parts) == 5:
+            workspace = {'workspaceId': workspace_id, 'name': 'Default Workspace', 'path': workspace_path,
+                         'fingerprint': workspace_fingerprint}
+            return {'workspace': [workspace]} if http_method == 'GET' else workspace
+
+        if parts[5] != workspace_id:
+            raise ApiError(404, 'Not found: workspace %s' % parts[5])
+
+        if action == 'create_version' and len(parts) == 6:
+            response = self.tag_manager('POST', container_parts + ['versions'], query, body)
+            with self._lock:
+                container['workspace'] = self._Id()
+                container['workspace_fingerprint'] = self._Fingerprint()
+            response['newWorkspacePath'] = '/'.join(container_parts + ['workspaces', container['workspace']])
+            return response
+
+        if len(parts) not in (7, 8) or parts[6] not in CONTAINER_COLLECTIONS:
+            raise ApiError(404, 'Not found: %s' % '/'.join(parts))
+
+        response = self.tag_manager(http_method, container_parts + parts[6:], query, body)
+        if response is None:
+            return None
+        if len(parts) == 7 and http_method == 'GET':
+            # v2 list responses name the items in the singular
+            return {parts[6][:-1]: [self._V2Path(item, workspace_path, parts[6]) for item in response[parts[6]]]}
+        return self._V2Path(response, workspace_path, parts[6])
+
+    def _V2Path(self, resource, workspace_path=None, collection=None):
+        if collection is None:
+            resource['path'] = 'accounts/%(accountId)s/containers/%(containerId)s' % resource
+        else:
+            resource['path'] = '%s/%s/%s' % (workspace_path, collection, resource[CONTAINER_COLLECTIONS[collection]])
+        return resource
+
+    def analytics(self, http_method, parts, query, body):
+        """
+        Serve an Analytics v3 management request, parts is the path split on / after the version.
+        """
+
+        with self._lock:
+            start = int(query.get('start-index', 1)) - 1
+            size = int(query.get('max-results', 1000))
+
+            if parts == ['management', 'accounts']:
+                items = [{'id': account_id, 'name': 'Fake account %s' % account_id}
+                         for account_id in self.analytics_accounts]
+            elif len(parts) == 4 and parts[:2] == ['management', 'accounts'] and parts[3] == 'webproperties' and \
+                    parts[2] in self.web_properties:
+                items = self.web_properties[parts[2]]
+                if http_method == 'POST':
+                    web_property = dict(body, id='UA-%s-%s' % (parts[2], len(items) + 1))
+                    items.append(web_property)
+                    return dict(web_property)
+            else:
+                raise ApiError(404, 'Not found: %s' % '/'.join(parts))
+
+            response = {'items': [dict(item) for item in items[start:start + size]], 'totalResults': len(items)}
+            if start + size < len(items):
+                response['nextLink'] = 'start-index=%s' % (start + size + 1)
+            return response
+
+
+class FakeGoogleApis(object):
+    """
+    Fake Tag Manager and Analytics HTTP server running in a background thread.
+
+    Point the project at it by setting settings.API_ROOT_URL to root_url:
+    service objects are then built from its discovery documents and sent
+    unauthenticated. Batch requests are served too.
+
+    Args:
+    latency: seconds every API call takes.
+    jitter: up to that many seconds are randomly added to latency.
+    error_rate: fraction of API calls failing with 503.
+    throttle_rate: fraction of API calls refused with 429.
+    queries_per_second: calls beyond this rate are refused with 429, unlimited if not given.
+    seed: seed of the random error and throttle injection.
+    accounts: number of Tag Manager and of Analytics accounts.
+    page_size: items per page of the Tag Manager v2 lists, see FakeState.
+    """
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, throttle_rate=0, queries_per_second=None, seed=None,
+                 accounts=1, page_size=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.limiter = TokenBucket(queries_per_second) if queries_per_second else None
+        self.state = FakeState(accounts, page_size)
+        self.calls = 0
+        self.calls_by_status = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def root_url(self):
+        return 'http://%s:%s' % self._server.server_address[:2]
+
+    def start(self):
+        """
+        Start serving on a free local port and return the root URL.
+        """
+
+        fake = self
+
+        class Handler(_Handler):
+            apis = fake
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-google-apis')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.root_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _Record(self, status):
+        with self._lock:
+            self.calls += 1
+            self.calls_by_status[status] = self.calls_by_status.get(status, 0) + 1
+
+    def call(self, http_method, url, body):
+        """
+        Serve one API call, injecting latency, errors and throttling.
+
+        Returns:
+        A (status, response dict or None) tuple.
+        """
+
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+        with self._lock:
+            draw = self._random.random()
+
+        try:
+            if draw < self.throttle_rate or (self.limiter is not None and self.limiter.reserve()):
+                raise ApiError(429, 'Rate Limit Exceeded', 'rateLimitExceeded')
+            if draw < self.throttle_rate + self.error_rate:
+                raise ApiError(503, 'Backend Error', 'backendError')
+
+            parts = urlsplit(url)
+            query = dict((key, values[0]) for key, values in parse_qs(parts.query).items())
+            body = json.loads(body) if body else {}
+
+            if parts.path.startswith(TAG_MANAGER_V2_PATH):
+                response = self.state.tag_manager_v2(http_method, parts.path[len(TAG_MANAGER_V2_PATH):].split('/'),
+                                                     query, body)
+            elif parts.path.startswith(TAG_MANAGER_PATH):
+                response = self.state.tag_manager(http_method, parts.path[len(TAG_MANAGER_PATH):].split('/'),
+                                                  query, body)
+            elif parts.path.startswith(ANALYTICS_PATH):
+                response = self.state.analytics(http_method, parts.path[len(ANALYTICS_PATH):].split('/'),
+                                                query, body)
+            else:
+                raise ApiError(404, 'Not found: %s' % parts.path)
+
+        except ApiError as error:
+            self._Record(error.status)
+            return error.status, error.body
+
+        status = 204 if response is None else 200
+        self._Record(status)
+        return status, response
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+STATUS_REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict',
+                  429: 'Too Many Requests', 503: 'Service Unavailable'}
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # send each response in one segment, keep-alive clients would otherwise wait on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    apis = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _Body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8') if length else ''
+
+    def _Reply(self, status, content, content_type='application/json'):
+        content = content.encode('utf-8')
+        self.send_response(status, STATUS_REASONS.get(status))
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _Serve(self):
+        discovery = DISCOVERY_PATH.match(urlsplit(self.path).path)
+        if discovery:
+            document = DiscoveryDocument(discovery.group(1), discovery.group(2), self.apis.root_url)
+            return self._Reply(200, json.dumps(document))
+
+        if urlsplit(self.path).path == '/batch':
+            return self._Batch()
+
+        status, response = self.apis.call(self.command, self.path, self._Body())
+        self._Reply(status, json.dumps(response) if response is not None else '')
+
+    def _Batch(self):
+        """
+        Serve a multipart/mixed batch request, every part is an API call of its own.
+        """
+
+        message = Parser().parsestr('Content-Type: %s\r\n\r\n%s' % (self.headers.get('Content-Type'), self._Body()))
+        boundary = 'batch_fake_boundary'
+        parts = []
+        for part in message.get_payload():
+            # the parser may have turned CRLF line ends into LF
+            request = part.get_payload().replace('\r\n', '\n')
+            head, _, body = request.partition('\n\n')
+            http_method, url = head.split('\n', 1)[0].split(' ')[:2]
+            status, response = self.apis.call(http_method, url, body.strip())
+            content = json.dumps(response) if response is not None else ''
+            parts.append('--%s\r\nContent-Type: application/http\r\nContent-ID: <response-%s>\r\n\r\n'
+                         'HTTP/1.1 %s %s\r\nContent-Type: application/json\r\nContent-Length: %s\r\n\r\n%s\r\n' % (
+                             boundary, part['Content-ID'][1:-1], status, STATUS_REASONS.get(status), len(content),
+                             content))
+
+        self._Reply(200, ''.join(parts) + '--%s--\r\n' % boundary, 'multipart/mixed; boundary=%s' % boundary)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _Serve
@@ -2,99 +2,267 @@
 Access Google Analytics API and create or get web property tracking ID
 """
 from __future__ import print_function, unicode_literals
-from googleapiclient.discovery import build
 
-import httplib2
 import settings
 from googleapiclient.http import HttpError
 import simplejson as json
-from oauth2client import client
-from oauth2client import file
-from oauth2client import tools
-import argparse
+from metrics import Instrumented
+from retry import Execute
+from services import GetService
+import threading
 
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 
-def GetService(api_name, api_version, scope, client_secrets_path):
-  """
-  Get a service that communicates to a Google API.
 
-  Args:
-    api_name: string The name of the api to connect to.
-    api_version: string The api version to connect to.
-    scope: A list of strings representing the auth scopes to authorize for the
-      connection.
-    client_secrets_path: string A path to a valid client secrets file.
+def _IterItems(resource, fields, page_size=1000, **kwargs):
+    """
+    Lazily yield the items of a management API list method page by page.
 
-  Returns:
-    A service that is connected to the specified API.
-  """
+    Analytics v3 pages with start-index/max-results, the next page is only
+    requested when the caller consumes the previous one.
+    """
 
-  print('Connecting to Google Analytics service...')
+    start_index = 1
+    while True:
+        try:
+            response = Execute(resource.list(fields='nextLink,items(%s)' % fields, max_results=page_size,
+                                             start_index=start_index, **kwargs))
 
-  # Parse command-line arguments.
-  parser = argparse.ArgumentParser(
-      formatter_class=argparse.RawDescriptionHelpFormatter,
-      parents=[tools.argparser])
-  flags = parser.parse_args([])
+        except TypeError as error:
+            # Handle errors in constructing a query.
+            raise Exception('There was an error in constructing your query : %s' % error)
 
-  # Set up a Flow object to be used if we need to authenticate.
-  flow = client.flow_from_clientsecrets(
-      client_secrets_path, scope=scope,
-      message=tools.message_if_missing(client_secrets_path))
+        except HttpError as error:
+            # Handle API errors.
+            raise Exception('There was an in API call or your Account ID. Original Message: %s :' % (json.loads(error.content)['error']['message']))
 
-  # Prepare credentials, and authorize HTTP object with them.
-  # If the credentials don't exist or are invalid run through the native client
-  # flow. The Storage object will ensure that if successful the good
-  # credentials will get written back to a file.
-  storage = file.Storage(api_name + '.dat')
-  credentials = storage.get()
-  if credentials is None or credentials.invalid:
-    credentials = tools.run_flow(flow, storage, flags)
-  http = credentials.authorize(http=httplib2.Http())
+        items = response.get('items', [])
+        for item in items:
+            yield item
 
-  # Build the service object.
-  service = build(api_name, api_version, http=http)
+        if not response.get('nextLink') or not items:
+            return
+        start_index += len(items)
 
-  return service
 
+def IterAccounts(service, fields='id'):
+    """
+    Lazily yield the Google Analytics accounts of the authorized user.
+    """
 
-def GetOrCreateTrackingId(service, site_name, site_url):
+    return _IterItems(service.management().accounts(), fields)
+
+
+def IterWebProperties(service, account_id, fields='id,name'):
+    """
+    Lazily yield the web properties of a Google Analytics account.
+    """
+
+    return _IterItems(service.management().webproperties(), fields, accountId=account_id)
+
+
+@Instrumented('analytics')
+def GetAccountID(service, inventory=None):
+    """
+    Return the ID of the first Google Analytics account or None if there is no account.
+    """
+
+    accounts = inventory.get('analytics_accounts', 'me') if inventory is not None else None
+    if accounts is None:
+        # Get the first Google Analytics account, no need to fetch the others.
+        accounts = {'first': next((account.get('id') for account in IterAccounts(service)), None)}
+        if inventory is not None:
+            inventory.set('analytics_accounts', 'me', accounts)
+
+    return accounts['first']
+
+
+def NormalizeUrl(url):
+    """
+    Normalize a site URL for lookups: no scheme, no www., no default port,
+    lower case host and no trailing slash.
+    """
+
+    parts = urlsplit(url.strip() if '://' in url else '//' + url.strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = '%s:%s' % (host, parts.port)
+    return host + parts.path.rstrip('/')
+
+
+class WebPropertyIndex(object):
+    """
+    Name and website URL lookup of the web properties of one Analytics account.
+
+    Built once per account with GetWebPropertyIndex and shared by every site
+    of a batch (it is thread-safe), so looking up a site is a dict access
+    instead of a scan of every property. Created properties are added with
+    add, which also writes them through to the inventory when given.
+
+    seeded tells that the properties come from a snapshot, which may predate
+    some of them: a name not found must be looked up live, see reload.
+    """
+
+    def __init__(self, account_id, properties=(), inventory=None, seeded=False):
+        self.account_id = account_id
+        self.inventory = inventory
+        self.seeded = seeded
+        self._by_name = {}
+        self._by_url = {}
+        self._lock = threading.Lock()
+        for property in properties:
+            self._Index(property)
+
+    def reload(self, properties):
+        """
+        Index a live listing of web property dicts with id, name and websiteUrl
+        keys, stored to the inventory when given. Properties added meanwhile stay indexed.
+        """
+
+        properties = list(properties)
+        with self._lock:
+            for property in properties:
+                self._Index(property)
+            self.seeded = False
+        if self.inventory is not None:
+            self.inventory.set('webproperties', self.account_id, {
+                property.get('name'): (property.get('id'), property.get('websiteUrl')) for property in properties
+            })
+
+    def _Index(self, property):
+        self._by_name[property.get('name')] = property.get('id')
+        if property.get('websiteUrl'):
+            self._by_url[NormalizeUrl(property.get('websiteUrl'))] = property.get('id')
+
+    def add(self, property):
+        """
+        Add a web property dict with id, name and websiteUrl keys.
+        """
+
+        with self._lock:
+            self._Index(property)
+        if self.inventory is not None:
+            self.inventory.add('webproperties', self.account_id, property.get('name'),
+                               (property.get('id'), property.get('websiteUrl')))
+
+    def find(self, name=None, url=None):
+        """
+        Return the tracking ID of the property with this name, or else with
+        this website URL (compared normalized). None if there is none.
+        """
+
+        with self._lock:
+            if name is not None and name in self._by_name:
+                return self._by_name[name]
+            if url is not None:
+                return self._by_url.get(NormalizeUrl(url))
+        return None
+
+    def names(self):
+        """
+        Return the names of the indexed web properties.
+        """
+
+        with self._lock:
+            return list(self._by_name)
+
+    def __len__(self):
+        return len(self._by_name)
+
+
+@Instrumented('analytics')
+def GetWebPropertyIndex(service, account_id=None, inventory=None):
+    """
+    Build the WebPropertyIndex of an Analytics account, the first one if
+    account_id is not given. The web properties listing is served from and
+    stored to inventory when given.
+    """
+
+    if account_id is None:
+        account_id = GetAccountID(service, inventory)
+        if account_id is None:
+            raise Exception('Currently you have not created any account on Google Analytics. Please create one.')
+
+    listing = inventory.get('webproperties', account_id) if inventory is not None else None
+    if listing is not None and not all(isinstance(ids, (list, tuple)) for ids in listing.values()):
+        # inventories written before website URLs were indexed map names to bare IDs, list them again
+        listing = None
+    if listing is None:
+        properties = list(IterWebProperties(service, account_id, fields='id,name,websiteUrl'))
+        if inventory is not None:
+            inventory.set('webproperties', account_id, {
+                property.get('name'): (property.get('id'), property.get('websiteUrl')) for property in properties
+            })
+    else:
+        properties = [{'name': name, 'id': ids[0], 'websiteUrl': ids[1]} for name, ids in listing.items()]
+
+    seeded = listing is not None and inventory.seeded('webproperties', account_id)
+    return WebPropertyIndex(account_id, properties, inventory, seeded)
+
+
+@Instrumented('analytics')
+def GetOrCreateTrackingId(service, site_name, site_url, inventory=None, property_index=None):
+    """
+    Return the tracking ID of the web property named site_name in the first
+    Google Analytics account, creating the property if it does not exist.
+
+    Lookups go through property_index when given (batch runs share one),
+    otherwise through an index built from inventory when given, otherwise
+    the properties are listed until the name is found.
+    """
 
     print('Creating Web property to get Tracking ID...')
 
-    accounts = service.management().accounts().list(fields='items').execute()
+    if property_index is None and inventory is not None:
+        property_index = GetWebPropertyIndex(service, inventory=inventory)
 
-    if accounts.get('items'):
+    if property_index is not None:
+        account = property_index.account_id
 
-        # Get the first Google Analytics account.
-        account = accounts.get('items')[0].get('id')
+        # check if property already exists then simply return tracking code from property
+        tracking_id = property_index.find(name=site_name)
+        if tracking_id is None and property_index.seeded:
+            # a snapshot listing may predate the property, list them live before creating a duplicate
+            property_index.reload(IterWebProperties(service, account, fields='id,name,websiteUrl'))
+            tracking_id = property_index.find(name=site_name)
+        if tracking_id is not None:
+            return tracking_id
 
-        # Get a list of all the properties for the first account.
-        properties = service.management().webproperties().list(accountId=account, fields='items').execute()
+    else:
+        account = GetAccountID(service)
+        if account is None:
+            raise Exception('Currently you have not created any account on Google Analytics. Please create one.')
 
-        if properties.get('items'):
+        # check if property already exists then simply return tracking code from property,
+        # stop listing as soon as it is found
+        for property in IterWebProperties(service, account):
+            if site_name == property.get('name'):
+                return property.get('id')
 
-          # check if property already exists then simply return tracking code from property
-          for property in properties.get('items'):
-              if site_name == property.get('name'):
-                  return property.get('id')
+    try:
+        web_property = Execute(service.management().webproperties().insert(
+            accountId=account,
+            fields='id',
+            body={
+                'websiteUrl': site_url,
+                'name': site_name
+            }
+        ), idempotent=False)
 
-          try:
-              web_property = service.management().webproperties().insert(
-                  accountId=account,
-                  fields='id',
-                  body={
-                      'websiteUrl': site_url,
-                      'name': site_name
-                  }
-              ).execute()
+    except TypeError as error:
+        # Handle errors in constructing a query.
+        raise Exception('There was an error in constructing your query : %s' % error)
 
-          except TypeError as error:
-              # Handle errors in constructing a query.
-              raise Exception('There was an error in constructing your query : %s' % error)
+    except HttpError as error:
+        # Handle API errors.
+        raise Exception('There was an in API call or your Account ID. Original Message: %s :' % (json.loads(error.content)['error']['message']))
 
-          except HttpError as error:
-              # Handle API errors.
-              raise Exception('There was an in API call or your Account ID. Original Message: %s :' % (json.loads(error.content)['error']['message']))
+    if property_index is not None:
+        property_index.add({'id': web_property.get('id'), 'name': site_name, 'websiteUrl': site_url})
 
     return web_property.get('id')
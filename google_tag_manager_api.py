@@ -1,112 +1,295 @@
-import argparse
-import httplib2
+import hashlib
+import threading
 
-from googleapiclient.discovery import build
-from oauth2client import client
-from oauth2client import file
-from oauth2client import tools
 from googleapiclient.http import HttpError
 import simplejson as json
+from batching import BatchExecutor
+from metrics import Instrumented
+from retry import Execute
+from services import GetService
 import settings
 
 
-def GetService(api_name, api_version, scope, client_secrets_path):
+def _IterItems(resource, items_key, item_fields, **kwargs):
     """
-    Get a service that communicates to a Google API.
+    Lazily yield the items of a list method page by page.
 
     Args:
-    api_name: string The name of the api to connect to.
-    api_version: string The api version to connect to.
-    scope: A list of strings representing the auth scopes to authorize for the
-      connection.
-    client_secrets_path: string A path to a valid client secrets file.
+    resource: the collection to list, e.g. service.accounts().containers().
+    items_key: key of the items in the response, e.g. 'containers'.
+    item_fields: comma separated item fields to request, e.g. 'name,containerId'.
+    kwargs: parameters of the list method.
+
+    Pages are only requested when the caller consumes the previous one, so
+    breaking out of the loop stops fetching. API versions without pagination
+    (Tag Manager v1) have no list_next method and return everything in one page.
+    """
 
-    Returns:
-    A service that is connected to the specified API.
+    paginated = hasattr(resource, 'list_next')
+    fields = '%s(%s)' % (items_key, item_fields)
+    if paginated:
+        fields = 'nextPageToken,' + fields
+
+    request = resource.list(fields=fields, **kwargs)
+    while request is not None:
+        try:
+            response = Execute(request)
+
+        except TypeError as error:
+            # Handle errors in constructing a query.
+            raise Exception('There was an error in constructing your query : %s' % error)
+
+        except HttpError as error:
+            # Handle API errors.
+            raise Exception('There was an API error : %s' % (json.loads(error.content)['error']['message']))
+
+        for item in response.get(items_key, []):
+            yield item
+
+        request = resource.list_next(request, response) if paginated else None
+
+
+# name of the tag provisioned in every container, unless a site sets its own tag_name
+HELLO_WORLD_TAG_NAME = 'UA Hello World Tag'
+
+# ID field of the resources of a container, per kind
+CONTAINER_KINDS = {'tags': 'tagId', 'triggers': 'triggerId', 'variables': 'variableId'}
+
+_workspaces_lock = threading.Lock()
+_workspaces = {}
+_workspace_locks = {}
+
+
+def IsV2(service):
+    """
+    Whether service is a Tag Manager v2 service object. v1 addresses resources
+    by account and container ID, v2 by path and stages changes in workspaces.
+    """
+
+    return hasattr(service.accounts().containers(), 'workspaces')
+
+
+def ContainerPath(account_id, container_id):
+    return 'accounts/%s/containers/%s' % (account_id, container_id)
+
+
+def IterWorkspaces(service, account_id, container_id, fields='workspaceId,name,path'):
+    """
+    Lazily yield the v2 workspaces of a Tag Manager container.
+    """
+
+    return _IterItems(service.accounts().containers().workspaces(), 'workspace', fields,
+                      parent=ContainerPath(account_id, container_id))
+
+
+def ChooseWorkspace(workspaces):
+    """
+    Return the workspace changes are staged in among a container's workspaces:
+    the oldest one named settings.TAG_MANAGER_WORKSPACE, else the oldest one, None if there are none.
+    """
+
+    def age(workspace):
+        # workspace IDs grow with creation
+        return int(workspace.get('workspaceId') or 0)
+
+    named = [workspace for workspace in workspaces if workspace.get('name') == settings.TAG_MANAGER_WORKSPACE]
+    candidates = sorted(named or workspaces, key=age)
+    return candidates[0] if candidates else None
+
+
+def GetWorkspacePath(service, account_id, container_id):
+    """
+    Return the path of the v2 workspace changes of a container are staged in,
+    see ChooseWorkspace, created if the container has none. Looked up once per
+    container and process, by one thread at a time.
+    """
+
+    key = (account_id, container_id)
+    with _workspaces_lock:
+        lock = _workspace_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        with _workspaces_lock:
+            if key in _workspaces:
+                return _workspaces[key]
+
+        workspace = ChooseWorkspace(list(IterWorkspaces(service, account_id, container_id)))
+        if workspace is None:
+            try:
+                workspace = Execute(service.accounts().containers().workspaces().create(
+                    parent=ContainerPath(account_id, container_id),
+                    fields='workspaceId,name,path',
+                    body={'name': settings.TAG_MANAGER_WORKSPACE}
+                ), idempotent=False)
+
+            except HttpError as error:
+                # Handle API errors.
+                raise Exception('There was an API error : %s' % (json.loads(error.content)['error']['message']))
+
+            # another process may have created one meanwhile, all of them settle on the oldest
+            workspace = ChooseWorkspace(list(IterWorkspaces(service, account_id, container_id))) or workspace
+
+        SetWorkspacePath(account_id, container_id, workspace.get('path'))
+        return workspace.get('path')
+
+
+def SetWorkspacePath(account_id, container_id, path):
+    """
+    Remember the v2 workspace of a container, or forget it when path is None.
+    """
+
+    with _workspaces_lock:
+        if path is None:
+            _workspaces.pop((account_id, container_id), None)
+        else:
+            _workspaces[(account_id, container_id)] = path
+
+
+def ClearWorkspaces():
+    """
+    Forget every remembered v2 workspace, e.g. after pointing the services at another server.
+    """
+
+    with _workspaces_lock:
+        _workspaces.clear()
+
+
+class ContainerCollection(object):
     """
+    Builds the requests of one kind of resources of a container (tags,
+    triggers or variables) for the API version of the service: v1 addresses
+    them by account and container ID, v2 by path in the container workspace.
+    Requests are returned unexecuted, for Execute or a BatchExecutor.
 
-    print('Connecting to Google Tag Manger Service...')
+    Args:
+    service: the Tag Manager service object.
+    account_id: the ID of the account holding the container.
+    container_id: the ID of the container.
+    kind: 'tags', 'triggers' or 'variables'.
+    """
+
+    def __init__(self, service, account_id, container_id, kind):
+        self.kind = kind
+        self.id_field = CONTAINER_KINDS[kind]
+        self.v2 = IsV2(service)
+
+        if self.v2:
+            self.parent = GetWorkspacePath(service, account_id, container_id)
+            self.resource = getattr(service.accounts().containers().workspaces(), kind)()
+            # v2 list responses name the items in the singular
+            self.items_key = kind[:-1]
+            self._parent_args = {'parent': self.parent}
+        else:
+            self.resource = getattr(service.accounts().containers(), kind)()
+            self.items_key = kind
+            self._parent_args = {'accountId': account_id, 'containerId': container_id}
+
+    def _ItemArgs(self, item_id):
+        if self.v2:
+            return {'path': '%s/%s/%s' % (self.parent, self.kind, item_id)}
+        return dict(self._parent_args, **{self.id_field: item_id})
+
+    def iter(self, fields):
+        """
+        Lazily yield the items, see _IterItems.
+        """
+
+        return _IterItems(self.resource, self.items_key, fields, **self._parent_args)
 
-    # Parser command-line arguments.
-    parser = argparse.ArgumentParser(
-      formatter_class=argparse.RawDescriptionHelpFormatter,
-      parents=[tools.argparser])
-    flags = parser.parse_args([])
+    def list(self, **kwargs):
+        return self.resource.list(**dict(self._parent_args, **kwargs))
 
-    # Set up a Flow object to be used if we need to authenticate.
-    flow = client.flow_from_clientsecrets(
-      client_secrets_path, scope=scope,
-      message=tools.message_if_missing(client_secrets_path))
+    def create(self, body, **kwargs):
+        return self.resource.create(body=body, **dict(self._parent_args, **kwargs))
 
-    # Prepare credentials, and authorize HTTP object with them.
-    # If the credentials don't exist or are invalid run through the native client
-    # flow. The Storage object will ensure that if successful the good
-    # credentials will get written back to a file.
-    storage = file.Storage(api_name + '.dat')
-    credentials = storage.get()
+    def get(self, item_id, **kwargs):
+        return self.resource.get(**dict(self._ItemArgs(item_id), **kwargs))
 
-    if credentials is None or credentials.invalid:
-        credentials = tools.run_flow(flow, storage, flags)
-    http = credentials.authorize(http=httplib2.Http())
+    def update(self, item_id, body, fingerprint=None, **kwargs):
+        return self.resource.update(body=body, fingerprint=fingerprint, **dict(self._ItemArgs(item_id), **kwargs))
 
-    # Build the service object.
-    service = build(api_name, api_version, http=http)
+    def delete(self, item_id):
+        return self.resource.delete(**self._ItemArgs(item_id))
 
-    return service
 
+def IterAccounts(service, fields='accountId'):
+    """
+    Lazily yield the Tag Manager accounts of the authorized user.
+    """
+
+    return _IterItems(service.accounts(), 'account' if IsV2(service) else 'accounts', fields)
+
+
+def IterContainers(service, account_id, fields='name,containerId,publicId'):
+    """
+    Lazily yield the containers of a Tag Manager account.
+    """
+
+    if IsV2(service):
+        return _IterItems(service.accounts().containers(), 'container', fields, parent='accounts/%s' % account_id)
+    return _IterItems(service.accounts().containers(), 'containers', fields, accountId=account_id)
 
+
+def IterTags(service, account_id, container_id, fields='name,tagId'):
+    """
+    Lazily yield the tags of a Tag Manager container (of its workspace in v2).
+    """
+
+    return ContainerCollection(service, account_id, container_id, 'tags').iter(fields)
+
+
+def IterVersionHeaders(service, account_id, container_id, fields='containerVersionId'):
+    """
+    Lazily yield the headers of the versions of a Tag Manager container, without their tags.
+    """
+
+    if IsV2(service):
+        return _IterItems(service.accounts().containers().version_headers(), 'containerVersionHeader', fields,
+                          parent=ContainerPath(account_id, container_id))
+    return _IterItems(service.accounts().containers().versions(), 'containerVersionHeader', fields,
+                      accountId=account_id, containerId=container_id, headersOnly=True)
+
+
+@Instrumented('tagmanager')
 def GetAccountID(service):
 
     print('Getting your Google Tag Manager Accounts...')
 
     # Note: This code assumes you have an authorized tagmanager service object.
 
-    # This request lists all accounts for the authorized user.
-    try:
-        accounts = service.accounts().list(fields='accounts/accountId').execute()
-    except TypeError as error:
-        # Handle errors in constructing a query.
-        raise Exception('There was an error in constructing your query : %s' % error)
-
-    except HttpError as error:
-        # Handle API errors.
-        raise Exception('There was an API error : %s' % (json.loads(error.content)['error']['message']))
-
-    # The results of the list method are stored in the accounts object.
-    # get first account
-    if accounts.get('accounts'):
-        return accounts.get('accounts')[0].get('accountId')
+    # This request lists accounts for the authorized user.
+    # get first account, no need to fetch the others
+    for account in IterAccounts(service):
+        return account.get('accountId')
     raise Exception('Currently you have not created any account on Google Tag Manager. Please create one.')
 
 
-def GetContainersList(service, account_id):
+@Instrumented('tagmanager')
+def GetContainersList(service, account_id, inventory=None):
     """
     This code assumes you have an authorized tagmanager service object.
     This request lists all containers for the authorized user.
+    The listing is served from and stored to inventory when given.
     """
 
-    try:
-        containers = service.accounts().containers().list(
-            accountId=account_id,
-            fields='containers/name, containers/containerId, containers/publicId'
-        ).execute()
+    if inventory is not None:
+        account_containers = inventory.get('containers', account_id)
+        if account_containers is not None:
+            return account_containers
 
-    except TypeError as error:
-        # Handle errors in constructing a query.
-        raise Exception('There was an error in constructing your query : %s' % error)
+    account_containers = {
+            container.get('name'): (container.get('containerId'), container.get('publicId'))
+            for container in IterContainers(service, account_id)
+           }
 
-    except HttpError as error:
-        # Handle API errors.
-        raise Exception('There was an error either in API call or your Account ID. Original Message: %s' %
-                        (json.loads(error.content)['error']['message']))
+    if inventory is not None:
+        inventory.set('containers', account_id, account_containers)
 
-    # The results of the list method are stored in the containers object.
-    return {
-            container.get('name'): (container.get('containerId'), container.get('publicId')) for container in containers.get('containers', [])
-           }
+    return account_containers
 
 
-def CreateOrGetContainer(service, account_id, container_name, container_site, container_type=None):
+@Instrumented('tagmanager')
+def CreateOrGetContainer(service, account_id, container_name, container_site, container_type=None, inventory=None):
     """
     This code assumes you have an authorized tagmanager service object, account ID and container name.
     This request creates a new container or return existing container if exists
@@ -114,7 +297,13 @@ def CreateOrGetContainer(service, account_id, container_name, container_site, co
     it may return container id to get tag or create tag
     """
 
-    account_containers = GetContainersList(service, account_id)
+    account_containers = GetContainersList(service, account_id, inventory)
+    if (container_name not in account_containers and inventory is not None and
+            inventory.seeded('containers', account_id)):
+        # a snapshot listing may predate the container, list them live before creating a duplicate
+        inventory.invalidate('containers', account_id)
+        account_containers = GetContainersList(service, account_id, inventory)
+
     if container_name in account_containers.keys():
 
         if container_type == 'public_id':
@@ -125,17 +314,32 @@ def CreateOrGetContainer(service, account_id, container_name, container_site, co
     print('Creating new container...')
 
     try:
-        response = service.accounts().containers().create(
-            accountId=account_id,
-            fields='containerId',
-            body={
-                'name': container_name,
-                'timeZoneCountryId': settings.TIME_ZONE_COUNTRY_ID,
-                'timeZoneId': settings.TIME_ZONE_ID,
-                'usageContext': settings.GOOGLE_TAG_USAGE_CONTEXT,
-                'domainName':  [container_site]
-            }
-        ).execute()
+        if IsV2(service):
+            # v2 containers have no time zone
+            request = service.accounts().containers().create(
+                parent='accounts/%s' % account_id,
+                fields='containerId,publicId',
+                body={
+                    'name': container_name,
+                    'usageContext': settings.GOOGLE_TAG_USAGE_CONTEXT,
+                    'domainName': [container_site],
+                    'notes': settings.MANAGED_CONTAINER_NOTES
+                }
+            )
+        else:
+            request = service.accounts().containers().create(
+                accountId=account_id,
+                fields='containerId,publicId',
+                body={
+                    'name': container_name,
+                    'timeZoneCountryId': settings.TIME_ZONE_COUNTRY_ID,
+                    'timeZoneId': settings.TIME_ZONE_ID,
+                    'usageContext': settings.GOOGLE_TAG_USAGE_CONTEXT,
+                    'domainName':  [container_site],
+                    'notes': settings.MANAGED_CONTAINER_NOTES
+                }
+            )
+        response = Execute(request, idempotent=False)
 
     except AttributeError as error:
         # handle attribute missing error for timezone and usage context in settings.py
@@ -150,42 +354,47 @@ def CreateOrGetContainer(service, account_id, container_name, container_site, co
         raise Exception('There was an error either in API call or your Account ID. Original Message: %s' % (
             json.loads(error.content)['error']['message']))
 
+    if inventory is not None:
+        inventory.add('containers', account_id, container_name, (response.get('containerId'), response.get('publicId')))
+        # a new container has no tags, no need to list them
+        inventory.set('tags', '%s/%s' % (account_id, response.get('containerId')), {})
+
+    if container_type == 'public_id':
+        return response.get('publicId')
+
     # The results of the create method are stored in the response object.
     # The following code shows how to access the created id and fingerprint.
     return response.get('containerId')
 
 
-def GetTagsList(service, account_id, container_id):
+@Instrumented('tagmanager')
+def GetTagsList(service, account_id, container_id, inventory=None):
     """
     Note: This code assumes you have an authorized tagmanager service object.
 
     # This request lists all tags for the authorized user.
+    # The listing is served from and stored to inventory when given.
     """
 
-    print('Getting existing Tags...')
+    inventory_key = '%s/%s' % (account_id, container_id)
+    if inventory is not None:
+        container_tags = inventory.get('tags', inventory_key)
+        if container_tags is not None:
+            return container_tags
 
-    try:
-        tags = service.accounts().containers().tags().list(
-            accountId=account_id,
-            containerId=container_id,
-            fields='tags/name, tags/tagId'
-        ).execute()
+    print('Getting existing Tags...')
 
-    except TypeError as error:
-        # Handle errors in constructing a query.
-        raise Exception('There was an error in constructing your query : %s' % error)
+    container_tags = {
+             tag.get('name'): tag.get('tagId') for tag in IterTags(service, account_id, container_id)
+            }
 
-    except HttpError as error:
-        # Handle API errors.
-        raise Exception('There was an API error : %s : %s' % (error.resp.status, error.resp.reason))
+    if inventory is not None:
+        inventory.set('tags', inventory_key, container_tags)
 
-    # The results of the list method are stored in the tags object.
-    # The following code shows how to iterate through them.
-    return {
-             tag.get('name'): tag.get('tagId') for tag in tags.get('tags', [])
-            }
+    return container_tags
 
 
+@Instrumented('tagmanager')
 def GetTagDetails(service, account_id, container_id, tag_id):
     """
     # Note: This code assumes you have an authorized tagmanager service object.
@@ -193,12 +402,7 @@ def GetTagDetails(service, account_id, container_id, tag_id):
     # This request gets an existing new container tag.
     """
     try:
-        tag = service.accounts().containers().tags().get(
-            accountId=account_id,
-            containerId=container_id,
-            tagId=tag_id,
-            fields=''
-        ).execute()
+        tag = Execute(ContainerCollection(service, account_id, container_id, 'tags').get(tag_id, fields=''))
 
     except TypeError as error:
         # Handle errors in constructing a query.
@@ -211,7 +415,196 @@ def GetTagDetails(service, account_id, container_id, tag_id):
     return tag
 
 
-def CreateOrGetTag(service, account_id, container_id, tracking_id, tag_name='UA Hello World Tag'):
+@Instrumented('tagmanager')
+def GetTagsLists(service, containers, inventory=None, limiter=None):
+    """
+    List the tags of many containers in batch HTTP requests, see GetTagsList.
+    v2 pages after the first one are not batched.
+
+    Args:
+    service: the Tag Manager service object.
+    containers: iterable of (account_id, container_id) tuples.
+    inventory: optional Inventory the listings are stored to.
+    limiter: optional TokenBucket every call takes a token from.
+
+    Returns:
+    A dict mapping every (account_id, container_id) tuple to a (listing, error)
+    tuple, listing maps tag name to tag ID.
+    """
+
+    batch = BatchExecutor(service, limiter=limiter)
+    collections = {}
+    for account_id, container_id in set(containers):
+        collection = ContainerCollection(service, account_id, container_id, 'tags')
+        fields = '%s(name,tagId)' % collection.items_key
+        request = collection.list(fields='nextPageToken,' + fields if collection.v2 else fields)
+        collections[(account_id, container_id)] = (collection, request)
+        batch.add((account_id, container_id), request)
+
+    listings = {}
+    for key, (response, error) in batch.execute().items():
+        if error is not None:
+            listings[key] = (None, error)
+            continue
+
+        collection, request = collections[key]
+        try:
+            tags = response.get(collection.items_key, [])
+            while response.get('nextPageToken'):
+                request = collection.resource.list_next(request, response)
+                response = Execute(request)
+                tags.extend(response.get(collection.items_key, []))
+        except HttpError as error:
+            listings[key] = (None, Exception('There was an API error : %s' % (
+                json.loads(error.content)['error']['message'])))
+            continue
+
+        listing = {tag.get('name'): tag.get('tagId') for tag in tags}
+        if inventory is not None:
+            inventory.set('tags', '%s/%s' % key, listing)
+        listings[key] = (listing, None)
+    return listings
+
+
+@Instrumented('tagmanager')
+def GetTagsDetails(service, tags, limiter=None, callback=None):
+    """
+    Get many tags, of any containers, in batch HTTP requests.
+
+    Args:
+    service: the Tag Manager service object.
+    tags: dict mapping a key (e.g. site name) to an (account_id, container_id, tag_id) tuple.
+    limiter: optional TokenBucket every call takes a token from.
+    callback: optional callable(key, tag, error) called for every tag.
+
+    Returns:
+    A dict mapping every key to a (tag, error) tuple, error is None on success.
+    """
+
+    batch = BatchExecutor(service, limiter=limiter)
+    for key, (account_id, container_id, tag_id) in tags.items():
+        batch.add(key, ContainerCollection(service, account_id, container_id, 'tags').get(tag_id, fields=''), callback)
+    return batch.execute()
+
+
+@Instrumented('tagmanager')
+def CreateTags(service, tags, limiter=None, callback=None):
+    """
+    Create many tags, usually one per container, in batch HTTP requests.
+
+    Args:
+    service: the Tag Manager service object.
+    tags: dict mapping a key (e.g. site name) to an (account_id, container_id, tag_body) tuple.
+    limiter: optional TokenBucket every call takes a token from.
+    callback: optional callable(key, tag, error) called for every tag.
+
+    Returns:
+    A dict mapping every key to a (tag, error) tuple, error is None on success.
+    """
+
+    batch = BatchExecutor(service, limiter=limiter, idempotent=False)
+    for key, (account_id, container_id, body) in tags.items():
+        batch.add(key, ContainerCollection(service, account_id, container_id, 'tags').create(body, fields=''), callback)
+    return batch.execute()
+
+
+@Instrumented('tagmanager')
+def DeleteTags(service, tags, limiter=None, callback=None):
+    """
+    Delete many tags, of any containers, in batch HTTP requests.
+    In v2 the deletions are staged in the container workspaces.
+
+    Args:
+    service: the Tag Manager service object.
+    tags: dict mapping a key to an (account_id, container_id, tag_id) tuple.
+    limiter: optional TokenBucket every deletion takes a token from.
+    callback: optional callable(key, response, error) called for every tag.
+
+    Returns:
+    A dict mapping every key to a (response, error) tuple, error is None on success.
+    """
+
+    batch = BatchExecutor(service, limiter=limiter)
+    for key, (account_id, container_id, tag_id) in tags.items():
+        batch.add(key, ContainerCollection(service, account_id, container_id, 'tags').delete(tag_id), callback)
+    return batch.execute()
+
+
+@Instrumented('tagmanager')
+def DeleteContainerVersions(service, versions, limiter=None, callback=None):
+    """
+    Delete many container versions in batch HTTP requests. The published version cannot be deleted.
+
+    Args:
+    service: the Tag Manager service object.
+    versions: dict mapping a key to an (account_id, container_id, container_version_id) tuple.
+    limiter: optional TokenBucket every deletion takes a token from.
+    callback: optional callable(key, response, error) called for every version.
+
+    Returns:
+    A dict mapping every key to a (response, error) tuple, error is None on success.
+    """
+
+    batch = BatchExecutor(service, limiter=limiter)
+    for key, (account_id, container_id, version_id) in versions.items():
+        if IsV2(service):
+            request = service.accounts().containers().versions().delete(
+                path='%s/versions/%s' % (ContainerPath(account_id, container_id), version_id))
+        else:
+            request = service.accounts().containers().versions().delete(
+                accountId=account_id, containerId=container_id, containerVersionId=version_id)
+        batch.add(key, request, callback)
+    return batch.execute()
+
+
+@Instrumented('tagmanager')
+def DeleteContainers(service, containers, limiter=None, callback=None):
+    """
+    Delete many containers, with their workspaces, versions and tags, in batch HTTP requests.
+
+    Args:
+    service: the Tag Manager service object.
+    containers: dict mapping a key to an (account_id, container_id) tuple.
+    limiter: optional TokenBucket every deletion takes a token from.
+    callback: optional callable(key, response, error) called for every container.
+
+    Returns:
+    A dict mapping every key to a (response, error) tuple, error is None on success.
+    """
+
+    batch = BatchExecutor(service, limiter=limiter)
+    for key, (account_id, container_id) in containers.items():
+        if IsV2(service):
+            request = service.accounts().containers().delete(path=ContainerPath(account_id, container_id))
+        else:
+            request = service.accounts().containers().delete(accountId=account_id, containerId=container_id)
+        batch.add(key, request, callback)
+
+    results = batch.execute()
+    for key, (account_id, container_id) in containers.items():
+        if results[key][1] is None:
+            SetWorkspacePath(account_id, container_id, None)
+    return results
+
+
+def HelloWorldTag(tracking_id, tag_name=HELLO_WORLD_TAG_NAME):
+    """
+    Return the body of the Universal Analytics Hello World Tag for a tracking ID.
+    """
+
+    return {
+      'name': tag_name,
+      'type': 'ua',
+      'parameter': [{
+          'key': 'trackingId',
+          'type': 'template',
+          'value': str(tracking_id),
+      }],
+    }
+
+
+@Instrumented('tagmanager')
+def CreateOrGetTag(service, account_id, container_id, tracking_id, tag_name=HELLO_WORLD_TAG_NAME, inventory=None):
     """
     Create the Universal Analytics Hello World Tag or return if exist
 
@@ -220,36 +613,34 @@ def CreateOrGetTag(service, account_id, container_id, tracking_id, tag_name='UA
     account_id: the ID of the account holding the container.
     container_id: the ID of the container to create the tag in.
     tracking_id: the Universal Analytics tracking ID to use.
+    tag_name: name of the tag to create or get.
+    inventory: optional Inventory caching the tags listing.
 
     Returns:
     The API response as a dict representing the newly created Tag resource
     or an error.
     """
 
-    container_tags = GetTagsList(service, account_id, container_id)
+    container_tags = GetTagsList(service, account_id, container_id, inventory)
+    inventory_key = '%s/%s' % (account_id, container_id)
+    if tag_name not in container_tags and inventory is not None and inventory.seeded('tags', inventory_key):
+        # a snapshot listing may predate the tag, list them live before creating a duplicate
+        inventory.invalidate('tags', inventory_key)
+        container_tags = GetTagsList(service, account_id, container_id, inventory)
+
     if tag_name in container_tags.keys():
         tag_id = container_tags[tag_name]
         return GetTagDetails(service, account_id, container_id, tag_id)
 
-    hello_world_tag = {
-      'name': tag_name,
-      'type': 'ua',
-      'parameter': [{
-          'key': 'trackingId',
-          'type': 'template',
-          'value': str(tracking_id),
-      }],
-    }
+    hello_world_tag = HelloWorldTag(tracking_id, tag_name)
 
     print('Creating Tag...')
 
     try:
-        response = service.accounts().containers().tags().create(
-          accountId=account_id,
-          containerId=container_id,
-          body=hello_world_tag,
+        response = Execute(ContainerCollection(service, account_id, container_id, 'tags').create(
+          hello_world_tag,
           fields=''
-        ).execute()
+        ), idempotent=False)
 
     except TypeError as error:
         # Handle errors in constructing a query.
@@ -259,26 +650,223 @@ def CreateOrGetTag(service, account_id, container_id, tracking_id, tag_name='UA
         # Handle API errors.
         raise Exception('There was an error either in API call or Google Tracking ID. Original Message: %s' % (
             json.loads(error.content)['error']['message']))
+
+    if inventory is not None:
+        inventory.add('tags', '%s/%s' % (account_id, container_id), tag_name, response.get('tagId'))
+
     return response
 
 
+@Instrumented('tagmanager')
+def CreateOrGetTags(service, tags, inventory=None, limiter=None):
+    """
+    Create the Universal Analytics Hello World Tag of many containers or get
+    them if they exist, see CreateOrGetTag. The tag listings missing from
+    inventory, the gets and the creates each go in batch HTTP requests, so
+    the tags of BATCH_SIZE containers cost a few round-trips instead of one per container.
+
+    Args:
+    service: the Tag Manager service object.
+    tags: dict mapping a key (e.g. site name) to an (account_id, container_id, tracking_id, tag_name) tuple.
+    inventory: optional Inventory caching the tags listings.
+    limiter: optional TokenBucket every call takes a token from.
+
+    Returns:
+    A dict mapping every key to a (tag, error) tuple, error is None on success.
+    """
+
+    def listing(account_id, container_id, tag_name):
+        inventory_key = '%s/%s' % (account_id, container_id)
+        container_tags = inventory.get('tags', inventory_key) if inventory is not None else None
+        if container_tags is not None and tag_name not in container_tags and inventory.seeded('tags', inventory_key):
+            # a snapshot listing may predate the tag, list them live before creating a duplicate
+            return None
+        return container_tags
+
+    listings = {}
+    for account_id, container_id, _, tag_name in tags.values():
+        container_tags = listing(account_id, container_id, tag_name)
+        if container_tags is not None:
+            listings[(account_id, container_id)] = (container_tags, None)
+
+    missing = [(account_id, container_id) for account_id, container_id, _, _ in tags.values()
+               if (account_id, container_id) not in listings]
+    if missing:
+        print('Getting existing Tags of %s containers...' % len(set(missing)))
+        listings.update(GetTagsLists(service, missing, inventory, limiter))
+
+    results = {}
+    gets = {}
+    creates = {}
+    for key, (account_id, container_id, tracking_id, tag_name) in tags.items():
+        container_tags, error = listings[(account_id, container_id)]
+        if error is not None:
+            results[key] = (None, error)
+        elif tag_name in container_tags:
+            gets[key] = (account_id, container_id, container_tags[tag_name])
+        else:
+            creates[key] = (account_id, container_id, HelloWorldTag(tracking_id, tag_name))
+
+    if gets:
+        results.update(GetTagsDetails(service, gets, limiter))
+    if creates:
+        print('Creating %s Tags...' % len(creates))
+        for key, (tag, error) in CreateTags(service, creates, limiter).items():
+            account_id, container_id, body = creates[key]
+            if error is None and inventory is not None:
+                inventory.add('tags', '%s/%s' % (account_id, container_id), body['name'], tag.get('tagId'))
+            results[key] = (tag, error)
+    return results
+
+
+# Tag fields that make up its configuration, IDs, fingerprints and notes do not.
+TAG_CONFIG_FIELDS = ('name', 'type', 'parameter', 'firingRuleId', 'blockingRuleId', 'firingTriggerId',
+                     'blockingTriggerId', 'liveOnly', 'priority', 'scheduleStartMs', 'scheduleEndMs', 'paused',
+                     'tagFiringOption')
+
+
+def ResourceFingerprint(resource, fields):
+    """
+    Return a hash of the given fields of a Tag Manager resource dict (tag,
+    trigger, variable), equal for two resources that behave the same whatever
+    their IDs, order of parameters or of trigger IDs. Empty fields are ignored.
+    """
+
+    def canonical(value):
+        if isinstance(value, dict):
+            return {key: canonical(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return sorted((canonical(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True))
+        return value
+
+    config = {field: canonical(resource[field]) for field in fields if resource.get(field) not in (None, [], '')}
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def TagFingerprint(tag):
+    """
+    Return a hash of the configuration of a tag resource dict, see ResourceFingerprint.
+    """
+
+    return ResourceFingerprint(tag, TAG_CONFIG_FIELDS)
+
+
+@Instrumented('tagmanager')
+def GetLiveVersion(service, account_id, container_id, fields='containerVersionId,tag'):
+    """
+    Return the published container version or None if the container was never published.
+    """
+
+    try:
+        if IsV2(service):
+            return Execute(service.accounts().containers().versions().live(
+                parent=ContainerPath(account_id, container_id),
+                fields=fields
+            ))
+
+        return Execute(service.accounts().containers().versions().get(
+            accountId=account_id,
+            containerId=container_id,
+            containerVersionId='published',
+            fields=fields
+        ))
+
+    except TypeError as error:
+        # Handle errors in constructing a query.
+        raise Exception('There was an error in constructing your query : %s' % error)
+
+    except HttpError as error:
+        if error.resp.status == 404:
+            return None
+        # Handle API errors.
+        raise Exception('There was an API error : %s : %s' % (error.resp.status, error.resp.reason))
+
+
+@Instrumented('tagmanager')
+def GetContainerVersion(service, account_id, container_id, container_version_id,
+                        fields='containerVersionId,fingerprint'):
+    """
+    Return a container version, None if it does not exist.
+    """
+
+    try:
+        if IsV2(service):
+            return Execute(service.accounts().containers().versions().get(
+                path='%s/versions/%s' % (ContainerPath(account_id, container_id), container_version_id),
+                fields=fields
+            ))
+
+        return Execute(service.accounts().containers().versions().get(
+            accountId=account_id,
+            containerId=container_id,
+            containerVersionId=container_version_id,
+            fields=fields
+        ))
+
+    except TypeError as error:
+        # Handle errors in constructing a query.
+        raise Exception('There was an error in constructing your query : %s' % error)
+
+    except HttpError as error:
+        if error.resp.status == 404:
+            return None
+        # Handle API errors.
+        raise Exception('There was an API error : %s : %s' % (error.resp.status, error.resp.reason))
+
+
+@Instrumented('tagmanager')
+def FindLiveTagVersion(service, account_id, container_id, tag):
+    """
+    Return the ID of the published container version if it has a tag named
+    like tag with the same configuration (see TagFingerprint), None otherwise.
+    Creating and publishing a new version for this tag is then pointless.
+    """
+
+    live_version = GetLiveVersion(service, account_id, container_id)
+    if not live_version:
+        return None
+
+    fingerprint = TagFingerprint(tag)
+    for live_tag in live_version.get('tag', []):
+        if live_tag.get('name') == tag.get('name') and TagFingerprint(live_tag) == fingerprint:
+            return live_version.get('containerVersionId')
+    return None
+
+
+@Instrumented('tagmanager')
 def CreateContainerVersion(service, account_id, container_id):
     """
     This code assumes you have an authorized tagmanager service object.
     This request creates a new container version.
+    In v2 the version is created from the container workspace, with every
+    change staged there since the previous version.
     """
 
     print('Creating container version for publishing...')
 
     try:
-        response = service.accounts().containers().versions().create(
-            accountId=account_id,
-            containerId=container_id,
-            fields='containerVersion/containerVersionId',
-            body={
-                'quickPreview': False
-            }
-        ).execute()
+        if IsV2(service):
+            response = Execute(service.accounts().containers().workspaces().create_version(
+                path=GetWorkspacePath(service, account_id, container_id),
+                fields='containerVersion/containerVersionId,compilerError,newWorkspacePath',
+                body={}
+            ), idempotent=False)
+
+            # the workspace is consumed, the API names the one to stage the next changes in
+            SetWorkspacePath(account_id, container_id, response.get('newWorkspacePath'))
+            if response.get('compilerError'):
+                raise Exception('The workspace of container %s does not compile, no version was created' %
+                                container_id)
+
+        else:
+            response = Execute(service.accounts().containers().versions().create(
+                accountId=account_id,
+                containerId=container_id,
+                fields='containerVersion/containerVersionId',
+                body={
+                    'quickPreview': False
+                }
+            ), idempotent=False)
 
     except TypeError as error:
         # Handle errors in constructing a query.
@@ -295,6 +883,7 @@ def CreateContainerVersion(service, account_id, container_id):
     return version.get('containerVersionId')
 
 
+@Instrumented('tagmanager')
 def PublishContainerVersion(service, account_id, container_id, container_version_id):
     # Note: This code assumes you have an authorized tagmanager service object.
 
@@ -303,12 +892,18 @@ def PublishContainerVersion(service, account_id, container_id, container_version
     print('Publishing Container...')
 
     try:
-        service.accounts().containers().versions().publish(
-            accountId=account_id,
-            containerId=container_id,
-            containerVersionId=container_version_id,
-            fields=''
-        ).execute()
+        if IsV2(service):
+            Execute(service.accounts().containers().versions().publish(
+                path='%s/versions/%s' % (ContainerPath(account_id, container_id), container_version_id),
+                fields='compilerError'
+            ))
+        else:
+            Execute(service.accounts().containers().versions().publish(
+                accountId=account_id,
+                containerId=container_id,
+                containerVersionId=container_version_id,
+                fields=''
+            ))
 
     except TypeError as error:
         # Handle errors in constructing a query.
@@ -1,16 +1,15 @@
 """
 Access and manage a Google Tag Manager account.
+
+Every command imports the modules it needs once the arguments are parsed,
+so --help and invalid arguments return without loading the Google API client.
 """
 from __future__ import print_function, unicode_literals
+import argparse
+import atexit
 import sys
-import os
-import re
 
-from utils import Email
-from google_tag_manager_api import *
-from google_analytics_api import GetOrCreateTrackingId, GetService as GetAnalyticsService
 import settings
-import validators
 
 
 def main(argv):
@@ -26,65 +25,333 @@ def main(argv):
     Site Name, Site URL and Google Analytics Tracking ID from command line.
     Site name and Site URL for creating container to get javascript code snippet.
     Google Analytics tracking id, where you want get all type of tracking
+    Use --manifest to provision many sites from a CSV or JSONL file in one run.
+    Use --sync to bring containers to the tags, triggers and variables of a JSON or YAML spec.
+    Use --export to snapshot every account, container, tag and web property to a local file.
+    Use --gc to report stale containers, tags and versions, and --apply to delete them.
+    Use --serve to keep provisioning sites requested over HTTP/JSON or through a job queue folder.
     """
 
     parser = argparse.ArgumentParser(description=args_help)
-    parser.add_argument('--site_name', type=str, help='Your site name', required=True)
-    parser.add_argument('--site_url', type=str, help='Your site URL', required=True)
+    parser.add_argument('--site_name', type=str, help='Your site name')
+    parser.add_argument('--site_url', type=str, help='Your site URL')
+    parser.add_argument('--manifest', type=str, help='CSV or JSONL file of sites (name, url, options)')
+    parser.add_argument('--output', type=str, help='Write batch results as JSONL to this file instead of stdout')
+    parser.add_argument('--workers', type=int, default=1, help='Number of sites provisioned in parallel')
+    parser.add_argument('--inventory', type=str, default=settings.INVENTORY_PATH,
+                        help='SQLite file caching account listings between runs')
+    parser.add_argument('--journal', type=str, default=settings.JOURNAL_PATH,
+                        help='JSONL journal of completed steps, rerun with the same file to resume')
+    parser.add_argument('--snippets', type=str,
+                        help='With --manifest, write the code snippet of every provisioned site to this folder')
+    parser.add_argument('--sync', type=str, help='JSON or YAML spec of container tags, triggers and variables')
+    parser.add_argument('--prune', action='store_true', help='With --sync, delete resources missing from the spec')
+    parser.add_argument('--metrics', type=str, default=settings.METRICS_PROMETHEUS_PATH,
+                        help='Write API call and step metrics as Prometheus text to this file on exit')
+    parser.add_argument('--export', type=str,
+                        help='Export every account, container, tag and web property to this gzipped JSONL snapshot, '
+                             'refetching only the containers that changed since the last export')
+    parser.add_argument('--full', action='store_true', help='With --export, refetch every container')
+    parser.add_argument('--snapshot', type=str, default=settings.SNAPSHOT_PATH,
+                        help='Look up existing containers, tags and web properties in this snapshot')
+    parser.add_argument('--gc', action='store_true',
+                        help='Report stale containers (missing from --manifest), paused tags and old versions '
+                             'as JSONL, deleting them with --apply')
+    parser.add_argument('--apply', action='store_true', help='With --gc, delete the stale resources')
+    parser.add_argument('--max-age-days', type=float, default=settings.GC_MAX_AGE_DAYS,
+                        help='With --gc, days a container or paused tag must be unchanged for to be stale')
+    parser.add_argument('--gc-account', action='append', default=None,
+                        help='With --gc, a Tag Manager account whose containers missing from --manifest may be '
+                             'deleted, repeat for several. Defaults to GC_CONTAINER_ACCOUNTS')
+    parser.add_argument('--keep-versions', type=int, default=settings.GC_KEEP_VERSIONS,
+                        help='With --gc, versions kept per container besides the published one')
+    parser.add_argument('--serve', action='store_true',
+                        help='Keep running and provision the sites requested on --listen or queued in --queue')
+    parser.add_argument('--listen', type=str, default=settings.SERVICE_ADDRESS,
+                        help="With --serve, 'host:port' of the HTTP/JSON endpoint, empty to serve the queue only")
+    parser.add_argument('--queue', type=str, default=settings.SERVICE_QUEUE_PATH,
+                        help='With --serve, folder of the durable job queue to take jobs from')
     args = parser.parse_args()
 
-    container_name = str(args.site_name)
-    container_site = str(args.site_url)
+    if (not args.serve and not args.gc and not args.export and not args.sync and not args.manifest
+            and (not args.site_name or not args.site_url)):
+        parser.error('--site_name and --site_url are required unless --manifest, --sync, --export, --gc or --serve '
+                     'is given')
+    if args.serve and not args.listen and not args.queue:
+        parser.error('--serve needs --listen or --queue')
+
+    from metrics import METRICS
+    # flush and close the metrics log and StatsD socket last, after the Prometheus file is written
+    atexit.register(METRICS.close)
+    if args.metrics:
+        atexit.register(METRICS.write_prometheus, args.metrics)
+
+    if args.serve:
+        return serve(args.listen, args.queue, args.workers, args.inventory, args.journal, args.snippets)
+
+    if args.gc:
+        return gc(args.manifest, args.output, args.apply, args.workers, args.max_age_days, args.keep_versions,
+                  args.inventory, args.gc_account)
+
+    if args.export:
+        return export(args.export, args.workers, not args.full)
+
+    if args.sync:
+        return sync(args.sync, args.output, args.prune, args.inventory, args.snapshot)
+
+    if args.manifest:
+        return batch(args.manifest, args.output, args.workers, args.inventory, args.journal, args.snippets,
+                     args.snapshot)
+
+    return site(str(args.site_name), str(args.site_url), args.journal, args.inventory, args.snapshot)
 
+
+def site(container_name, container_site, journal_path=None, inventory_path=None, snapshot_path=None):
+    """
+    Provision one site, print its code snippet and email it when SEND_CODE_SNIPPET_EMAIL is on.
+    """
+
+    import validators
     if not validators.url(container_site):
         raise Exception('invalid site URL')
 
-    # Define the auth scopes to request.
-    tag_manager_scope = ['https://www.googleapis.com/auth/tagmanager.edit.containers',
-             'https://www.googleapis.com/auth/tagmanager.edit.containerversions',
-             'https://www.googleapis.com/auth/tagmanager.publish'
-             ]
-
-    # Define the auth scopes to request.
-    analytics_scope = ['https://www.googleapis.com/auth/analytics.edit']
+    from google_analytics_api import GetService as GetAnalyticsService
+    from google_tag_manager_api import GetService
+    from journal import Journal
+    from provisioning import ProvisionSite
+    from snippets import GetTemplate, WriteSnippet
 
     # Authenticate and construct service.
-    analytics_service = GetAnalyticsService('analytics', 'v3', analytics_scope, settings.GOOGLE_DEVELOPER_SECRET_KEY)
-    tracking_id = GetOrCreateTrackingId(analytics_service, container_name, container_site)
+    analytics_service = GetAnalyticsService('analytics', 'v3', settings.ANALYTICS_SCOPE,
+                                            settings.GOOGLE_DEVELOPER_SECRET_KEY)
 
     # Authenticate and construct service.
-    tag_manager_service = GetService('tagmanager', 'v1', tag_manager_scope, settings.GOOGLE_DEVELOPER_SECRET_KEY)
+    tag_manager_service = GetService('tagmanager', settings.TAG_MANAGER_API_VERSION, settings.TAG_MANAGER_SCOPE,
+                                     settings.GOOGLE_DEVELOPER_SECRET_KEY)
 
-    account_id = GetAccountID(tag_manager_service)
+    journal = Journal(journal_path) if journal_path else None
+    inventory = _Inventory(inventory_path, snapshot_path)
+    try:
+        site = ProvisionSite(analytics_service, tag_manager_service, container_name, container_site,
+                             inventory=inventory, journal=journal)
+    finally:
+        if journal is not None:
+            journal.close()
+        inventory.close()
 
-    # get container id to create tag
-    container_id = CreateOrGetContainer(tag_manager_service, account_id, container_name, container_site)
+    print('Preparing javascript code snippet...')
 
-    # Create the hello world tag for tracking id
-    CreateOrGetTag(tag_manager_service, account_id, container_id, tracking_id)
+    gtm_snippet = GetTemplate().render(site['public_id'])
+    WriteSnippet(settings.SNIPPET_DIR, site['public_id'], gtm_snippet)
 
-    container_version_id = CreateContainerVersion(tag_manager_service, account_id, container_id)
+    print(gtm_snippet)
 
-    PublishContainerVersion(tag_manager_service, account_id, container_id, container_version_id)
+    if settings.SEND_CODE_SNIPPET_EMAIL:
+        from utils import Email
+        Email.send(gtm_snippet)
 
-    container_public_id = CreateOrGetContainer(tag_manager_service, account_id, container_name, container_site, 'public_id')
 
-    print('Preparing javascript code snippet...')
+def _Inventory(inventory_path=None, snapshot_path=None):
+    """
+    Open the inventory, seeded with the listings of the snapshot when given.
+    """
 
-    with open(os.path.join('code_snippet', 'gtm_backup.txt'), 'r') as gtm:
-        gtm_snippet = gtm.read()
-        gtm.close()
+    from inventory import Inventory
+    inventory = Inventory(path=inventory_path)
+    if snapshot_path:
+        from snapshot import Snapshot
+        snapshot = Snapshot.read(snapshot_path)
+        if snapshot is None:
+            print('No usable snapshot at %s, listing from the API' % snapshot_path, file=sys.stderr)
+        else:
+            snapshot.seed(inventory)
+    return inventory
 
-    with open(os.path.join('code_snippet', 'gtm.txt'), 'w') as gtm:
-        gtm_snippet = re.sub(r'XXXXXXXX', container_public_id, gtm_snippet)
-        gtm.write(gtm_snippet)
-        gtm.close()
 
-    print(gtm_snippet)
+def batch(manifest_path, output_path=None, workers=1, inventory_path=None, journal_path=None, snippets_path=None,
+          snapshot_path=None):
+    """
+    Provision every site in the manifest with one pair of authorized services
+    (one pair per worker thread when workers > 1) and stream one JSON result record per site.
+    With snippets_path the code snippet of every provisioned site is rendered into its own file there.
+    """
 
-    if settings.SEND_CODE_SNIPPET_EMAIL:
-        Email.send()
+    from manifest import ReadManifest
+    # Read the whole manifest first so a malformed line fails before any API call.
+    sites = list(ReadManifest(manifest_path))
+
+    import simplejson as json
+    from google_analytics_api import GetService as GetAnalyticsService
+    from google_tag_manager_api import GetService
+    from journal import Journal
+    from mailer import MailQueue
+    from provisioning import ProvisionSites, ProvisionSitesConcurrently
+    from snippets import GetTemplate, WriteSnippet
+    import retry
+
+    inventory = _Inventory(inventory_path, snapshot_path)
+    journal = Journal(journal_path) if journal_path else None
+
+    if workers > 1:
+        results = ProvisionSitesConcurrently(sites, workers, inventory, journal)
+    else:
+        analytics_service = GetAnalyticsService('analytics', 'v3', settings.ANALYTICS_SCOPE,
+                                                settings.GOOGLE_DEVELOPER_SECRET_KEY)
+        tag_manager_service = GetService('tagmanager', settings.TAG_MANAGER_API_VERSION, settings.TAG_MANAGER_SCOPE,
+                                         settings.GOOGLE_DEVELOPER_SECRET_KEY)
+        results = ProvisionSites(analytics_service, tag_manager_service, sites, inventory, journal)
+
+    options = {site['name']: site.get('options') or {} for site in sites}
+    template = GetTemplate() if snippets_path or settings.SEND_CODE_SNIPPET_EMAIL else None
+    # emails go out from a background thread over one SMTP session
+    mail = MailQueue() if settings.SEND_CODE_SNIPPET_EMAIL else None
+
+    output = open(output_path, 'a') if output_path else sys.stdout
+    failed = 0
+    try:
+        for result in results:
+            if result['status'] != 'ok':
+                failed += 1
+            elif template is not None:
+                # manifest options may set data_layer and the gtm_auth and gtm_preview environment parameters
+                site_options = options.get(result['site_name'], {})
+                snippet = template.render(result['public_id'], site_options.get('data_layer'), site_options)
+                if snippets_path:
+                    result['snippet'] = WriteSnippet(snippets_path, result['public_id'], snippet)
+                if mail is not None:
+                    # an email column sends the snippet of a site to its own recipient
+                    mail.put(result['site_name'], snippet, site_options.get('email'))
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        inventory.close()
+        if journal is not None:
+            journal.close()
+        if output_path:
+            output.close()
+        if mail is not None:
+            print('Sent %s code snippet emails' % mail.close(), file=sys.stderr)
+            for error in mail.errors:
+                print('Email error: %s' % error, file=sys.stderr)
+
+    print('Provisioned %s of %s sites' % (len(sites) - failed, len(sites)), file=sys.stderr)
+    print('API calls: %(calls)s, retries: %(retries)s, seconds waiting to retry: %(sleep_seconds)s'
+          % retry.STATS.as_dict(), file=sys.stderr)
+    return 1 if failed else 0
+
+
+def sync(spec_path, output_path=None, prune=False, inventory_path=None, snapshot_path=None):
+    """
+    Sync every container of the spec and write one JSON result record per container.
+    """
+
+    from container_sync import ReadSpec, SyncContainers
+    # Read the whole spec first so a malformed one fails before any API call.
+    containers = ReadSpec(spec_path)
+
+    import simplejson as json
+    from google_tag_manager_api import GetService
+    import retry
+
+    inventory = _Inventory(inventory_path, snapshot_path)
+
+    tag_manager_service = GetService('tagmanager', settings.TAG_MANAGER_API_VERSION, settings.TAG_MANAGER_SCOPE,
+                                     settings.GOOGLE_DEVELOPER_SECRET_KEY)
+
+    output = open(output_path, 'a') if output_path else sys.stdout
+    try:
+        results = SyncContainers(tag_manager_service, containers, prune=prune, inventory=inventory)
+        for result in results:
+            output.write(json.dumps(result) + '\n')
+    finally:
+        inventory.close()
+        if output_path:
+            output.close()
+
+    failed = sum(1 for result in results if result['status'] != 'ok')
+    changed = sum(1 for result in results if result.get('changed'))
+    print('Synced %s of %s containers, %s changed' % (len(results) - failed, len(results), changed), file=sys.stderr)
+    print('API calls: %(calls)s, retries: %(retries)s, seconds waiting to retry: %(sleep_seconds)s'
+          % retry.STATS.as_dict(), file=sys.stderr)
+    return 1 if failed else 0
+
+
+def export(snapshot_path, workers=None, refresh=True):
+    """
+    Export every account to the snapshot and print what was fetched and reused.
+    """
+
+    from snapshot import ExportSnapshot
+    import retry
+
+    snapshot, stats = ExportSnapshot(snapshot_path, workers, refresh)
+    print('Exported %(containers)s containers of %(tagmanager_accounts)s Tag Manager accounts '
+          '(%(containers_fetched)s fetched, %(containers_reused)s unchanged) and %(web_properties)s web properties '
+          'of %(analytics_accounts)s Analytics accounts' % stats, file=sys.stderr)
+    print('API calls: %(calls)s, retries: %(retries)s, seconds waiting to retry: %(sleep_seconds)s'
+          % retry.STATS.as_dict(), file=sys.stderr)
+    return 0
+
+
+def serve(address=None, queue_path=None, workers=None, inventory_path=None, journal_path=None, snippets_path=None):
+    """
+    Run the provisioning service until interrupted, see provisioning_service.Serve.
+    """
+
+    from inventory import Inventory
+    from journal import Journal
+    from provisioning_service import ProvisioningService, Serve
+
+    service = ProvisioningService(workers, Inventory(path=inventory_path),
+                                  Journal(journal_path) if journal_path else None, snippets_path)
+    return Serve(service, address, queue_path)
+
+
+def gc(manifest_path=None, output_path=None, apply=False, workers=None, max_age_days=None, keep_versions=None,
+       inventory_path=None, container_accounts=None):
+    """
+    Write one JSON record per stale resource, deleting them when apply is True.
+    Containers and web properties are only stale when a manifest of the sites to keep is given,
+    containers only in the container_accounts (settings.GC_CONTAINER_ACCOUNTS by default).
+    Every record is written as soon as it is final, deletions as they are done.
+    """
+
+    keep = None
+    if manifest_path:
+        from manifest import ReadManifest
+        keep = [site['name'] for site in ReadManifest(manifest_path)]
+
+    import simplejson as json
+    from cleanup import CollectGarbage
+    import retry
+
+    container_accounts = settings.GC_CONTAINER_ACCOUNTS if container_accounts is None else container_accounts
+    if keep is not None and not container_accounts:
+        print('No --gc-account given, no container is deleted', file=sys.stderr)
+
+    counts = {}
+    output = open(output_path, 'a') if output_path else sys.stdout
+
+    def report(record):
+        output.write(json.dumps(record) + '\n')
+        output.flush()
+        counts[record['status']] = counts.get(record['status'], 0) + 1
+
+    inventory = _Inventory(inventory_path)
+    try:
+        CollectGarbage(keep, apply, workers, max_age_days, keep_versions, inventory, container_accounts, report)
+    finally:
+        inventory.close()
+        if output_path:
+            output.close()
 
+    print('%s stale resources: %s' % (sum(counts.values()), ', '.join(
+        '%s %s' % (count, status) for status, count in sorted(counts.items())) or 'none'), file=sys.stderr)
+    if not apply and counts.get('stale'):
+        print('Dry run, rerun with --apply to delete them', file=sys.stderr)
+    print('API calls: %(calls)s, retries: %(retries)s, seconds waiting to retry: %(sleep_seconds)s'
+          % retry.STATS.as_dict(), file=sys.stderr)
+    return 1 if counts.get('error') else 0
 
 if __name__ == '__main__':
-    main(sys.argv)
+    sys.exit(main(sys.argv))
@@ -0,0 +1,127 @@
+"""
+Cache of account listings (web properties, containers, tags) shared by provisioning runs.
+"""
+import sqlite3
+import threading
+import time
+
+import simplejson as json
+import settings
+
+
+class Inventory(object):
+    """
+    In-memory cache of API listings with a time to live, optionally persisted
+    to a local SQLite file so the next run starts warm.
+
+    Entries are stored per kind and key, e.g. kind 'containers' and key
+    account ID, kind 'tags' and key 'account_id/container_id'. Each entry is a
+    dict mapping resource name to its IDs. Create calls add the new resource
+    to the cached entry (write-through) instead of invalidating it.
+
+    Listings seeded from a snapshot are kept in memory only and flagged, see
+    seed: a name missing from them must be looked up live before creating it.
+
+    Args:
+    ttl: seconds a listing stays valid. Defaults to settings.INVENTORY_TTL.
+    path: SQLite file to persist the cache to. Memory only if not given.
+    """
+
+    def __init__(self, ttl=None, path=None):
+        self.ttl = settings.INVENTORY_TTL if ttl is None else ttl
+        self._entries = {}
+        self._seeded = set()
+        self._lock = threading.RLock()
+        self._db = None
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS inventory '
+                             '(kind TEXT, key TEXT, value TEXT, updated REAL, PRIMARY KEY (kind, key))')
+            self._db.commit()
+            for kind, key, value, updated in self._db.execute('SELECT kind, key, value, updated FROM inventory'):
+                self._entries[(kind, key)] = (json.loads(value), updated)
+
+    def get(self, kind, key):
+        """
+        Return the cached listing or None if missing or expired.
+        """
+
+        with self._lock:
+            entry = self._entries.get((kind, str(key)))
+            if entry is None or time.time() - entry[1] > self.ttl:
+                return None
+            return entry[0]
+
+    def set(self, kind, key, value, updated=None):
+        """
+        Store a complete listing, fetched at updated (seconds since the epoch) or now.
+        """
+
+        with self._lock:
+            self._seeded.discard((kind, str(key)))
+            self._store(kind, str(key), dict(value), time.time() if updated is None else updated)
+
+    def seed(self, kind, key, value, updated):
+        """
+        Store a listing of a snapshot taken at updated, unless a listing at
+        least as recent is cached. Seeded listings are not persisted, and may
+        lack what was created since the snapshot, see seeded.
+        """
+
+        with self._lock:
+            entry = self._entries.get((kind, str(key)))
+            if entry is not None and entry[1] >= updated:
+                return
+            self._seeded.add((kind, str(key)))
+            self._store(kind, str(key), dict(value), updated)
+
+    def seeded(self, kind, key):
+        """
+        Whether the cached listing comes from a snapshot rather than from the API.
+        """
+
+        with self._lock:
+            return (kind, str(key)) in self._seeded
+
+    def add(self, kind, key, name, ids):
+        """
+        Write-through a single created resource into a cached listing.
+        Nothing is cached if the listing itself is not, the next get lists it anyway.
+        """
+
+        with self._lock:
+            entry = self._entries.get((kind, str(key)))
+            if entry is None:
+                return
+            listing = dict(entry[0])
+            listing[name] = ids
+            # keep the listing age, the rest of it is not any fresher
+            self._store(kind, str(key), listing, entry[1])
+
+    def invalidate(self, kind=None, key=None):
+        """
+        Drop cached listings, all of them or those of a kind and key.
+        """
+
+        with self._lock:
+            for entry_kind, entry_key in list(self._entries):
+                if (kind is None or kind == entry_kind) and (key is None or str(key) == entry_key):
+                    del self._entries[(entry_kind, entry_key)]
+                    self._seeded.discard((entry_kind, entry_key))
+                    if self._db:
+                        self._db.execute('DELETE FROM inventory WHERE kind = ? AND key = ?', (entry_kind, entry_key))
+            if self._db:
+                self._db.commit()
+
+    def _store(self, kind, key, value, updated):
+        self._entries[(kind, key)] = (value, updated)
+        if self._db and (kind, key) not in self._seeded:
+            self._db.execute('INSERT OR REPLACE INTO inventory (kind, key, value, updated) VALUES (?, ?, ?, ?)',
+                             (kind, key, json.dumps(value), updated))
+            self._db.commit()
+
+    def close(self):
+        if self._db:
+            self._db.close()
+            self._db = None
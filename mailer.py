@@ -0,0 +1,178 @@
+"""
+Send code snippet emails over one persistent SMTP session, off the provisioning critical path.
+"""
+from __future__ import print_function, unicode_literals
+import smtplib
+import threading
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import settings
+
+
+def BuildMessage(code_snippet, recipient=None, subject=None):
+    """
+    Build the code snippet email to recipient, settings.RECEIVER_EMAIL if not given.
+    """
+
+    # Create message container - the correct MIME type is multipart/alternative.
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject or settings.EMAIL_SUBJECT
+    msg['From'] = settings.SENDER_EMAIL
+    msg['To'] = recipient or settings.RECEIVER_EMAIL
+
+    # Record the MIME type text/plain
+    msg.attach(MIMEText(code_snippet, 'plain'))
+    return msg
+
+
+class SmtpSession(object):
+    """
+    One SMTP connection opened, upgraded with STARTTLS and logged in on the
+    first message and reused for the next ones, so many messages cost one
+    TLS and auth handshake. A connection dropped by the server is opened
+    again once before giving up. Not thread-safe, MailQueue gives it a thread of its own.
+
+    Args:
+    host, port: SMTP server. Default to settings.SMTP_HOST and settings.SMTP_PORT.
+    user, password: login, skipped when user is empty (e.g. a local debug server).
+    starttls: upgrade the connection with STARTTLS, failing if the server does not offer it.
+      Defaults to settings.SMTP_STARTTLS. Always on when logging in.
+    """
+
+    def __init__(self, host=None, port=None, user=None, password=None, starttls=None):
+        self.host = host or settings.SMTP_HOST
+        self.port = port or settings.SMTP_PORT
+        self.user = settings.SMTP_EMAIL if user is None else user
+        self.password = settings.SMTP_PASSWORD if password is None else password
+        self.starttls = settings.SMTP_STARTTLS if starttls is None else starttls
+        self._server = None
+
+    def _Connect(self):
+        # Send the message via SMTP server.
+        try:
+            server = smtplib.SMTP(self.host, self.port)
+        except smtplib.socket.gaierror as error:
+            raise Exception('Invalid HOST or PORT for SMTP configuration: Original Message: %s' % (error))
+
+        server.ehlo()
+        # never send the password, or the snippets, over a connection that was not upgraded
+        if self.starttls or self.user:
+            if not server.has_extn('starttls'):
+                server.quit()
+                raise Exception('SMTP server %s:%s does not offer STARTTLS, refusing to send in cleartext' % (
+                    self.host, self.port))
+            server.starttls()
+            server.ehlo()
+
+        if self.user:
+            try:
+                server.login(self.user, self.password)
+            except smtplib.SMTPAuthenticationError as error:
+                server.quit()
+                raise Exception('Invalid username or password for SMTP configuration: Original Message: %s' % (
+                    error))
+
+        self._server = server
+
+    def send(self, msg):
+        """
+        Send an email.message.Message to its To recipients.
+
+        Returns:
+        The dict of refused recipients, empty if all were accepted.
+        """
+
+        for attempt in range(2):
+            if self._server is None:
+                self._Connect()
+            try:
+                return self._server.sendmail(msg['From'] or settings.SENDER_EMAIL, msg['To'].split(','),
+                                             msg.as_string())
+            except smtplib.SMTPServerDisconnected:
+                # idle connection closed by the server, open a new one once
+                self._server = None
+                if attempt:
+                    raise
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+            self._server = None
+
+
+class MailQueue(object):
+    """
+    Queue of code snippet emails delivered by a background thread over one
+    SmtpSession, so provisioning never waits on SMTP.
+
+    With digest, snippets are grouped per recipient and sent as one email
+    each on close instead of one email per site.
+
+    Args:
+    session: SmtpSession, a new one on the settings if not given.
+    digest: send one email per recipient. Defaults to settings.EMAIL_DIGEST.
+    """
+
+    def __init__(self, session=None, digest=None):
+        self.session = session or SmtpSession()
+        self.digest = settings.EMAIL_DIGEST if digest is None else digest
+        self.sent = 0
+        self.errors = []
+        self._digests = {}
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._Run, name='mail-queue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, site_name, code_snippet, recipient=None):
+        """
+        Queue the snippet of a site for recipient, settings.RECEIVER_EMAIL if not given.
+        """
+
+        self._queue.put((site_name, code_snippet, recipient or settings.RECEIVER_EMAIL))
+
+    def _Send(self, msg):
+        try:
+            self.session.send(msg)
+            self.sent += 1
+        except Exception as error:
+            self.errors.append('%s: %s' % (msg['To'], error))
+
+    def _Run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            site_name, code_snippet, recipient = item
+            if self.digest:
+                self._digests.setdefault(recipient, []).append((site_name, code_snippet))
+            else:
+                self._Send(BuildMessage(code_snippet, recipient, '%s: %s' % (settings.EMAIL_SUBJECT, site_name)))
+
+        for recipient, snippets in self._digests.items():
+            body = '\n\n'.join('%s\n\n%s' % (site_name, code_snippet) for site_name, code_snippet in snippets)
+            self._Send(BuildMessage(body, recipient, '%s: %s sites' % (settings.EMAIL_SUBJECT, len(snippets))))
+        self._digests = {}
+        self.session.close()
+
+    def close(self):
+        """
+        Deliver everything queued (and the digests), then close the SMTP session.
+
+        Returns:
+        The number of emails sent.
+        """
+
+        self._queue.put(None)
+        self._thread.join()
+        return self.sent
@@ -0,0 +1,67 @@
+"""
+Read sites to provision from a CSV or JSONL manifest file.
+"""
+from __future__ import print_function
+import csv
+import io
+
+import simplejson as json
+import validators
+from snippets import CheckDataLayer
+
+
+def ParseSite(record, source='Site'):
+    """
+    Normalize a manifest record, or a provisioning request, into a dict of name, url and options.
+    Every key other than name and url is kept in options. Errors start with source, e.g. 'Manifest line 3'.
+    """
+
+    record = dict(record)
+    name = (record.pop('name', None) or '').strip()
+    url = (record.pop('url', None) or '').strip()
+
+    if not name or not url:
+        raise Exception('%s: name and url are required' % source)
+
+    if not validators.url(url):
+        raise Exception('%s: invalid site URL %s' % (source, url))
+
+    if record.get('data_layer'):
+        try:
+            CheckDataLayer(record['data_layer'])
+        except Exception as error:
+            raise Exception('%s: %s' % (source, error))
+
+    return {
+        'name': name,
+        'url': url,
+        'options': {key: value for key, value in record.items() if key and value not in (None, '')},
+    }
+
+
+def ReadManifest(path):
+    """
+    Read a manifest file lazily.
+
+    Args:
+    path: path to a .csv file with a header row (name, url, options...)
+      or a .jsonl file with one JSON object per line.
+
+    Yields:
+    One dict per site with name, url and options keys.
+    """
+
+    with io.open(path, 'r', encoding='utf-8') as manifest:
+        if path.lower().endswith('.csv'):
+            # header is line 1
+            for line_number, row in enumerate(csv.DictReader(manifest), 2):
+                yield ParseSite(row, 'Manifest line %s' % line_number)
+        else:
+            for line_number, line in enumerate(manifest, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as error:
+                    raise Exception('Manifest line %s: invalid JSON: %s' % (line_number, error))
+                yield ParseSite(record, 'Manifest line %s' % line_number)
@@ -0,0 +1,240 @@
+"""
+Latency, status, retry and byte metrics of API calls and provisioning steps, exported as JSON logs, Prometheus text
+and StatsD.
+"""
+from __future__ import print_function, unicode_literals
+import functools
+import io
+import os
+import re
+import socket
+import threading
+import time
+
+import simplejson as json
+import settings
+
+# samples kept per series to compute quantiles, the oldest are dropped first
+MAX_SAMPLES = 10000
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _StatsdName(*parts):
+    """
+    Join parts into a StatsD metric name. Characters StatsD lines cannot hold
+    (':' and '|' separate the value and the type) are replaced by '_'.
+    """
+
+    return '.'.join(re.sub(r'[^A-Za-z0-9_.]', '_', str(part)) for part in parts)
+
+
+def Quantile(samples, quantile):
+    """
+    Return the nearest-rank quantile (0 to 1) of a list of numbers, None if empty.
+    """
+
+    if not samples:
+        return None
+    samples = sorted(samples)
+    rank = max(1, int(round(quantile * len(samples))))
+    return samples[min(rank, len(samples)) - 1]
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of counters and latency samples.
+
+    API requests are recorded by retry.Execute (one record per attempt, by
+    API method and status) and API functions by the Instrumented decorator
+    (one record per call, by step and outcome). Every record is also written
+    as a JSON line to the events log and sent to StatsD when configured.
+
+    Args:
+    log_path: JSONL file of events. Defaults to settings.METRICS_LOG_PATH, None disables it.
+    statsd_address: 'host:port' of a StatsD server. Defaults to settings.STATSD_ADDRESS, None disables it.
+    """
+
+    def __init__(self, log_path=None, statsd_address=None):
+        self.log_path = log_path
+        self.statsd_address = statsd_address
+        self._lock = threading.Lock()
+        self._log = None
+        self._statsd = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.samples = {}
+
+    def _Count(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _Sample(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        samples = self.samples.setdefault(key, [])
+        samples.append(value)
+        if len(samples) > MAX_SAMPLES:
+            del samples[0]
+
+    def record_request(self, method, status, seconds, sent=0, received=0):
+        """
+        Record one HTTP attempt of an API method, e.g. tagmanager.accounts.containers.list.
+        status is the HTTP status, or 'socket' for a connection error.
+        """
+
+        labels = {'method': method, 'status': str(status)}
+        with self._lock:
+            self._Count('api_requests_total', labels)
+            self._Count('api_request_bytes_sent_total', {'method': method}, sent)
+            self._Count('api_request_bytes_received_total', {'method': method}, received)
+            self._Sample('api_request_seconds', {'method': method}, seconds)
+        self._Emit({'event': 'api_request', 'method': method, 'status': status, 'seconds': round(seconds, 6),
+                    'sent': sent, 'received': received},
+                   ['%s:1|c' % _StatsdName('api.requests', method, status),
+                    '%s:%d|ms' % (_StatsdName('api.request', method), seconds * 1000)])
+
+    def record_retry(self, method, status, delay):
+        """
+        Record that an API method is retried after delay seconds.
+        """
+
+        with self._lock:
+            self._Count('api_retries_total', {'method': method, 'status': str(status)})
+            self._Count('api_retry_sleep_seconds_total', {'method': method}, delay)
+        self._Emit({'event': 'api_retry', 'method': method, 'status': status, 'delay': round(delay, 3)},
+                   ['%s:1|c' % _StatsdName('api.retries', method, status)])
+
+    def record_step(self, step, seconds, error=None):
+        """
+        Record one call of an instrumented function, e.g. tagmanager.CreateOrGetTag.
+        """
+
+        outcome = 'error' if error is not None else 'ok'
+        with self._lock:
+            self._Count('step_calls_total', {'step': step, 'outcome': outcome})
+            self._Sample('step_seconds', {'step': step}, seconds)
+        event = {'event': 'step', 'step': step, 'outcome': outcome, 'seconds': round(seconds, 6)}
+        if error is not None:
+            event['error'] = str(error)
+        self._Emit(event, ['%s:1|c' % _StatsdName('step.calls', step, outcome),
+                           '%s:%d|ms' % (_StatsdName('step', step), seconds * 1000)])
+
+    def step_quantiles(self):
+        """
+        Return a dict mapping every step to its call count and p50, p90 and p99 seconds.
+        """
+
+        with self._lock:
+            series = [(dict(labels)['step'], list(samples)) for (name, labels), samples in self.samples.items()
+                      if name == 'step_seconds']
+        return dict((step, dict([('calls', len(samples))] + [
+            ('p%d' % round(quantile * 100), Quantile(samples, quantile)) for quantile in QUANTILES
+        ])) for step, samples in series)
+
+    def _Emit(self, event, statsd_lines):
+        log_path = self.log_path if self.log_path is not None else settings.METRICS_LOG_PATH
+        if log_path:
+            event['time'] = time.time()
+            line = json.dumps(event) + '\n'
+            with self._lock:
+                if self._log is None:
+                    self._log = io.open(log_path, 'a', encoding='utf-8')
+                self._log.write(line)
+                self._log.flush()
+
+        address = self.statsd_address if self.statsd_address is not None else settings.STATSD_ADDRESS
+        if address:
+            host, port = address.rsplit(':', 1)
+            with self._lock:
+                if self._statsd is None:
+                    self._statsd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                statsd = self._statsd
+            payload = '\n'.join('%s.%s' % (settings.METRICS_PREFIX, line) for line in statsd_lines)
+            try:
+                statsd.sendto(payload.encode('utf-8'), (host, int(port)))
+            except socket.error:
+                # metrics are best effort, never fail a call for them, nor for a socket closed meanwhile
+                pass
+
+    def prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format:
+        counters, and summaries with quantiles for latencies.
+        """
+
+        def series(name, labels, suffix=''):
+            label_text = ','.join('%s="%s"' % (key, value.replace('"', '\\"')) for key, value in labels)
+            return '%s_%s%s{%s}' % (settings.METRICS_PREFIX, name, suffix, label_text)
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            samples = sorted((key, list(values)) for key, values in self.samples.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE %s_%s counter' % (settings.METRICS_PREFIX, name))
+                typed.add(name)
+            lines.append('%s %s' % (series(name, labels), value))
+
+        for (name, labels), values in samples:
+            if name not in typed:
+                lines.append('# TYPE %s_%s summary' % (settings.METRICS_PREFIX, name))
+                typed.add(name)
+            for quantile in QUANTILES:
+                lines.append('%s %s' % (series(name, labels + (('quantile', str(quantile)),)),
+                                        Quantile(values, quantile)))
+            lines.append('%s %s' % (series(name, labels, '_sum'), sum(values)))
+            lines.append('%s %s' % (series(name, labels, '_count'), len(values)))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        """
+        Write the Prometheus text to path atomically, for the node exporter textfile collector.
+        """
+
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with io.open(tmp_path, 'w', encoding='utf-8') as prometheus:
+            prometheus.write(self.prometheus())
+        os.rename(tmp_path, path)
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if self._statsd is not None:
+                self._statsd.close()
+                self._statsd = None
+
+
+METRICS = Metrics()
+
+
+def Instrumented(api_name):
+    """
+    Decorator recording every call of an API function as the step
+    '<api_name>.<function name>' in METRICS: latency and whether it raised.
+    """
+
+    def decorator(function):
+        step = '%s.%s' % (api_name, function.__name__)
+
+        @functools.wraps(function)
+        def instrumented(*args, **kwargs):
+            start = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                METRICS.record_step(step, time.time() - start, error)
+                raise
+            METRICS.record_step(step, time.time() - start)
+            return result
+
+        return instrumented
+
+    return decorator
@@ -0,0 +1,371 @@
+"""
+Provision Google Analytics web property and Google Tag Manager container for one or many sites.
+"""
+from __future__ import print_function, unicode_literals
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from accounts import AccountRouter
+from google_tag_manager_api import (GetService, GetAccountID, CreateOrGetContainer, CreateOrGetTag, CreateOrGetTags,
+                                    FindLiveTagVersion, CreateContainerVersion, PublishContainerVersion,
+                                    HELLO_WORLD_TAG_NAME)
+from google_analytics_api import GetOrCreateTrackingId, GetService as GetAnalyticsService
+from inventory import Inventory
+from rate_limit import TokenBucket, RateLimitedHttp
+import settings
+
+
+def _Step(journal, site_name, step, run):
+    """
+    Run a provisioning step unless the journal has it done already, then record its value.
+    """
+
+    if journal is not None:
+        value = journal.get(site_name, step)
+        if value is not None:
+            return value
+
+    value = run()
+
+    if journal is not None:
+        journal.record(site_name, step, value)
+    return value
+
+
+def _ProvisionContainer(analytics_service, tag_manager_service, site_name, site_url, account_id, inventory,
+                        property_index, journal):
+    """
+    Get or create the web property and the container of a site.
+
+    Returns:
+    A (tracking_id, account_id, container_id) tuple.
+    """
+
+    tracking_id = _Step(journal, site_name, 'tracking_id', lambda: GetOrCreateTrackingId(
+        analytics_service, site_name, site_url, inventory, property_index))
+
+    def container():
+        container_account_id = account_id or GetAccountID(tag_manager_service)
+        # get container id to create tag
+        return [container_account_id, CreateOrGetContainer(tag_manager_service, container_account_id, site_name,
+                                                           site_url, inventory=inventory)]
+
+    account_id, container_id = _Step(journal, site_name, 'container', container)
+    return tracking_id, account_id, container_id
+
+
+def _TagState(tag_manager_service, account_id, container_id, tag):
+    return {
+        'tag_id': tag.get('tagId'),
+        'live_version_id': FindLiveTagVersion(tag_manager_service, account_id, container_id, tag),
+    }
+
+
+def _Publish(tag_manager_service, site_name, site_url, tracking_id, account_id, container_id, tag_state, inventory,
+             journal):
+    """
+    Create and publish a container version unless the published one has the tag, and return the site result.
+    """
+
+    changed = tag_state['live_version_id'] is None
+
+    if changed:
+        container_version_id = _Step(journal, site_name, 'version', lambda: CreateContainerVersion(
+            tag_manager_service, account_id, container_id))
+
+        _Step(journal, site_name, 'published', lambda: PublishContainerVersion(
+            tag_manager_service, account_id, container_id, container_version_id) or container_version_id)
+    else:
+        print('Published container version is up to date, nothing to publish.')
+        container_version_id = tag_state['live_version_id']
+
+    container_public_id = _Step(journal, site_name, 'public_id', lambda: CreateOrGetContainer(
+        tag_manager_service, account_id, site_name, site_url, 'public_id', inventory=inventory))
+
+    result = {
+        'site_name': site_name,
+        'site_url': site_url,
+        'tracking_id': tracking_id,
+        'account_id': account_id,
+        'container_id': container_id,
+        'public_id': container_public_id,
+        'version_id': container_version_id,
+        'changed': changed,
+        'status': 'ok',
+    }
+
+    if journal is not None:
+        journal.record(site_name, 'done', result)
+    return result
+
+
+def ProvisionSite(analytics_service, tag_manager_service, site_name, site_url, account_id=None, options=None,
+                  inventory=None, property_index=None, journal=None):
+    """
+    Run the whole provisioning chain for a single site.
+
+    Args:
+    analytics_service: an authorized analytics v3 service object.
+    tag_manager_service: an authorized tagmanager service object.
+    site_name: name used for web property and container.
+    site_url: URL of the site.
+    account_id: Tag Manager account ID. Looked up if not given.
+    options: dict of optional per-site settings, e.g. tag_name.
+    inventory: optional Inventory caching account listings between sites.
+    property_index: optional WebPropertyIndex shared between sites.
+    journal: optional Journal. Steps it has done are skipped, the others are recorded.
+
+    Returns:
+    A dict describing the provisioned site. A new container version is only
+    created and published when the published one lacks the tag as it is in
+    the workspace, 'changed' tells whether it was.
+    """
+
+    if journal is not None and journal.get(site_name, 'done') is not None:
+        return journal.get(site_name, 'done')
+
+    options = options or {}
+
+    tracking_id, account_id, container_id = _ProvisionContainer(
+        analytics_service, tag_manager_service, site_name, site_url, account_id, inventory, property_index, journal)
+
+    def tag():
+        # Create the hello world tag for tracking id
+        tag = CreateOrGetTag(tag_manager_service, account_id, container_id, tracking_id, inventory=inventory,
+                             tag_name=options.get('tag_name') or HELLO_WORLD_TAG_NAME)
+        return _TagState(tag_manager_service, account_id, container_id, tag)
+
+    tag_state = _Step(journal, site_name, 'tag_state', tag)
+    return _Publish(tag_manager_service, site_name, site_url, tracking_id, account_id, container_id, tag_state,
+                    inventory, journal)
+
+
+def _ErrorRecord(site, error):
+    return {
+        'site_name': site['name'],
+        'site_url': site['url'],
+        'status': 'error',
+        'error': str(error),
+    }
+
+
+def ProvisionSiteBatch(analytics_service, tag_manager_service, sites, router, inventory, journal, limiter=None):
+    """
+    Provision a few manifest sites (up to BATCH_SIZE) together: their web
+    properties and containers site by site, then all their tags in batch HTTP
+    requests (see CreateOrGetTags), then their versions site by site. A
+    failing site gets an error record, the others go on.
+
+    Args:
+    analytics_service, tag_manager_service: authorized service objects.
+    sites: list of dicts with name, url and options keys.
+    router: AccountRouter choosing the accounts of every site.
+    inventory: Inventory shared by all sites.
+    journal: optional Journal, see ProvisionSite.
+    limiter: optional Tag Manager TokenBucket every batched call takes a token from.
+
+    Returns:
+    One result dict per site, in the order of sites.
+    """
+
+    results = {}
+    containers = {}
+    for site in sites:
+        done = journal.get(site['name'], 'done') if journal is not None else None
+        if done is not None:
+            results[site['name']] = done
+            continue
+        try:
+            account_id, property_index = router.route(site)
+            containers[site['name']] = _ProvisionContainer(analytics_service, tag_manager_service, site['name'],
+                                                           site['url'], account_id, inventory, property_index, journal)
+        except Exception as error:
+            results[site['name']] = _ErrorRecord(site, error)
+
+    tag_states = {}
+    pending = {}
+    for site in sites:
+        if site['name'] not in containers:
+            continue
+        tag_state = journal.get(site['name'], 'tag_state') if journal is not None else None
+        if tag_state is not None:
+            tag_states[site['name']] = tag_state
+        else:
+            tracking_id, account_id, container_id = containers[site['name']]
+            pending[site['name']] = (account_id, container_id, tracking_id,
+                                     (site.get('options') or {}).get('tag_name') or HELLO_WORLD_TAG_NAME)
+
+    tags = {}
+    if pending:
+        try:
+            tags = CreateOrGetTags(tag_manager_service, pending, inventory, limiter)
+        except Exception as error:
+            # e.g. the workspace of a container could not be looked up, the tags were not even requested
+            tags = {site_name: (None, error) for site_name in pending}
+
+    for site in sites:
+        if site['name'] not in pending:
+            continue
+        tag, error = tags[site['name']]
+        try:
+            if error is not None:
+                raise error
+            _, account_id, container_id = containers[site['name']]
+            tag_states[site['name']] = _Step(journal, site['name'], 'tag_state', lambda: _TagState(
+                tag_manager_service, account_id, container_id, tag))
+        except Exception as error:
+            results[site['name']] = _ErrorRecord(site, error)
+
+    for site in sites:
+        if site['name'] in results:
+            continue
+        tracking_id, account_id, container_id = containers[site['name']]
+        try:
+            results[site['name']] = _Publish(tag_manager_service, site['name'], site['url'], tracking_id, account_id,
+                                             container_id, tag_states[site['name']], inventory, journal)
+        except Exception as error:
+            results[site['name']] = _ErrorRecord(site, error)
+
+    return [results[site['name']] for site in sites]
+
+
+def _JournaledSites(sites, journal):
+    """
+    Split sites into the results the journal has for completed ones and the sites left to provision.
+    """
+
+    if journal is None:
+        return [], list(sites)
+
+    done, todo = [], []
+    for site in sites:
+        result = journal.get(site['name'], 'done')
+        if result is not None:
+            done.append(result)
+        else:
+            todo.append(site)
+    return done, todo
+
+
+def ProvisionSites(analytics_service, tag_manager_service, sites, inventory=None, journal=None, router=None):
+    """
+    Provision every site of a manifest reusing the same authorized services.
+
+    Args:
+    analytics_service: an authorized analytics v3 service object.
+    tag_manager_service: an authorized tagmanager service object.
+    sites: iterable of dicts with name, url and options keys.
+    inventory: Inventory shared by all sites. A memory only one is used if not given.
+    journal: optional Journal to resume an interrupted batch from.
+    router: AccountRouter choosing the accounts of every site. One following settings.ACCOUNT_ROUTING if not given.
+
+    Yields:
+    One result dict per site, BATCH_SIZE sites at a time: their tags are got
+    or created in batch requests, see ProvisionSiteBatch. A failing site yields
+    a record with status 'error' and does not stop the batch.
+    """
+
+    done, sites = _JournaledSites(sites, journal)
+    for result in done:
+        yield result
+    if not sites:
+        return
+
+    if inventory is None:
+        inventory = Inventory()
+
+    # List the accounts and index their containers and web properties once for the whole batch.
+    if router is None:
+        router = AccountRouter(analytics_service, tag_manager_service, inventory=inventory)
+
+    size = settings.BATCH_SIZE
+    for start in range(0, len(sites), size):
+        for result in ProvisionSiteBatch(analytics_service, tag_manager_service, sites[start:start + size], router,
+                                         inventory, journal):
+            yield result
+
+
+def ProvisionManifestSite(analytics_service, tag_manager_service, site, router, inventory, journal):
+    """
+    Provision one manifest site in the accounts the router picks, turning any failure into an error record.
+    """
+
+    try:
+        account_id, property_index = router.route(site)
+        return ProvisionSite(analytics_service, tag_manager_service, site['name'], site['url'],
+                             account_id=account_id, options=site.get('options'), inventory=inventory,
+                             property_index=property_index, journal=journal)
+    except Exception as error:
+        return _ErrorRecord(site, error)
+
+
+def ProvisionSitesConcurrently(sites, workers=None, inventory=None, journal=None, router=None):
+    """
+    Provision many sites in parallel with a bounded pool of worker threads.
+
+    Every worker thread builds its own services on its own httplib2.Http,
+    which is not thread-safe. All Analytics calls and all Tag Manager calls
+    of every worker share one token bucket per API so the pool stays within
+    the quotas set in settings.
+
+    Args:
+    sites: iterable of dicts with name, url and options keys.
+    workers: number of worker threads. Defaults to settings.PROVISIONING_WORKERS.
+    inventory: Inventory shared by all workers. A memory only one is used if not given.
+    journal: optional Journal to resume an interrupted batch from.
+    router: AccountRouter choosing the accounts of every site. One following settings.ACCOUNT_ROUTING if not given.
+
+    Yields:
+    One result dict per site, a batch of sites at a time in completion order.
+    Every worker provisions a batch of up to BATCH_SIZE sites (see
+    ProvisionSiteBatch), smaller batches keep every worker busy on short
+    manifests. Sites routed to different accounts are provisioned in parallel like the others.
+    """
+
+    done, sites = _JournaledSites(sites, journal)
+    for result in done:
+        yield result
+    if not sites:
+        return
+
+    if inventory is None:
+        inventory = Inventory()
+
+    analytics_limiter = TokenBucket(settings.ANALYTICS_QUERIES_PER_SECOND)
+    tag_manager_limiter = TokenBucket(settings.TAG_MANAGER_QUERIES_PER_SECOND)
+    local = threading.local()
+
+    def services():
+        if not hasattr(local, 'analytics_service'):
+            local.analytics_service = GetAnalyticsService(
+                'analytics', 'v3', settings.ANALYTICS_SCOPE, settings.GOOGLE_DEVELOPER_SECRET_KEY,
+                http=RateLimitedHttp(analytics_limiter))
+            local.tag_manager_service = GetService(
+                'tagmanager', settings.TAG_MANAGER_API_VERSION, settings.TAG_MANAGER_SCOPE,
+                settings.GOOGLE_DEVELOPER_SECRET_KEY, http=RateLimitedHttp(tag_manager_limiter))
+        return local.analytics_service, local.tag_manager_service
+
+    # Authorize once in the calling thread so an interactive auth flow never
+    # runs inside the pool, list the accounts and index their containers and web properties for the batch.
+    analytics_service, tag_manager_service = services()
+    if router is None:
+        router = AccountRouter(analytics_service, tag_manager_service, inventory=inventory)
+
+    def work(batch):
+        analytics_service, tag_manager_service = services()
+        return ProvisionSiteBatch(analytics_service, tag_manager_service, batch, router, inventory, journal,
+                                  tag_manager_limiter)
+
+    workers = workers or settings.PROVISIONING_WORKERS
+    size = max(1, min(settings.BATCH_SIZE, -(-len(sites) // workers)))
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = [pool.submit(work, sites[start:start + size]) for start in range(0, len(sites), size)]
+    try:
+        for future in as_completed(futures):
+            for result in future.result():
+                yield result
+    finally:
+        # caller stopped early, drop the sites not started yet
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
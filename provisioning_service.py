@@ -0,0 +1,454 @@
+"""
+Long-running provisioning service taking jobs from a local HTTP/JSON endpoint or an on-disk queue.
+"""
+from __future__ import print_function, unicode_literals
+import atexit
+import hmac
+import io
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson as json
+from accounts import AccountRouter
+from google_tag_manager_api import GetService
+from google_analytics_api import GetService as GetAnalyticsService
+from inventory import Inventory
+from manifest import ParseSite
+from metrics import METRICS
+from provisioning import ProvisionManifestSite
+from rate_limit import TokenBucket, RateLimitedHttp
+from snippets import GetTemplate, WriteSnippet
+import settings
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+
+# header of the HTTP requests carrying settings.SERVICE_TOKEN
+TOKEN_HEADER = 'X-Provisioning-Token'
+
+
+def _WriteJson(path, value):
+    # write then rename so a reader never sees half a file
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with io.open(tmp_path, 'w', encoding='utf-8') as json_file:
+        json_file.write(json.dumps(value))
+    os.rename(tmp_path, path)
+
+
+class JobQueue(object):
+    """
+    Durable queue of provisioning jobs in a folder, one JSON file per job.
+
+    Producers write a job to new/, the service moves it to processing/
+    while it runs and writes its result to done/ before removing it, every
+    move being an atomic rename. Jobs left in processing/ by a service that
+    died are queued again on start, so one service only may consume a folder.
+
+    A job file holds {"id": ..., "site": {"name": ..., "url": ..., other options}},
+    the site being a manifest record. Any process can queue one with put, or
+    by writing such a file elsewhere on the same filesystem and renaming it into new/.
+
+    Args:
+    path: the queue folder, created if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for folder in ('new', 'processing', 'done'):
+            if not os.path.isdir(os.path.join(path, folder)):
+                os.makedirs(os.path.join(path, folder))
+
+    def _Path(self, folder, job_id):
+        return os.path.join(self.path, folder, '%s.json' % job_id)
+
+    def put(self, site):
+        """
+        Queue a site record and return the ID of its job. Jobs run in the order they were queued.
+        """
+
+        job_id = '%.6f-%s' % (time.time(), uuid.uuid4().hex[:8])
+        tmp_path = os.path.join(self.path, '%s.json.tmp' % job_id)
+        with io.open(tmp_path, 'w', encoding='utf-8') as job_file:
+            job_file.write(json.dumps({'id': job_id, 'site': site}))
+        os.rename(tmp_path, self._Path('new', job_id))
+        return job_id
+
+    def claim(self, limit):
+        """
+        Move up to limit queued jobs to processing/ and return them as (job ID, site record) tuples.
+        A job file that is not valid JSON is returned with a None record.
+        """
+
+        jobs = []
+        for filename in sorted(os.listdir(os.path.join(self.path, 'new')))[:limit]:
+            if not filename.endswith('.json'):
+                continue
+            job_id = filename[:-len('.json')]
+            os.rename(self._Path('new', job_id), self._Path('processing', job_id))
+
+            try:
+                with io.open(self._Path('processing', job_id), 'r', encoding='utf-8') as job_file:
+                    site = json.load(job_file)['site']
+            except (ValueError, KeyError, TypeError):
+                site = None
+            jobs.append((job_id, site))
+        return jobs
+
+    def finish(self, job_id, result):
+        """
+        Record the result of a job in done/ and drop it from processing/.
+        """
+
+        _WriteJson(self._Path('done', job_id), result)
+        os.remove(self._Path('processing', job_id))
+
+    def result(self, job_id):
+        """
+        Return the result of a job, None while it is queued or running.
+        """
+
+        try:
+            with io.open(self._Path('done', job_id), 'r', encoding='utf-8') as result_file:
+                return json.load(result_file)
+        except (IOError, OSError):
+            return None
+
+    def recover(self):
+        """
+        Queue again the jobs a previous service left unfinished in processing/, return how many.
+        """
+
+        filenames = [filename for filename in os.listdir(os.path.join(self.path, 'processing'))
+                     if filename.endswith('.json')]
+        recovered = 0
+        for filename in filenames:
+            if os.path.exists(os.path.join(self.path, 'done', filename)):
+                # stopped between writing the result and dropping the job
+                os.remove(os.path.join(self.path, 'processing', filename))
+                continue
+            os.rename(os.path.join(self.path, 'processing', filename), os.path.join(self.path, 'new', filename))
+            recovered += 1
+        return recovered
+
+
+class ProvisioningService(object):
+    """
+    Provisions sites for as long as the process lives, keeping what a CLI
+    run pays for at every start: authorized services (one pair per worker
+    thread, sharing one token bucket per API), the inventory of listings,
+    the account router and the compiled snippet template. A site then costs
+    its API calls only.
+
+    Jobs for a site name already being provisioned are not run again, they
+    get the result of the running one.
+
+    Args:
+    workers: number of worker threads. Defaults to settings.PROVISIONING_WORKERS.
+    inventory: Inventory shared by all jobs. A memory only one is used if not given.
+    journal: optional Journal. Sites it has done are answered without any API call.
+    snippets_path: optional folder the code snippet of every provisioned site is written to.
+    """
+
+    def __init__(self, workers=None, inventory=None, journal=None, snippets_path=None):
+        self.workers = workers or settings.PROVISIONING_WORKERS
+        self.inventory = inventory if inventory is not None else Inventory()
+        self.journal = journal
+        self.snippets_path = snippets_path
+        self.template = GetTemplate()
+        self.mail = None
+        self.started = time.time()
+        self.counts = {'submitted': 0, 'deduplicated': 0, 'ok': 0, 'error': 0}
+
+        self._lock = threading.Lock()
+        # site name to the Future of its running job
+        self._jobs = {}
+        self._router = None
+        self._router_built = 0
+        self._router_lock = threading.Lock()
+
+        self._analytics_limiter = TokenBucket(settings.ANALYTICS_QUERIES_PER_SECOND)
+        self._tag_manager_limiter = TokenBucket(settings.TAG_MANAGER_QUERIES_PER_SECOND)
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+
+        # Authorize once in the calling thread so an interactive auth flow never
+        # runs inside the pool, and list the accounts before the first job.
+        self._Router(*self._Services())
+
+        if settings.SEND_CODE_SNIPPET_EMAIL:
+            from mailer import MailQueue
+            self.mail = MailQueue()
+
+    def _Services(self):
+        local = self._local
+        if not hasattr(local, 'analytics_service'):
+            local.analytics_service = GetAnalyticsService(
+                'analytics', 'v3', settings.ANALYTICS_SCOPE, settings.GOOGLE_DEVELOPER_SECRET_KEY,
+                http=RateLimitedHttp(self._analytics_limiter))
+            local.tag_manager_service = GetService(
+                'tagmanager', settings.TAG_MANAGER_API_VERSION, settings.TAG_MANAGER_SCOPE,
+                settings.GOOGLE_DEVELOPER_SECRET_KEY, http=RateLimitedHttp(self._tag_manager_limiter))
+        return local.analytics_service, local.tag_manager_service
+
+    def _Router(self, analytics_service, tag_manager_service):
+        """
+        Return the account router, built again once the listings it counted from are older than the inventory TTL.
+        """
+
+        with self._router_lock:
+            if self._router is None or time.time() - self._router_built > self.inventory.ttl:
+                self._router = AccountRouter(analytics_service, tag_manager_service, inventory=self.inventory)
+                self._router_built = time.time()
+            return self._router
+
+    def submit(self, site):
+        """
+        Queue the provisioning of a site, see ParseSite.
+
+        Returns:
+        A Future of the result dict of the site, see ProvisionSite, with the
+        rendered code snippet as 'snippet' when it was provisioned.
+        """
+
+        with self._lock:
+            self.counts['submitted'] += 1
+            future = self._jobs.get(site['name'])
+            if future is not None:
+                self.counts['deduplicated'] += 1
+                return future
+
+            future = self._pool.submit(self._Run, site)
+            self._jobs[site['name']] = future
+
+        future.add_done_callback(lambda done: self._Done(site['name'], done))
+        return future
+
+    def _Done(self, site_name, future):
+        with self._lock:
+            if self._jobs.get(site_name) is future:
+                del self._jobs[site_name]
+            self.counts['ok' if future.result()['status'] == 'ok' else 'error'] += 1
+
+    def _Run(self, site):
+        try:
+            analytics_service, tag_manager_service = self._Services()
+            router = self._Router(analytics_service, tag_manager_service)
+            result = ProvisionManifestSite(analytics_service, tag_manager_service, site, router, self.inventory,
+                                           self.journal)
+            if result['status'] != 'ok':
+                return result
+
+            # manifest options may set data_layer and the gtm_auth and gtm_preview environment parameters
+            options = site.get('options') or {}
+            snippet = self.template.render(result['public_id'], options.get('data_layer'), options)
+            result = dict(result, snippet=snippet)
+            if self.snippets_path:
+                result['snippet_path'] = WriteSnippet(self.snippets_path, result['public_id'], snippet)
+            if self.mail is not None:
+                self.mail.put(site['name'], snippet, options.get('email'))
+            return result
+
+        except Exception as error:
+            return {'site_name': site['name'], 'site_url': site['url'], 'status': 'error', 'error': str(error)}
+
+    def status(self):
+        """
+        Return the job counts, the sites being provisioned and the uptime in seconds.
+        """
+
+        with self._lock:
+            return dict(self.counts, running=sorted(self._jobs), workers=self.workers,
+                        uptime=round(time.time() - self.started, 1))
+
+    def watch(self, queue, stop, interval=None):
+        """
+        Run the jobs of a JobQueue until the stop Event is set, checking for
+        new ones every interval seconds (settings.SERVICE_QUEUE_POLL_INTERVAL).
+        At most twice as many jobs as workers are claimed at a time, the rest stay queued.
+        """
+
+        interval = settings.SERVICE_QUEUE_POLL_INTERVAL if interval is None else interval
+        recovered = queue.recover()
+        if recovered:
+            print('Queued again %s interrupted jobs' % recovered, file=sys.stderr)
+
+        claimed = set()
+        claimed_lock = threading.Lock()
+
+        def finish(job_id, result):
+            queue.finish(job_id, result)
+            with claimed_lock:
+                claimed.discard(job_id)
+
+        while not stop.is_set():
+            with claimed_lock:
+                limit = 2 * self.workers - len(claimed)
+            for job_id, record in queue.claim(max(0, limit)):
+                try:
+                    if record is None:
+                        raise Exception('Job %s: invalid JSON' % job_id)
+                    site = ParseSite(record, 'Job %s' % job_id)
+                except Exception as error:
+                    queue.finish(job_id, {'status': 'error', 'error': str(error)})
+                    continue
+
+                with claimed_lock:
+                    claimed.add(job_id)
+                self.submit(site).add_done_callback(lambda done, job_id=job_id: finish(job_id, done.result()))
+            stop.wait(interval)
+
+    def close(self):
+        """
+        Finish the running jobs, then deliver the queued emails and close the inventory and journal.
+        """
+
+        self._pool.shutdown(wait=True)
+        if self.mail is not None:
+            print('Sent %s code snippet emails' % self.mail.close(), file=sys.stderr)
+        self.inventory.close()
+        if self.journal is not None:
+            self.journal.close()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    POST /sites provisions the site of a JSON manifest record and answers
+    with its result once done. GET /status answers with service.status().
+
+    Requests sent by browsers (with an Origin header) are refused, so a web
+    page cannot reach the endpoint from the operator's machine, and so are
+    requests without the settings.SERVICE_TOKEN header when it is set.
+    """
+
+    service = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _Reply(self, status, response):
+        content = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _Refused(self):
+        """
+        Reply with an error and return True unless the request may be served.
+        """
+
+        if self.headers.get('Origin'):
+            self._Reply(403, {'status': 'error', 'error': 'Requests from browsers are not served'})
+            return True
+        if settings.SERVICE_TOKEN and not hmac.compare_digest(
+                (self.headers.get(TOKEN_HEADER) or '').encode('utf-8'), settings.SERVICE_TOKEN.encode('utf-8')):
+            self._Reply(401, {'status': 'error', 'error': 'Missing or invalid %s header' % TOKEN_HEADER})
+            return True
+        return False
+
+    def do_GET(self):
+        if self._Refused():
+            return
+        if urlsplit(self.path).path != '/status':
+            return self._Reply(404, {'error': 'Not found: %s' % self.path})
+        self._Reply(200, self.service.status())
+
+    def do_POST(self):
+        if self._Refused():
+            return
+        if urlsplit(self.path).path != '/sites':
+            return self._Reply(404, {'error': 'Not found: %s' % self.path})
+
+        # a form or text/plain body is what a cross-site request can send without a preflight
+        if (self.headers.get('Content-Type') or '').split(';')[0].strip().lower() != 'application/json':
+            return self._Reply(415, {'status': 'error', 'error': 'Content-Type must be application/json'})
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            site = ParseSite(json.loads(self.rfile.read(length).decode('utf-8')), 'Request')
+        except Exception as error:
+            return self._Reply(400, {'status': 'error', 'error': str(error)})
+
+        # snippets requested over HTTP only go to settings.RECEIVER_EMAIL
+        site['options'].pop('email', None)
+
+        result = self.service.submit(site).result()
+        self._Reply(200 if result['status'] == 'ok' else 502, result)
+
+
+def Serve(service, address=None, queue_path=None):
+    """
+    Serve provisioning jobs until SIGINT or SIGTERM, then finish the running ones and close the service.
+
+    Args:
+    service: the ProvisioningService running the jobs.
+    address: 'host:port' of the HTTP/JSON endpoint, not served if None. Keep it on
+      a local interface, and set settings.SERVICE_TOKEN to authenticate requests.
+    queue_path: folder of a JobQueue to take jobs from, not watched if None.
+    """
+
+    # the metrics log and StatsD socket outlive the service, until the process exits
+    atexit.register(METRICS.close)
+    stop = threading.Event()
+    server = None
+    threads = []
+
+    def shutdown(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, shutdown)
+
+    if address:
+        host, port = address.rsplit(':', 1)
+
+        class Handler(_Handler):
+            pass
+
+        Handler.service = service
+        server = _ThreadingHTTPServer((host, int(port)), Handler)
+        threads.append(threading.Thread(target=server.serve_forever, name='provisioning-http'))
+        print('Serving provisioning requests on http://%s:%s' % server.server_address[:2], file=sys.stderr)
+        if not settings.SERVICE_TOKEN:
+            print('SERVICE_TOKEN is not set, any local process can request provisioning', file=sys.stderr)
+
+    if queue_path:
+        threads.append(threading.Thread(target=service.watch, args=(JobQueue(queue_path), stop),
+                                        name='provisioning-queue'))
+        print('Taking provisioning jobs from %s' % queue_path, file=sys.stderr)
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while not stop.is_set():
+            stop.wait(1)
+    except KeyboardInterrupt:
+        stop.set()
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        for thread in threads:
+            thread.join()
+        service.close()
+
+    print('Provisioned %(ok)s sites, %(error)s failed, %(deduplicated)s duplicate requests' % service.counts,
+          file=sys.stderr)
+    return 0
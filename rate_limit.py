@@ -0,0 +1,69 @@
+"""
+Token bucket rate limiting for Google API calls shared between worker threads.
+"""
+import threading
+import time
+
+import httplib2
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket.
+
+    Args:
+    rate: tokens added per second, i.e. the sustained queries per second.
+    capacity: maximum burst size. Defaults to one second worth of tokens.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """
+        Take the requested number of tokens if available without blocking.
+
+        Returns:
+        0 if the tokens were taken, otherwise the seconds to wait before trying again.
+        """
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Block until the requested number of tokens is available and take them.
+        """
+
+        while True:
+            wait = self.reserve(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class RateLimitedHttp(httplib2.Http):
+    """
+    httplib2.Http that takes a token from the limiter before every request.
+    httplib2.Http is not thread-safe, every worker thread needs its own instance.
+    """
+
+    def __init__(self, limiter, *args, **kwargs):
+        super(RateLimitedHttp, self).__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    def request(self, *args, **kwargs):
+        self.limiter.acquire()
+        return super(RateLimitedHttp, self).request(*args, **kwargs)
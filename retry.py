@@ -0,0 +1,194 @@
+"""
+Retry Google API calls failing with transient errors, with exponential backoff and jitter.
+"""
+import random
+import socket
+import threading
+import time
+
+import httplib2
+from googleapiclient.http import HttpError
+import simplejson as json
+from metrics import METRICS
+import settings
+
+try:
+    from http.client import HTTPException
+except ImportError:
+    from httplib import HTTPException
+
+# 403 reasons Google APIs use for quota errors, as opposed to permission errors
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+# errors of the connection rather than of the API: DNS failures, resets, truncated or garbled responses
+TRANSPORT_ERRORS = (socket.error, httplib2.ServerNotFoundError, HTTPException)
+
+
+class RetryStats(object):
+    """
+    Thread-safe counters of what retries cost: calls made, retries per
+    status and seconds spent sleeping before retrying.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.retries = 0
+            self.failures = 0
+            self.sleep_seconds = 0.0
+            self.retries_by_status = {}
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def record_retry(self, status, delay):
+        with self._lock:
+            self.retries += 1
+            self.sleep_seconds += delay
+            self.retries_by_status[status] = self.retries_by_status.get(status, 0) + 1
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'retries': self.retries,
+                'failures': self.failures,
+                'sleep_seconds': round(self.sleep_seconds, 3),
+                'retries_by_status': dict(self.retries_by_status),
+            }
+
+
+class RetryPolicy(object):
+    """
+    When and how long to wait before retrying a failed call.
+
+    Args:
+    max_attempts: attempts in total, including the first one.
+    base_delay: seconds to wait before the first retry, doubled every retry.
+    max_delay: upper bound of a single wait.
+    jitter: wait a random time between 0 and the backoff delay (full jitter)
+      so concurrent workers do not retry in lockstep.
+    statuses: HTTP statuses retried. 403 is retried only for quota reasons.
+    """
+
+    def __init__(self, max_attempts=None, base_delay=None, max_delay=None, jitter=True,
+                 statuses=(403, 429, 500, 502, 503, 504)):
+        self.max_attempts = max_attempts or settings.RETRY_MAX_ATTEMPTS
+        self.base_delay = settings.RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = settings.RETRY_MAX_DELAY if max_delay is None else max_delay
+        self.jitter = jitter
+        self.statuses = statuses
+
+    def is_retryable(self, error, idempotent=True):
+        """
+        Whether the error is worth another attempt. A call that is not
+        idempotent (create, insert) may have been done despite a 5xx or a
+        dropped connection, it is only retried when the server refused it
+        for quota (429 or 403 quota reasons).
+        """
+
+        if isinstance(error, TRANSPORT_ERRORS):
+            return idempotent
+
+        if not isinstance(error, HttpError):
+            return False
+
+        status = error.resp.status
+        if status not in self.statuses:
+            return False
+
+        if not idempotent and status not in (403, 429):
+            return False
+
+        if status == 403:
+            try:
+                errors = json.loads(error.content)['error']['errors']
+            except (ValueError, KeyError, TypeError):
+                return False
+            return any(item.get('reason') in RATE_LIMIT_REASONS for item in errors)
+
+        return True
+
+    def delay(self, attempt, error=None):
+        """
+        Seconds to wait before retry number attempt (starting at 1).
+        A Retry-After header in seconds takes precedence over the backoff.
+        """
+
+        retry_after = getattr(getattr(error, 'resp', None), 'get', lambda key: None)('retry-after')
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_delay)
+            except ValueError:
+                pass
+
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+DEFAULT_POLICY = RetryPolicy()
+STATS = RetryStats()
+
+
+def Execute(request, idempotent=True, policy=None, stats=None):
+    """
+    Execute an HttpRequest (or BatchHttpRequest), retrying transient errors
+    according to the policy. The last error is raised once attempts are exhausted.
+
+    Args:
+    request: the request to execute.
+    idempotent: False for create and insert calls, see RetryPolicy.is_retryable.
+    policy: RetryPolicy, DEFAULT_POLICY if not given.
+    stats: RetryStats to record into, the process-wide STATS if not given.
+
+    Returns:
+    The response of the request.
+    """
+
+    policy = policy or DEFAULT_POLICY
+    stats = stats or STATS
+    attempt = 1
+
+    # batch requests have no method ID and no response callbacks
+    method = getattr(request, 'methodId', None) or 'batch'
+    sent = len(getattr(request, 'body', None) or '')
+    responses = []
+    if hasattr(request, 'add_response_callback'):
+        request.add_response_callback(responses.append)
+
+    while True:
+        stats.record_call()
+        start = time.time()
+        try:
+            response = request.execute()
+            received = int(responses[-1].get('content-length', 0)) if responses else 0
+            METRICS.record_request(method, responses[-1].status if responses else 200, time.time() - start, sent,
+                                   received)
+            return response
+        except (HttpError,) + TRANSPORT_ERRORS as error:
+            if isinstance(error, HttpError):
+                METRICS.record_request(method, error.resp.status, time.time() - start, sent, len(error.content or ''))
+            else:
+                METRICS.record_request(method, 'socket', time.time() - start, sent)
+
+            if attempt >= policy.max_attempts or not policy.is_retryable(error, idempotent):
+                stats.record_failure()
+                raise
+
+            delay = policy.delay(attempt, error)
+            status = error.resp.status if isinstance(error, HttpError) else 'socket'
+            stats.record_retry(status, delay)
+            METRICS.record_retry(method, status, delay)
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,161 @@
+"""
+Process-wide factory of authorized Google API service objects.
+"""
+from __future__ import print_function
+import os
+import threading
+
+import httplib2
+from googleapiclient.discovery import build_from_document, DISCOVERY_URI
+import settings
+
+_lock = threading.RLock()
+_credentials = {}
+_services = {}
+
+
+def GetCredentials(api_name, scope, client_secrets_path):
+    """
+    Get credentials for the auth scopes once per process.
+
+    With settings.AUTH_MODE 'service_account' they are the service account
+    of settings.SERVICE_ACCOUNT_KEY, acting as settings.DELEGATED_USER when
+    set, and no browser is ever needed. Otherwise they are loaded from the
+    api_name.dat Storage file. If the credentials don't exist or are invalid run
+    through the native client flow. The Storage object will ensure that if
+    successful the good credentials will get written back to a file.
+
+    Either way their access tokens are kept in the settings.TOKEN_CACHE_PATH
+    file shared by every process, see auth.SharedTokenStorage.
+    """
+
+    key = (api_name, tuple(scope), client_secrets_path)
+    with _lock:
+        if key in _credentials:
+            return _credentials[key]
+
+        # oauth2client and its crypto stack are only loaded when authorizing
+        import auth
+
+        if settings.AUTH_MODE == 'service_account':
+            credentials = auth.GetServiceAccountCredentials(scope)
+            _credentials[key] = auth.ShareTokens(credentials, '%s:%s:%s' % (
+                api_name, settings.DELEGATED_USER or credentials.service_account_email, ' '.join(scope)))
+            return _credentials[key]
+
+        if settings.AUTH_MODE != 'installed':
+            raise Exception('Improperly configured settings: unknown AUTH_MODE %s' % settings.AUTH_MODE)
+
+        import argparse
+        from oauth2client import client
+        from oauth2client import file
+        from oauth2client import tools
+
+        storage = file.Storage(api_name + '.dat')
+        credentials = storage.get()
+
+        if credentials is None or credentials.invalid:
+            # Parse command-line arguments, only the auth flow needs them.
+            parser = argparse.ArgumentParser(
+                formatter_class=argparse.RawDescriptionHelpFormatter,
+                parents=[tools.argparser])
+            flags = parser.parse_args([])
+
+            # Set up a Flow object to be used if we need to authenticate.
+            flow = client.flow_from_clientsecrets(
+                client_secrets_path, scope=scope,
+                message=tools.message_if_missing(client_secrets_path))
+            credentials = tools.run_flow(flow, storage, flags)
+
+        _credentials[key] = auth.ShareTokens(credentials, '%s:%s' % (api_name, ' '.join(scope)), storage=storage)
+        return credentials
+
+
+def GetDiscoveryDocument(api_name, api_version):
+    """
+    Return the discovery document of an API version, read from
+    settings.DISCOVERY_CACHE_DIR. It is fetched and written there only the
+    first time, later runs start without any discovery request.
+    """
+
+    if settings.API_ROOT_URL:
+        # a local stand-in of the APIs serves its own documents, they are not cached
+        uri = '%s/discovery/v1/apis/%s/%s/rest' % (settings.API_ROOT_URL, api_name, api_version)
+        response, content = httplib2.Http().request(uri)
+        if response.status >= 400:
+            raise Exception('Could not fetch discovery document for %s %s : %s : %s' % (
+                api_name, api_version, response.status, response.reason))
+        return content.decode('utf-8') if isinstance(content, bytes) else content
+
+    path = os.path.join(settings.DISCOVERY_CACHE_DIR, '%s.%s.json' % (api_name, api_version))
+    if os.path.exists(path):
+        with open(path, 'r') as document:
+            return document.read()
+
+    uri = DISCOVERY_URI.replace('{api}', api_name).replace('{apiVersion}', api_version)
+    response, content = httplib2.Http().request(uri)
+    if response.status >= 400:
+        raise Exception('Could not fetch discovery document for %s %s : %s : %s' % (
+            api_name, api_version, response.status, response.reason))
+
+    content = content.decode('utf-8') if isinstance(content, bytes) else content
+    if not os.path.isdir(settings.DISCOVERY_CACHE_DIR):
+        os.makedirs(settings.DISCOVERY_CACHE_DIR)
+
+    # write then rename so a concurrent reader never sees half a document
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as document:
+        document.write(content)
+    os.rename(tmp_path, path)
+    return content
+
+
+def GetService(api_name, api_version, scope, client_secrets_path, http=None):
+    """
+    Get a service that communicates to a Google API.
+
+    Args:
+    api_name: string The name of the api to connect to.
+    api_version: string The api version to connect to.
+    scope: A list of strings representing the auth scopes to authorize for the
+      connection.
+    client_secrets_path: string A path to a valid client secrets file.
+    http: httplib2.Http to authorize. httplib2.Http is not thread-safe, worker
+      threads pass their own and get a new service object on it.
+
+    Returns:
+    A service that is connected to the specified API. Without http the
+    service is built once per process and (api, version, scope) and reuses
+    one authorized keep-alive connection pool.
+    """
+
+    key = (api_name, api_version, tuple(scope))
+    with _lock:
+        if http is None and key in _services:
+            return _services[key]
+
+        print('Connecting to %s %s service...' % (api_name, api_version))
+
+        if settings.API_ROOT_URL:
+            # a local stand-in of the APIs takes unauthenticated requests
+            authorized_http = http or httplib2.Http()
+        else:
+            from auth import AuthorizeHttp
+            credentials = GetCredentials(api_name, scope, client_secrets_path)
+            authorized_http = AuthorizeHttp(credentials, http or httplib2.Http())
+
+        # Build the service object without a discovery request.
+        service = build_from_document(GetDiscoveryDocument(api_name, api_version), http=authorized_http)
+
+        if http is None:
+            _services[key] = service
+        return service
+
+
+def ClearServices():
+    """
+    Forget the service objects built so far, the next GetService builds new ones.
+    """
+
+    with _lock:
+        _services.clear()
@@ -12,6 +12,11 @@ SMTP_EMAIL = ''  # example.gmail.com
 SMTP_PASSWORD = ''  # ksj*)9900sdf
 SMTP_HOST = ''  # smtp.gmail.com
 SMTP_PORT = ''  # 587
+# upgrade the SMTP connection with STARTTLS, sending fails if the server does not offer it. Always on with SMTP_EMAIL
+SMTP_STARTTLS = True
+
+# batch runs send one email per recipient listing all its snippets instead of one email per site
+EMAIL_DIGEST = False
 
 # enable/disable error traceback
 DUBUG = False
@@ -22,6 +27,111 @@ DUBUG = False
 
 GOOGLE_DEVELOPER_SECRET_KEY = os.path.join('secrets', 'google_developer_secret.json')
 
+# 'installed' authorizes a user once in the browser (tokens kept in <api>.dat files),
+# 'service_account' authorizes the SERVICE_ACCOUNT_KEY service account, for headless workers
+AUTH_MODE = 'installed'
+SERVICE_ACCOUNT_KEY = os.path.join('secrets', 'service_account.json')
+# user the service account acts as with G Suite domain-wide delegation, None acts as the service account itself
+DELEGATED_USER = None
+# access tokens shared by every process of the host, refreshed by one of them only. None keeps them per process
+TOKEN_CACHE_PATH = 'token_cache.json'
+# seconds before expiry a token is refreshed, so no request is sent with an expired one
+TOKEN_REFRESH_MARGIN = 300
+
+# discovery documents are fetched once and cached in this folder
+DISCOVERY_CACHE_DIR = 'discovery_cache'
+
+# root URL of a local stand-in of the Google APIs (see fake_api.py), None talks to Google
+API_ROOT_URL = None
+
+# Tag Manager API version, v2 stages changes in a workspace, v1 is deprecated
+TAG_MANAGER_API_VERSION = 'v2'
+# v2 workspace changes are staged in, created if the container has no workspace
+TAG_MANAGER_WORKSPACE = 'Default Workspace'
+
+# auth scopes to request
+TAG_MANAGER_SCOPE = [
+    'https://www.googleapis.com/auth/tagmanager.edit.containers',
+    'https://www.googleapis.com/auth/tagmanager.edit.containerversions',
+    'https://www.googleapis.com/auth/tagmanager.publish'
+]
+ANALYTICS_SCOPE = ['https://www.googleapis.com/auth/analytics.edit']
+
+# account of every new site of a batch: 'first' fills the accounts in order, 'hash' spreads sites by a stable hash
+# of their name, 'least_loaded' picks the account with the fewest containers or web properties
+ACCOUNT_ROUTING = 'first'
+# IDs of the accounts batches provision into, every account of the credentials if empty
+TAG_MANAGER_ACCOUNTS = []
+ANALYTICS_ACCOUNTS = []
+# containers or web properties an account takes before new sites go to another one, None for no limit:
+# the API rejects the creates past its own quotas
+TAG_MANAGER_ACCOUNT_CONTAINER_LIMIT = None
+ANALYTICS_ACCOUNT_PROPERTY_LIMIT = None
+
+# number of sites provisioned in parallel by batch runs with --workers
+PROVISIONING_WORKERS = 4
+
+# sustained API queries per second shared by all workers, keep them below your project quotas
+ANALYTICS_QUERIES_PER_SECOND = 10
+TAG_MANAGER_QUERIES_PER_SECOND = 0.25
+
+# retry of API calls failing with 429, 5xx or quota errors: attempts in total,
+# seconds before the first retry (doubled every retry, randomized) and longest wait
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+# calls grouped in one batch HTTP request, Google APIs accept up to 1000
+BATCH_SIZE = 100
+
+# JSONL file every API request and step is logged to, None disables it
+METRICS_LOG_PATH = None
+# 'host:port' of a StatsD server to send metrics to, None disables it
+STATSD_ADDRESS = None
+# Prometheus text file written at the end of a run (node exporter textfile collector), None disables it
+METRICS_PROMETHEUS_PATH = None
+# prefix of metric names
+METRICS_PREFIX = 'gtm_provisioning'
+
+# keep-alive connections pooled by each asyncio client (async_client.py)
+ASYNC_CONNECTIONS = 100
+
+# seconds cached web property, container and tag listings stay valid
+INVENTORY_TTL = 600
+# SQLite file keeping those listings between runs, None keeps them in memory only
+INVENTORY_PATH = None
+
+# JSONL journal of completed provisioning steps, reruns skip what it records. None disables it
+JOURNAL_PATH = None
+
+# gzipped JSONL snapshot written by index.py --export, existing resources are looked up in it when set
+SNAPSHOT_PATH = None
+
+# index.py --serve: 'host:port' of the HTTP/JSON endpoint taking provisioning requests, keep it on a local interface
+SERVICE_ADDRESS = '127.0.0.1:8080'
+# shared secret HTTP requests must send in the X-Provisioning-Token header, None accepts any local request
+SERVICE_TOKEN = None
+# folder of the durable job queue index.py --serve takes jobs from, None disables it
+SERVICE_QUEUE_PATH = None
+# seconds between checks of the job queue for new jobs
+SERVICE_QUEUE_POLL_INTERVAL = 1
+
+# notes of the containers this tool creates, index.py --gc only ever deletes containers carrying them
+MANAGED_CONTAINER_NOTES = 'Created by gtm provisioning (index.py), index.py --gc may delete it'
+# index.py --gc: Tag Manager accounts whose containers missing from the manifest may be deleted, none if empty
+GC_CONTAINER_ACCOUNTS = []
+# index.py --gc: containers and paused tags unchanged for this many days are stale, 0 for any age
+GC_MAX_AGE_DAYS = 90
+# container versions kept besides the published one, older ones are stale
+GC_KEEP_VERSIONS = 10
+
+# code snippet template, read and compiled once per process
+SNIPPET_TEMPLATE = os.path.join('code_snippet', 'gtm_backup.txt')
+# folder rendered snippets are written to, one gtm-<public id>.txt file per container
+SNIPPET_DIR = 'code_snippet'
+# name of the dataLayer variable of the snippets, sites may set their own with a data_layer option
+SNIPPET_DATA_LAYER = 'dataLayer'
+
 
 TIME_ZONE_COUNTRY_ID = 'US'
 TIME_ZONE_ID = 'America/Los_Angeles'
@@ -0,0 +1,280 @@
+"""
+Export the configuration of every Tag Manager and Analytics account to a compressed local snapshot.
+"""
+from __future__ import print_function, unicode_literals
+import gzip
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson as json
+from batching import BatchExecutor
+from container_sync import FetchLiveState
+from google_tag_manager_api import (IterAccounts, IterContainers, GetService, IsV2, ContainerPath, ChooseWorkspace,
+                                    SetWorkspacePath)
+from google_analytics_api import (IterAccounts as IterAnalyticsAccounts, IterWebProperties,
+                                  GetService as GetAnalyticsService)
+from rate_limit import TokenBucket, RateLimitedHttp
+import settings
+
+# bumped when the record layout changes, older snapshots are then refetched in full
+SNAPSHOT_VERSION = 2
+
+CONTAINER_FIELDS = 'accountId,containerId,name,publicId,fingerprint'
+WEB_PROPERTY_FIELDS = 'accountId,id,name,websiteUrl'
+
+
+class Snapshot(object):
+    """
+    Point-in-time copy of the Tag Manager accounts, containers with their
+    tags, triggers and variables, and of the Analytics accounts and web properties.
+
+    Stored as a gzipped JSONL file: a header line, then one line per
+    account, container (with its resources) and web property. In v2 container
+    lines keep the fingerprint of the workspace the resources were read from
+    as workspaceFingerprint, the next export only refetches the resources of
+    containers whose workspace changed.
+
+    Args:
+    created: time of the export, in seconds since the epoch.
+    api_version: Tag Manager API version the resources were read with.
+    """
+
+    def __init__(self, created=None, api_version=None):
+        self.created = time.time() if created is None else created
+        self.api_version = api_version or settings.TAG_MANAGER_API_VERSION
+        self.tag_manager_accounts = []
+        # (account ID, container ID) to container record
+        self.containers = {}
+        self.analytics_accounts = []
+        # account ID to list of web properties
+        self.web_properties = {}
+
+    @staticmethod
+    def read(path):
+        """
+        Load a snapshot file, None if it does not exist or has another layout version.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        snapshot = None
+        with gzip.open(path, 'rb') as snapshot_file:
+            for line in snapshot_file:
+                record = json.loads(line.decode('utf-8'))
+                record_type = record.pop('type')
+
+                if record_type == 'snapshot':
+                    if record.get('version') != SNAPSHOT_VERSION:
+                        return None
+                    snapshot = Snapshot(record['created'], record['api_version'])
+                elif snapshot is None:
+                    raise Exception('Snapshot %s: no header line' % path)
+                elif record_type == 'tagmanager_account':
+                    snapshot.tag_manager_accounts.append(record)
+                elif record_type == 'container':
+                    snapshot.containers[(record['accountId'], record['containerId'])] = record
+                elif record_type == 'analytics_account':
+                    snapshot.analytics_accounts.append(record)
+                elif record_type == 'webproperty':
+                    snapshot.web_properties.setdefault(record['accountId'], []).append(record)
+        return snapshot
+
+    def records(self):
+        """
+        Yield the lines of the snapshot file as dicts, in a stable order.
+        """
+
+        yield {'type': 'snapshot', 'version': SNAPSHOT_VERSION, 'created': self.created,
+               'api_version': self.api_version}
+        for account in self.tag_manager_accounts:
+            yield dict(account, type='tagmanager_account')
+        for key in sorted(self.containers):
+            yield dict(self.containers[key], type='container')
+        for account in self.analytics_accounts:
+            yield dict(account, type='analytics_account')
+        for account_id in sorted(self.web_properties):
+            for web_property in self.web_properties[account_id]:
+                yield dict(web_property, type='webproperty')
+
+    def write(self, path):
+        """
+        Write the snapshot to path, atomically so readers never see half of it.
+        """
+
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with gzip.open(tmp_path, 'wb') as snapshot_file:
+            for record in self.records():
+                snapshot_file.write((json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+        os.rename(tmp_path, path)
+
+    def seed(self, inventory):
+        """
+        Fill an Inventory with the listings of the snapshot, so provisioning
+        looks containers, tags and web properties up in it instead of the live
+        API. Listings are dated from the export and expire with the inventory
+        TTL, newer ones already in the inventory are kept. A name missing from
+        a seeded listing is looked up live before it is created, see Inventory.seed.
+        """
+
+        containers = {}
+        for (account_id, container_id), container in self.containers.items():
+            containers.setdefault(account_id, {})[container['name']] = (container_id, container.get('publicId'))
+            inventory.seed('tags', '%s/%s' % (account_id, container_id),
+                           {tag.get('name'): tag.get('tagId') for tag in container.get('tags', [])}, self.created)
+        for account in self.tag_manager_accounts:
+            inventory.seed('containers', account['accountId'], containers.get(account['accountId'], {}), self.created)
+
+        if self.analytics_accounts:
+            inventory.seed('analytics_accounts', 'me', {'first': self.analytics_accounts[0]['id']}, self.created)
+        for account in self.analytics_accounts:
+            inventory.seed('webproperties', account['id'], {
+                web_property.get('name'): (web_property.get('id'), web_property.get('websiteUrl'))
+                for web_property in self.web_properties.get(account['id'], [])
+            }, self.created)
+
+
+def _Chunks(items, size):
+    items = list(items)
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+
+def ExportSnapshot(path, workers=None, refresh=True):
+    """
+    Export every account the credentials can read to a snapshot file.
+
+    Accounts are listed first, then the containers and web properties of
+    every account, then the tags, triggers and variables of the containers
+    in batch requests of BATCH_SIZE calls, all spread over a pool of worker
+    threads sharing one token bucket per API.
+
+    Args:
+    path: the snapshot file, gzipped JSONL.
+    workers: number of worker threads. Defaults to settings.PROVISIONING_WORKERS.
+    refresh: reuse the resources of containers whose workspace fingerprint did
+      not change since the snapshot already at path. False refetches everything.
+      v1 has no fingerprint of the draft a container's resources are read from,
+      v1 exports always refetch everything.
+
+    Returns:
+    A (Snapshot, stats dict) tuple, stats counts accounts, containers,
+    containers fetched and reused, and web properties.
+    """
+
+    previous = Snapshot.read(path) if refresh else None
+    if previous is not None and previous.api_version != settings.TAG_MANAGER_API_VERSION:
+        # v1 and v2 resources differ, they cannot be mixed in one snapshot
+        previous = None
+
+    analytics_limiter = TokenBucket(settings.ANALYTICS_QUERIES_PER_SECOND)
+    tag_manager_limiter = TokenBucket(settings.TAG_MANAGER_QUERIES_PER_SECOND)
+    local = threading.local()
+
+    def services():
+        if not hasattr(local, 'analytics_service'):
+            local.analytics_service = GetAnalyticsService(
+                'analytics', 'v3', settings.ANALYTICS_SCOPE, settings.GOOGLE_DEVELOPER_SECRET_KEY,
+                http=RateLimitedHttp(analytics_limiter))
+            local.tag_manager_service = GetService(
+                'tagmanager', settings.TAG_MANAGER_API_VERSION, settings.TAG_MANAGER_SCOPE,
+                settings.GOOGLE_DEVELOPER_SECRET_KEY, http=RateLimitedHttp(tag_manager_limiter))
+        return local.analytics_service, local.tag_manager_service
+
+    # Authorize once in the calling thread so an interactive auth flow never runs inside the pool.
+    analytics_service, tag_manager_service = services()
+    snapshot = Snapshot()
+    snapshot.tag_manager_accounts = list(IterAccounts(tag_manager_service, fields='accountId,name'))
+    snapshot.analytics_accounts = list(IterAnalyticsAccounts(analytics_service, fields='id,name'))
+
+    def list_containers(account_id):
+        return [dict(container, accountId=account_id)
+                for container in IterContainers(services()[1], account_id, fields=CONTAINER_FIELDS)]
+
+    def list_web_properties(account_id):
+        return [dict(web_property, accountId=account_id)
+                for web_property in IterWebProperties(services()[0], account_id, fields=WEB_PROPERTY_FIELDS)]
+
+    def read_workspaces(account_id, containers):
+        # one workspace listing per container, in batch requests
+        service = services()[1]
+        batch = BatchExecutor(service)
+        for container in containers:
+            batch.add(container['containerId'], service.accounts().containers().workspaces().list(
+                parent=ContainerPath(account_id, container['containerId']),
+                fields='workspace(workspaceId,name,path,fingerprint)'))
+        responses = batch.execute()
+
+        for container in containers:
+            response, error = responses[container['containerId']]
+            if error is not None:
+                raise Exception('Container %s: %s' % (container['name'], error))
+            workspace = ChooseWorkspace(response.get('workspace', []))
+            if workspace is not None:
+                # the resources are then read from it without listing the workspaces again
+                SetWorkspacePath(account_id, container['containerId'], workspace.get('path'))
+                container['workspaceFingerprint'] = workspace.get('fingerprint')
+
+    def fetch_containers(account_id, containers):
+        state = FetchLiveState(services()[1], account_id, {
+            container['name']: container['containerId'] for container in containers
+        })
+        for container in containers:
+            resources, error = state[container['name']]
+            if error is not None:
+                raise Exception('Container %s: %s' % (container['name'], error))
+            for kind, items in resources.items():
+                container[kind] = [items[name] for name in sorted(items)]
+
+    pool = ThreadPoolExecutor(max_workers=workers or settings.PROVISIONING_WORKERS)
+    try:
+        container_listings = [(account['accountId'], pool.submit(list_containers, account['accountId']))
+                              for account in snapshot.tag_manager_accounts]
+        web_property_listings = [(account['id'], pool.submit(list_web_properties, account['id']))
+                                 for account in snapshot.analytics_accounts]
+
+        listed = [(account_id, future.result()) for account_id, future in container_listings]
+        if IsV2(tag_manager_service):
+            # read before the resources, a change made meanwhile is refetched by the next export
+            lookups = [pool.submit(read_workspaces, account_id, chunk)
+                       for account_id, containers in listed for chunk in _Chunks(containers, settings.BATCH_SIZE)]
+            for future in lookups:
+                future.result()
+
+        changed = {}
+        for account_id, containers in listed:
+            for container in containers:
+                key = (account_id, container['containerId'])
+                cached = previous.containers.get(key) if previous is not None else None
+                if (cached is not None and container.get('workspaceFingerprint') and
+                        cached.get('workspaceFingerprint') == container['workspaceFingerprint']):
+                    # the resources are unchanged, the container itself may have been renamed
+                    snapshot.containers[key] = dict(cached, **container)
+                else:
+                    snapshot.containers[key] = container
+                    changed.setdefault(account_id, []).append(container)
+
+        # every container costs one list call per kind in the batch
+        chunk_size = max(1, settings.BATCH_SIZE // 3)
+        fetches = [pool.submit(fetch_containers, account_id, chunk)
+                   for account_id, containers in changed.items() for chunk in _Chunks(containers, chunk_size)]
+
+        for account_id, future in web_property_listings:
+            snapshot.web_properties[account_id] = future.result()
+        for future in fetches:
+            future.result()
+    finally:
+        pool.shutdown(wait=True)
+
+    snapshot.write(path)
+
+    fetched = sum(len(containers) for containers in changed.values())
+    return snapshot, {
+        'tagmanager_accounts': len(snapshot.tag_manager_accounts),
+        'containers': len(snapshot.containers),
+        'containers_fetched': fetched,
+        'containers_reused': len(snapshot.containers) - fetched,
+        'analytics_accounts': len(snapshot.analytics_accounts),
+        'web_properties': sum(len(properties) for properties in snapshot.web_properties.values()),
+    }
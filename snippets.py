@@ -0,0 +1,146 @@
+"""
+Render Google Tag Manager code snippets from a template compiled once per process.
+"""
+from __future__ import print_function, unicode_literals
+import io
+import os
+import re
+import threading
+
+import settings
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+# {{name}} placeholders of the template
+PLACEHOLDER = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+# dataLayer names are JavaScript identifiers, the snippet quotes them in a script
+DATA_LAYER_NAME = re.compile(r'^[A-Za-z_$][A-Za-z0-9_$]*$')
+
+_lock = threading.Lock()
+_templates = {}
+
+
+def _Compile(text):
+    """
+    Split a template into its literal parts and placeholder names once:
+    re.split leaves literals at even and names at odd indexes.
+    """
+
+    return PLACEHOLDER.split(text)
+
+
+def CheckDataLayer(data_layer):
+    """
+    Raise if data_layer is not a JavaScript identifier, e.g. a name with a quote that would break out of the snippet.
+    """
+
+    if not DATA_LAYER_NAME.match(data_layer or ''):
+        raise Exception('Invalid data_layer %r: it must be a JavaScript identifier' % (data_layer,))
+
+
+def _Render(parts, values):
+    output = list(parts)
+    for index in range(1, len(output), 2):
+        output[index] = values[output[index]]
+    return ''.join(output)
+
+
+class SnippetTemplate(object):
+    """
+    A code snippet template read and compiled once, then rendered for as many
+    containers as needed without reading the file or running a regex again.
+    Rendering only builds strings, it is thread-safe.
+
+    Placeholders are container_id, data_layer and the environment parameters
+    environment_js (JavaScript string concatenation) and environment_query
+    (URL query string escaped for an HTML attribute), both empty when no
+    environment is given.
+
+    Args:
+    text: the template text.
+    """
+
+    def __init__(self, text):
+        self._parts = _Compile(text)
+
+    @staticmethod
+    def values(container_id, data_layer=None, environment=None):
+        """
+        Return the placeholder values for a container.
+
+        Args:
+        container_id: the public ID of the container, e.g. GTM-XXXXXX.
+        data_layer: name of the dataLayer variable, a JavaScript identifier. Defaults to settings.SNIPPET_DATA_LAYER.
+        environment: optional dict of Tag Manager environment parameters,
+          gtm_auth and gtm_preview, gtm_cookies_win defaults to x.
+        """
+
+        data_layer = data_layer or settings.SNIPPET_DATA_LAYER
+        CheckDataLayer(data_layer)
+
+        query = ''
+        if environment and environment.get('gtm_auth'):
+            query = '&' + urlencode([
+                ('gtm_auth', environment['gtm_auth']),
+                ('gtm_preview', environment.get('gtm_preview', '')),
+                ('gtm_cookies_win', environment.get('gtm_cookies_win', 'x')),
+            ])
+
+        return {
+            'container_id': container_id,
+            'data_layer': data_layer,
+            'environment_js': "+ '%s'" % query if query else '',
+            # the noscript iframe src is an HTML attribute
+            'environment_query': query.replace('&', '&amp;'),
+        }
+
+    def render(self, container_id, data_layer=None, environment=None):
+        """
+        Return the whole snippet text for a container, see values for the arguments.
+        """
+
+        return _Render(self._parts, self.values(container_id, data_layer, environment))
+
+
+def GetTemplate(path=None):
+    """
+    Return the SnippetTemplate of a template file, read and compiled the
+    first time only. Defaults to settings.SNIPPET_TEMPLATE.
+    """
+
+    path = path or settings.SNIPPET_TEMPLATE
+    with _lock:
+        if path not in _templates:
+            with io.open(path, 'r', encoding='utf-8') as template:
+                _templates[path] = SnippetTemplate(template.read())
+        return _templates[path]
+
+
+def SnippetPath(directory, public_id):
+    """
+    Return the file a container snippet is written to, one per container so
+    concurrent sites never overwrite each other.
+    """
+
+    return os.path.join(directory, 'gtm-%s.txt' % public_id)
+
+
+def WriteSnippet(directory, public_id, snippet):
+    """
+    Write a rendered snippet to its own file in directory and return the path.
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    path = SnippetPath(directory, public_id)
+    # write then rename so a reader never sees half a snippet
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with io.open(tmp_path, 'w', encoding='utf-8') as snippet_file:
+        snippet_file.write(snippet)
+    os.rename(tmp_path, path)
+    return path
@@ -0,0 +1,192 @@
+"""
+Tests of the stale rules and deletions of cleanup.py against fake_api.py, run with python -m unittest test_cleanup.
+"""
+from __future__ import print_function, unicode_literals
+import socket
+import time
+import unittest
+
+import cleanup
+import google_tag_manager_api
+import services
+import settings
+from fake_api import FakeGoogleApis
+from google_analytics_api import GetService as GetAnalyticsService
+from provisioning import ProvisionSites
+
+DAY = 86400
+
+
+class CleanupTest(unittest.TestCase):
+
+    api_version = 'v2'
+
+    def setUp(self):
+        self.settings = {name: getattr(settings, name) for name in (
+            'API_ROOT_URL', 'TAG_MANAGER_API_VERSION', 'TAG_MANAGER_QUERIES_PER_SECOND',
+            'ANALYTICS_QUERIES_PER_SECOND', 'GC_CONTAINER_ACCOUNTS')}
+        self.fake = FakeGoogleApis()
+        settings.API_ROOT_URL = self.fake.start()
+        settings.TAG_MANAGER_API_VERSION = self.api_version
+        settings.TAG_MANAGER_QUERIES_PER_SECOND = 1000
+        settings.ANALYTICS_QUERIES_PER_SECOND = 1000
+        settings.GC_CONTAINER_ACCOUNTS = []
+        services.ClearServices()
+        google_tag_manager_api.ClearWorkspaces()
+
+        self.analytics = GetAnalyticsService('analytics', 'v3', [], '')
+        self.tag_manager = google_tag_manager_api.GetService('tagmanager', self.api_version, [], '')
+        sites = [{'name': name, 'url': 'http://%s.example.com' % name, 'options': {}} for name in ('kept', 'gone')]
+        for result in ProvisionSites(self.analytics, self.tag_manager, sites):
+            self.assertEqual(result['status'], 'ok', result)
+
+        self.account_id = self.fake.state.tag_manager_accounts[0]
+        self.container_ids = {name: ids[0] for name, ids in google_tag_manager_api.GetContainersList(
+            self.tag_manager, self.account_id).items()}
+
+    def tearDown(self):
+        self.fake.stop()
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        services.ClearServices()
+        google_tag_manager_api.ClearWorkspaces()
+
+    def _State(self, name):
+        return self.fake.state.containers[(self.account_id, self.container_ids[name])]
+
+    def _Age(self, name, days):
+        """
+        Date every change of a container back by days in the fake.
+        """
+
+        fingerprint = str(int((time.time() - days * DAY) * 1000))
+        state = self._State(name)
+        state['resource']['fingerprint'] = fingerprint
+        state['workspace_fingerprint'] = fingerprint
+        for kind in ('tags', 'triggers', 'variables', 'versions'):
+            for item in state[kind].values():
+                item['fingerprint'] = fingerprint
+
+    def _Find(self, **kwargs):
+        kwargs.setdefault('keep', ['kept'])
+        kwargs.setdefault('max_age_days', 90)
+        kwargs.setdefault('keep_versions', 10)
+        return cleanup.FindStaleContainers(self.tag_manager, self.account_id, **kwargs)
+
+    def _Stale(self, records, kind):
+        return sorted(record['name'] for record in records if record['kind'] == kind)
+
+    def test_containers_need_an_explicit_account(self):
+        self._Age('gone', 100)
+        self.assertEqual(self._Stale(self._Find(), 'container'), [])
+        self.assertEqual(self._Stale(self._Find(delete_containers=True), 'container'), ['gone'])
+
+    def test_containers_need_a_manifest(self):
+        self._Age('gone', 100)
+        self.assertEqual(self._Stale(self._Find(keep=None, delete_containers=True), 'container'), [])
+
+    def test_containers_not_created_by_the_tool_are_kept(self):
+        self._Age('gone', 100)
+        self._State('gone')['resource']['notes'] = 'created by hand'
+        self.assertEqual(self._Stale(self._Find(delete_containers=True), 'container'), [])
+
+    def test_recent_containers_are_kept(self):
+        self.assertEqual(self._Stale(self._Find(delete_containers=True), 'container'), [])
+
+    def test_workspace_changes_keep_a_container(self):
+        self._Age('gone', 100)
+        recent = str(int((time.time() - DAY) * 1000))
+        if self.api_version == 'v2':
+            self._State('gone')['workspace_fingerprint'] = recent
+        else:
+            next(iter(self._State('gone')['tags'].values()))['fingerprint'] = recent
+        self.assertEqual(self._Stale(self._Find(delete_containers=True), 'container'), [])
+
+    def test_published_versions_keep_a_container(self):
+        self._Age('gone', 100)
+        state = self._State('gone')
+        state['versions'][state['published']]['fingerprint'] = str(int((time.time() - DAY) * 1000))
+        self.assertEqual(self._Stale(self._Find(delete_containers=True), 'container'), [])
+
+    def test_old_versions_but_the_live_one_are_stale(self):
+        container_id = self.container_ids['kept']
+        live_version_id = self._State('kept')['published']
+        version_ids = [google_tag_manager_api.CreateContainerVersion(self.tag_manager, self.account_id, container_id)
+                       for _ in range(3)]
+
+        self.assertEqual(self._Stale(self._Find(keep_versions=3), 'version'), [])
+        self.assertEqual(self._Stale(self._Find(keep_versions=2), 'version'), version_ids[:1])
+        self.assertEqual(self._Stale(self._Find(keep_versions=1), 'version'), sorted(version_ids[:2]))
+        self.assertNotIn(live_version_id, self._Stale(self._Find(keep_versions=0), 'version'))
+
+    def test_old_paused_tags_are_stale(self):
+        tags = google_tag_manager_api.ContainerCollection(self.tag_manager, self.account_id,
+                                                          self.container_ids['kept'], 'tags')
+        tags.create({'name': 'paused', 'type': 'html', 'paused': True}).execute()
+        tags.create({'name': 'active', 'type': 'html'}).execute()
+
+        self.assertEqual(self._Stale(self._Find(), 'tag'), [])
+        self._Age('kept', 100)
+        self.assertEqual(self._Stale(self._Find(), 'tag'), ['paused'])
+
+    def test_tag_deletions_are_published(self):
+        container_id = self.container_ids['kept']
+        tags = google_tag_manager_api.ContainerCollection(self.tag_manager, self.account_id, container_id, 'tags')
+        tags.create({'name': 'paused', 'type': 'html', 'paused': True}).execute()
+        google_tag_manager_api.PublishContainerVersion(self.tag_manager, self.account_id, container_id,
+                                                       google_tag_manager_api.CreateContainerVersion(
+                                                           self.tag_manager, self.account_id, container_id))
+        self._Age('kept', 100)
+        reported = []
+        cleanup.CollectGarbage(['kept', 'gone'], True, 2, report=reported.append)
+
+        self.assertEqual([(record['kind'], record['name'], record['status']) for record in reported],
+                         [('tag', 'paused', 'deleted')])
+        state = self._State('kept')
+        self.assertNotIn('paused', [tag['name'] for tag in state['versions'][state['published']]['tag']])
+
+    def test_dry_run_deletes_nothing(self):
+        self._Age('gone', 100)
+        reported = []
+        records = cleanup.CollectGarbage(['kept'], False, 2, container_accounts=[self.account_id],
+                                         report=reported.append)
+
+        self.assertEqual([(record['kind'], record['name'], record['status']) for record in reported],
+                         [('container', 'gone', 'stale'), ('webproperty', 'gone', 'report_only')])
+        self.assertEqual(reported, records)
+        self.assertIn((self.account_id, self.container_ids['gone']), self.fake.state.containers)
+
+    def test_apply_reports_each_deletion(self):
+        self._Age('gone', 100)
+        reported = []
+        cleanup.CollectGarbage(['kept'], True, 2, container_accounts=[self.account_id], report=reported.append)
+
+        self.assertEqual(reported[0]['status'], 'deleted')
+        self.assertNotIn((self.account_id, self.container_ids['gone']), self.fake.state.containers)
+        self.assertIn((self.account_id, self.container_ids['kept']), self.fake.state.containers)
+
+    def test_failed_chunks_are_reported(self):
+        self._Age('gone', 100)
+        delete_containers = cleanup.DeleteContainers
+
+        def fail(*args):
+            raise socket.error('connection reset')
+
+        cleanup.DeleteContainers = fail
+        reported = []
+        try:
+            cleanup.CollectGarbage(['kept'], True, 2, container_accounts=[self.account_id], report=reported.append)
+        finally:
+            cleanup.DeleteContainers = delete_containers
+
+        self.assertEqual(reported[0]['status'], 'error')
+        self.assertIn('connection reset', reported[0]['error'])
+
+
+class CleanupV1Test(CleanupTest):
+
+    api_version = 'v1'
+
+
+if __name__ == '__main__':
+    unittest.main()
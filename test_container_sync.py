@@ -0,0 +1,84 @@
+"""
+Tests of container_sync.py against fake_api.py, run with python -m unittest test_container_sync.
+"""
+from __future__ import print_function, unicode_literals
+import unittest
+
+import container_sync
+import google_tag_manager_api
+import services
+import settings
+from fake_api import FakeGoogleApis
+
+
+def Tag(value, **fields):
+    return dict({'name': 'Custom HTML', 'type': 'html',
+                 'parameter': [{'type': 'template', 'key': 'html', 'value': value}]}, **fields)
+
+
+class ContainerSyncTest(unittest.TestCase):
+
+    api_version = 'v2'
+
+    def setUp(self):
+        self.settings = {name: getattr(settings, name) for name in (
+            'API_ROOT_URL', 'TAG_MANAGER_API_VERSION', 'TAG_MANAGER_QUERIES_PER_SECOND')}
+        self.fake = FakeGoogleApis()
+        settings.API_ROOT_URL = self.fake.start()
+        settings.TAG_MANAGER_API_VERSION = self.api_version
+        settings.TAG_MANAGER_QUERIES_PER_SECOND = 1000
+        services.ClearServices()
+        google_tag_manager_api.ClearWorkspaces()
+
+        self.tag_manager = google_tag_manager_api.GetService('tagmanager', self.api_version, [], '')
+        self.account_id = self.fake.state.tag_manager_accounts[0]
+
+    def tearDown(self):
+        self.fake.stop()
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        services.ClearServices()
+        google_tag_manager_api.ClearWorkspaces()
+
+    def _Sync(self, *tags):
+        spec = [{'name': 'site', 'url': 'http://site.example.com', 'tags': list(tags)}]
+        results = container_sync.SyncContainers(self.tag_manager, spec, self.account_id)
+        self.assertEqual(results[0]['status'], 'ok', results[0])
+        return results[0]
+
+    def _LiveTag(self):
+        container_id = google_tag_manager_api.GetContainersList(self.tag_manager, self.account_id)['site'][0]
+        container = self.fake.state.containers[(self.account_id, container_id)]
+        return next(iter(container['tags'].values()))
+
+    def test_update_sets_the_fields_of_the_spec(self):
+        self._Sync(Tag('<b>1</b>'))
+        result = self._Sync(Tag('<b>2</b>'))
+
+        self.assertEqual(result['updated'], 1)
+        self.assertEqual(self._LiveTag()['parameter'][0]['value'], '<b>2</b>')
+
+    def test_update_keeps_the_fields_the_spec_leaves_out(self):
+        self._Sync(Tag('<b>1</b>', notes='set by hand', tagFiringOption='oncePerEvent'))
+        result = self._Sync(Tag('<b>2</b>'))
+
+        self.assertEqual(result['updated'], 1)
+        tag = self._LiveTag()
+        self.assertEqual(tag['parameter'][0]['value'], '<b>2</b>')
+        self.assertEqual(tag['notes'], 'set by hand')
+        self.assertEqual(tag['tagFiringOption'], 'oncePerEvent')
+
+    def test_unchanged_spec_updates_nothing(self):
+        self._Sync(Tag('<b>1</b>', notes='set by hand'))
+        result = self._Sync(Tag('<b>1</b>'))
+
+        self.assertFalse(result['changed'])
+
+
+class ContainerSyncV1Test(ContainerSyncTest):
+
+    api_version = 'v1'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests of provisioning from inventories seeded with a snapshot, against fake_api.py, run with
+python -m unittest test_snapshot.
+"""
+from __future__ import print_function, unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+import google_tag_manager_api
+import services
+import settings
+from fake_api import FakeGoogleApis
+from inventory import Inventory
+from provisioning import ProvisionSites
+from snapshot import ExportSnapshot, Snapshot
+
+
+class SnapshotSeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = {name: getattr(settings, name) for name in (
+            'API_ROOT_URL', 'TAG_MANAGER_API_VERSION', 'TAG_MANAGER_QUERIES_PER_SECOND',
+            'ANALYTICS_QUERIES_PER_SECOND')}
+        self.fake = FakeGoogleApis()
+        settings.API_ROOT_URL = self.fake.start()
+        settings.TAG_MANAGER_API_VERSION = 'v2'
+        settings.TAG_MANAGER_QUERIES_PER_SECOND = 1000
+        settings.ANALYTICS_QUERIES_PER_SECOND = 1000
+        services.ClearServices()
+        google_tag_manager_api.ClearWorkspaces()
+
+        self.directory = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.directory, 'snapshot.jsonl.gz')
+        self.analytics = services.GetService('analytics', 'v3', [], '')
+        self.tag_manager = google_tag_manager_api.GetService('tagmanager', 'v2', [], '')
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.directory)
+        for name, value in self.settings.items():
+            setattr(settings, name, value)
+        services.ClearServices()
+        google_tag_manager_api.ClearWorkspaces()
+
+    def _Provision(self, names, inventory):
+        sites = [{'name': name, 'url': 'http://%s.example.com' % name, 'options': {}} for name in names]
+        for result in ProvisionSites(self.analytics, self.tag_manager, sites, inventory):
+            self.assertEqual(result['status'], 'ok', result)
+
+    def _Seeded(self, inventory):
+        Snapshot.read(self.snapshot_path).seed(inventory)
+        return inventory
+
+    def _Counts(self, name):
+        containers = [container for container in self.fake.state.containers.values()
+                      if container['resource']['name'] == name]
+        web_properties = [web_property for web_properties in self.fake.state.web_properties.values()
+                          for web_property in web_properties if web_property['name'] == name]
+        return len(containers), len(web_properties)
+
+    def test_sites_created_after_the_snapshot_are_not_duplicated(self):
+        self._Provision(['old'], Inventory())
+        ExportSnapshot(self.snapshot_path, workers=1)
+        self._Provision(['new'], Inventory())
+
+        self._Provision(['old', 'new'], self._Seeded(Inventory()))
+
+        self.assertEqual(self._Counts('old'), (1, 1))
+        self.assertEqual(self._Counts('new'), (1, 1))
+
+    def test_newer_listings_are_kept(self):
+        self._Provision(['old'], Inventory())
+        ExportSnapshot(self.snapshot_path, workers=1)
+        inventory_path = os.path.join(self.directory, 'inventory.sqlite')
+        inventory = Inventory(path=inventory_path)
+        self._Provision(['new'], inventory)
+        inventory.close()
+
+        inventory = self._Seeded(Inventory(path=inventory_path))
+        account_id = self.fake.state.tag_manager_accounts[0]
+        self.assertFalse(inventory.seeded('containers', account_id))
+        self.assertIn('new', inventory.get('containers', account_id))
+        self._Provision(['new'], inventory)
+        inventory.close()
+
+        self.assertEqual(self._Counts('new'), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()